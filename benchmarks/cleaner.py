@@ -0,0 +1,115 @@
+"""Measure the pauses of the ChatroomCleaner when many chatrooms are active.
+
+The server is filled with active conversations.  clean_inactive_users() is then called repeatedly:
+first while no deadline has expired yet, then once the deadlines of all the users have expired
+while they are still polling (they must be rescheduled), and finally once a part of them have stopped polling
+(they must be removed from their chatroom).  Meanwhile, a thread keeps joining new users to measure
+how long the joins are delayed by the cleaner.
+"""
+from datetime import datetime
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import report
+from server.base import BaseApi
+
+
+def measure(function, repeat):
+    durations = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {
+        "mean_ms": statistics.mean(durations) * 1000,
+        "max_ms": max(durations) * 1000
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the pauses of the chatroom cleaner.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--chatrooms", help="Number of active conversations.", type=int, default=10000)
+    parser.add_argument("--inactive_ratio", help="Ratio of the users that stop polling.", type=float, default=0.1)
+    parser.add_argument("--repeat", help="Number of times the cleaning is measured.", type=int, default=10)
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    cfg = {
+        "archives": tempfile.mkdtemp(prefix="dialogs-"),
+        "poll_interval": 1,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": "benchmark",
+        "prevent_multiple_tabs": "False"
+    }
+    api = BaseApi(cfg, logger)
+
+    chatrooms = []
+    for c in range(args.chatrooms):
+        chatroom_id = api.join(f"session{c}a_1")['chatroom'].id
+        api.join(f"session{c}b_1")
+        chatrooms.append(chatroom_id)
+
+    join_latencies = []
+    stop = threading.Event()
+
+    def join():
+        j = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            api.join(f"joining{j}_1")
+            join_latencies.append(time.perf_counter() - start)
+            j += 1
+            time.sleep(0.001)
+
+    def poll(users):
+        for chatroom_id in chatrooms[:users]:
+            chatroom = api.chatrooms.get(chatroom_id)
+            if chatroom is not None:
+                for user_id in list(chatroom.users):
+                    chatroom.has_polled(user_id)
+
+    joiner = threading.Thread(target=join)
+    joiner.start()
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "chatrooms": args.chatrooms
+    }
+    results["no_expired_deadline"] = measure(api.clean_inactive_users, args.repeat)
+
+    # Wait until all the deadlines have expired while the users keep polling.
+    time.sleep(api._get_inactivity_timeout() + 0.5)
+    poll(len(chatrooms))
+    results["expired_deadlines_of_active_users"] = measure(api.clean_inactive_users, 1)
+    results["after_rescheduling"] = measure(api.clean_inactive_users, args.repeat)
+
+    # Some of the users stop polling.
+    active_count = int(len(chatrooms) * (1 - args.inactive_ratio))
+    time.sleep(api._get_inactivity_timeout() + 0.5)
+    poll(active_count)
+    results["inactive_users_removal"] = measure(api.clean_inactive_users, 1)
+    results["remaining_chatrooms"] = len(api.chatrooms)
+
+    stop.set()
+    joiner.join()
+    api.shutdown()
+
+    results["join_latency_max_ms"] = max(join_latencies) * 1000 if join_latencies else 0.0
+    results["join_latency_mean_ms"] = statistics.mean(join_latencies) * 1000 if join_latencies else 0.0
+
+    report(results, args.output)
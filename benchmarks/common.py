@@ -0,0 +1,31 @@
+"""Helpers shared by the benchmark scripts."""
+import json
+import statistics
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies, prefix=""):
+    # Statistics of durations given in seconds.  The keys start with the prefix so that
+    # they can be merged into the results of a script.
+    return {
+        f"{prefix}count": len(latencies),
+        f"{prefix}mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+        f"{prefix}p50_ms": percentile(latencies, 50) * 1000,
+        f"{prefix}p99_ms": percentile(latencies, 99) * 1000,
+        f"{prefix}max_ms": max(latencies) * 1000 if latencies else 0.0
+    }
+
+
+def report(results, output=None):
+    # Prints the results and saves them in the output JSON file when one is given.
+    print(json.dumps(results, indent=4))
+    if output:
+        with open(output, mode="w") as output_file:
+            json.dump(results, output_file, indent=4)
@@ -0,0 +1,91 @@
+"""Measure the latency and the throughput of concurrent join requests.
+
+The server is first filled with a number of active conversations (closed chatrooms with 2 users),
+then many threads join at the same time.  Each pair of joining users should end up in the same chatroom.
+"""
+from datetime import datetime
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import report, summarize
+from server.base import BaseApi
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the join requests.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--active_chatrooms", help="Number of active conversations before the joins.", type=int, default=2000)
+    parser.add_argument("--joins", help="Number of users joining.", type=int, default=4000)
+    parser.add_argument("--threads", help="Number of threads performing the joins.", type=int, default=64)
+    parser.add_argument("--prevent_multiple_tabs", help="Value of the prevent_multiple_tabs parameter.", type=str, default="True")
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    cfg = {
+        "archives": tempfile.mkdtemp(prefix="dialogs-"),
+        "poll_interval": 30,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": "benchmark",
+        "prevent_multiple_tabs": args.prevent_multiple_tabs
+    }
+    api = BaseApi(cfg, logger)
+
+    for c in range(args.active_chatrooms):
+        api.join(f"active{c}a_1")
+        api.join(f"active{c}b_1")
+
+    latencies = []
+    assignments = {}
+    next_user = iter(range(args.joins))
+    next_user_lock = threading.Lock()
+
+    def run():
+        while True:
+            with next_user_lock:
+                u = next(next_user, None)
+            if u is None:
+                return
+            user_id = f"joining{u}_1"
+            start = time.perf_counter()
+            data = api.join(user_id)
+            latencies.append(time.perf_counter() - start)
+            assignments[user_id] = data['chatroom'].id
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run) for t in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    api.shutdown()
+
+    users_per_chatroom = {}
+    for user_id, chatroom_id in assignments.items():
+        users_per_chatroom[chatroom_id] = users_per_chatroom.get(chatroom_id, 0) + 1
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "active_chatrooms": args.active_chatrooms,
+        "joins": len(latencies),
+        "threads": args.threads,
+        "elapsed": elapsed,
+        "joins_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        **summarize(latencies, "latency_"),
+        "paired_chatrooms": sum(1 for count in users_per_chatroom.values() if count == 2),
+        "overfull_chatrooms": sum(1 for count in users_per_chatroom.values() if count > 2)
+    }
+    report(results, args.output)
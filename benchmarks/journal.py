@@ -0,0 +1,120 @@
+"""Measure the cost of the event journal and the time needed to recover the chatrooms from it.
+
+Several threads post messages in their own conversations, first without the journal, then with it
+(and with fsync when --fsync is given).  The mean cost of a post and the number of records written by
+each group commit are reported.  The server is then stopped abruptly (without its final snapshot)
+and a new one is started on the same journal to measure the recovery of the active chatrooms,
+from the journal only and from a snapshot.
+"""
+from datetime import datetime
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import report
+from server.base import BaseApi
+
+
+def make_cfg(journal_dir, args):
+    cfg = {
+        "archives": tempfile.mkdtemp(prefix="dialogs-"),
+        "poll_interval": 5,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": "benchmark",
+        "journal_fsync": "True" if args.fsync else "False",
+        # The snapshots are taken explicitly.
+        "journal_snapshot_interval": 10 ** 12
+    }
+    if journal_dir is not None:
+        cfg["journal"] = journal_dir
+    return cfg
+
+
+def post_messages(api, args):
+    # Returns the mean duration (in µs) of a post.
+    chatrooms = []
+    for c in range(args.chatrooms):
+        chatroom_id = api.join(f"session{c}a_1")['chatroom'].id
+        api.join(f"session{c}b_1")
+        chatrooms.append(chatroom_id)
+
+    def post(thread_index):
+        for m in range(args.messages):
+            for c in range(thread_index, args.chatrooms, args.threads):
+                api.post_message(f"session{c}{'a' if m % 2 == 0 else 'b'}_1", chatrooms[c], f"Message {m}")
+
+    threads = [threading.Thread(target=post, args=(t,)) for t in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    return duration * args.threads / (args.chatrooms * args.messages) * 1e6
+
+
+def crash(api):
+    # Stops the server without writing the final snapshot.
+    api.journal.close()
+    api.journal = None
+    api.shutdown()
+
+
+def recover(journal_dir, args):
+    start = time.perf_counter()
+    api = BaseApi(make_cfg(journal_dir, args), logging.getLogger('benchmark'))
+    duration = time.perf_counter() - start
+    assert len(api.chatrooms) == args.chatrooms
+    return api, duration
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the event journal.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--chatrooms", help="Number of active conversations.", type=int, default=2000)
+    parser.add_argument("--messages", help="Number of messages per conversation.", type=int, default=20)
+    parser.add_argument("--threads", help="Number of threads posting the messages.", type=int, default=16)
+    parser.add_argument("--fsync", help="Synchronize the journal to the disk on each commit.", action='store_true')
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "chatrooms": args.chatrooms,
+        "messages": args.messages,
+        "threads": args.threads,
+        "fsync": args.fsync
+    }
+
+    api = BaseApi(make_cfg(None, args), logger)
+    results["post_without_journal_us"] = post_messages(api, args)
+    api.shutdown()
+
+    journal_dir = tempfile.mkdtemp(prefix="journal-")
+    api = BaseApi(make_cfg(journal_dir, args), logger)
+    results["post_with_journal_us"] = post_messages(api, args)
+    stats = api.journal.stats()
+    results["journal_records"] = stats['records']
+    results["journal_bytes"] = stats['bytes']
+    results["records_per_commit"] = stats['records'] / stats['commits']
+    crash(api)
+
+    api, results["recovery_from_journal_secs"] = recover(journal_dir, args)
+    # The recovery ends with a snapshot, so the next one only loads it.
+    crash(api)
+    api, results["recovery_from_snapshot_secs"] = recover(journal_dir, args)
+    api.shutdown()
+
+    report(results, args.output)
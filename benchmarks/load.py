@@ -0,0 +1,350 @@
+"""Load test of the chat server through its HTTP routes.
+
+Pairs of participants play complete conversations like the browsers do: they join with the /join route,
+poll the /chatroom route until their partner arrives, take turns posting msg_count_high messages with
+the /post route (each one waits for the message of its partner with long polls) and leave with the
+/leave route.  By default, the server is started in a child process with a temporary configuration
+(use --asgi to serve it with uvicorn); --url targets a server that is already running instead
+and --pid gives its process so that its memory can be measured.
+
+The throughput, the latencies of each route, the pairing waits (time between the join and the arrival
+of the partner) and the RSS of the server are reported.  The /chatroom latencies include the time spent
+parked waiting for the partner.  The results can be saved (--output) and compared with the results of
+a previous run (--compare) to spot regressions.
+"""
+from datetime import datetime
+from http.cookies import SimpleCookie
+import http.client
+import json
+import logging
+import os
+import psutil
+import queue
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import report, summarize
+
+ROUTES = ("join", "chatroom", "post", "leave")
+
+
+def serve(cfg, port, asgi):
+    # Runs the server in this process (see the --serve option).
+    import jinja2
+    from pathlib import Path
+    from server.base import BaseApi, BaseApp
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    api = BaseApi(cfg, logging.getLogger('server'))
+    app = BaseApp(__name__, api)
+    app.jinja_loader.loaders.append(jinja2.FileSystemLoader(Path(__file__).parent.parent / 'templates'))
+    app.load_templates()
+    if asgi:
+        from server.asgi import AsgiApp
+        import uvicorn
+        uvicorn.run(AsgiApp(app), host='127.0.0.1', port=port, log_config=None, log_level='warning')
+    else:
+        app.run(host='127.0.0.1', port=port, debug=False, threaded=True)
+
+
+def start_server(args):
+    # Starts the server in a child process and waits until it answers.
+    work_dir = tempfile.mkdtemp(prefix="load-")
+    cfg = {
+        "sessions": os.path.join(work_dir, "sessions"),
+        "sessionTimeout": 30,
+        "cookiePath": "/ChatCollectionServer",
+        "archives": os.path.join(work_dir, "dialogs"),
+        "web_context": "ChatCollectionServer",
+        "poll_interval": args.poll_interval,
+        "delay_for_partner": 600,
+        "chatroom_cleaning_interval": 30,
+        "msg_count_low": max(args.messages // 3, 1),
+        "msg_count_high": args.messages,
+        "experiment_id": "benchmark",
+        "prevent_multiple_tabs": "True",
+        "push_transport": "poll"
+    }
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            cfg.update(json.load(f))
+    config_file = os.path.join(work_dir, "config.json")
+    with open(config_file, mode="w", encoding='utf-8') as f:
+        json.dump(cfg, f)
+
+    command = [sys.executable, os.path.abspath(__file__), "--serve", config_file, "--port", str(args.port)]
+    if args.asgi:
+        command.append("--asgi")
+    # The output of the server goes to stderr so that the results are the only output.
+    process = subprocess.Popen(command, stdout=sys.stderr)
+    url = f"http://127.0.0.1:{args.port}/{cfg['web_context']}"
+    deadline = time.monotonic() + args.start_timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', args.port, timeout=1)
+            connection.request("GET", f"/{cfg['web_context']}/version")
+            if connection.getresponse().status == 200:
+                return process, url
+        except OSError:
+            pass
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("The server could not be started.")
+        time.sleep(0.1)
+
+
+class Participant(object):
+    # Simulated browser tab of a user.  Each participant has its own session and connection.
+
+    def __init__(self, url, latencies, timeout):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        self.path = parts.path.rstrip('/')
+        self.latencies = latencies
+        self.headers = {}
+        self.client_tab_id = "1"
+        self.chatroom_id = None
+        # Sent with the requests following the join when the server issues tab tokens.
+        self.token = ''
+        self.version = ''
+        self.last_seq = 0
+        self.received = 0
+
+    def request(self, route, method, params):
+        body = None
+        headers = dict(self.headers)
+        path = f"{self.path}/{route}"
+        if method == "POST":
+            body = urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        else:
+            path = f"{path}?{urlencode(params)}"
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            cookie = response.getheader('Set-Cookie')
+            if cookie is not None:
+                # Keeps the session cookie like a browser.
+                self.headers['Cookie'] = '; '.join(f"{name}={morsel.value}" for name, morsel in SimpleCookie(cookie).items())
+        except (OSError, http.client.HTTPException):
+            # The server closed the connection: the next request opens a new one.
+            self.connection.close()
+            raise
+        self.latencies[route].append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError(f"/{route} returned {response.status}.")
+        return data
+
+    def join(self):
+        page = self.request("join", "POST", {'clientTabId': self.client_tab_id}).decode('utf-8')
+        match = re.search(r"var chatroomId = '(.+)';", page)
+        if match is None:
+            raise RuntimeError("/join did not return a chatroom.")
+        self.chatroom_id = match.group(1)
+        match = re.search(r"var tabToken = '(.*)';", page)
+        if match is not None:
+            self.token = match.group(1)
+
+    def update(self, data):
+        # Keeps the version and the last event of the chatroom like the client script.
+        chatroom = json.loads(data)
+        if isinstance(chatroom, str):
+            # Response rendered with the chatroom.json template.
+            chatroom = json.loads(chatroom)
+        if 'id' not in chatroom:
+            if 'msg' not in chatroom:
+                raise RuntimeError("The participant is not in the chatroom anymore.")
+            return chatroom
+        self.version = chatroom.get('version', chatroom.get('modified'))
+        for evt in chatroom['latestEvents']:
+            if evt['type'] == 'msg' and evt['from'] == 'other':
+                self.received += 1
+        if chatroom.get('lastSeq') is not None:
+            self.last_seq = chatroom['lastSeq']
+        return chatroom
+
+    def poll(self):
+        data = self.request("chatroom", "GET", {'clientTabId': self.client_tab_id, 'id': self.chatroom_id, 'token': self.token,
+                                                'timestamp': self.version, 'lastSeq': self.last_seq})
+        return self.update(data)
+
+    def post(self, message):
+        self.update(self.request("post", "POST", {'clientTabId': self.client_tab_id, 'chatroom': self.chatroom_id,
+                                                  'token': self.token, 'message': message, 'lastSeq': self.last_seq}))
+
+    def leave(self):
+        self.request("leave", "GET", {'clientTabId': self.client_tab_id, 'chatroom': self.chatroom_id,
+                                      'token': self.token, 'lastSeq': self.last_seq})
+        self.connection.close()
+
+
+def play(participant, messages, think_time, partner_timeout, pairing_waits):
+    # Plays one side of a conversation.  The initiator of the chatroom posts the even messages.
+    participant.join()
+    joined = time.perf_counter()
+    chatroom = participant.poll()
+    while len(chatroom.get('users', ())) < 2:
+        if time.perf_counter() - joined > partner_timeout:
+            participant.leave()
+            raise RuntimeError("No partner joined the chatroom.")
+        chatroom = participant.poll()
+    pairing_waits.append(time.perf_counter() - joined)
+
+    first = chatroom['initiator'] == 'self'
+    for m in range(messages):
+        if (m % 2 == 0) == first:
+            if think_time > 0:
+                time.sleep(think_time)
+            participant.post(f"Message {m}")
+        else:
+            expected = (m + 1) // 2 if first else m // 2 + 1
+            while participant.received < expected:
+                if len(participant.poll().get('users', (None, None))) < 2:
+                    participant.leave()
+                    raise RuntimeError("The partner left the chatroom.")
+    participant.leave()
+
+
+def compare(results, baseline):
+    # Prints the relative changes between two results.
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    lines = [f"Comparison with the results of {baseline['timestamp']}:"]
+    lines.append(f"  conversations/sec: {baseline['conversations_per_sec']:.1f} -> {results['conversations_per_sec']:.1f} "
+                 f"({change(results['conversations_per_sec'], baseline['conversations_per_sec'])})")
+    for name, stats in list(results['routes'].items()) + [('pairing_wait', results['pairing_wait'])]:
+        old_stats = baseline['routes'].get(name) if name != 'pairing_wait' else baseline.get('pairing_wait')
+        if old_stats is None:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            lines.append(f"  {name} {key}: {old_stats[key]:.2f} -> {stats[key]:.2f} ({change(stats[key], old_stats[key])})")
+    if results['rss_mb'] is not None and baseline.get('rss_mb') is not None:
+        lines.append(f"  peak RSS (MB): {baseline['rss_mb']['peak']:.1f} -> {results['rss_mb']['peak']:.1f} "
+                     f"({change(results['rss_mb']['peak'], baseline['rss_mb']['peak'])})")
+    print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Load test of the chat server through its HTTP routes.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--pairs", help="Number of conversations (pairs of participants).", type=int, default=200)
+    parser.add_argument("--concurrency", help="Number of participants playing at the same time.", type=int, default=100)
+    parser.add_argument("--messages", help="Number of messages of each conversation (msg_count_high of the server).", type=int, default=15)
+    parser.add_argument("--think_time", help="Delay (in secs) before each message is posted.", type=float, default=0.0)
+    parser.add_argument("--partner_timeout", help="Delay (in secs) after which a participant without partner gives up.", type=float, default=60)
+    parser.add_argument("--poll_interval", help="Value of the poll_interval parameter of the server.", type=int, default=30)
+    parser.add_argument("--url", help="URL of the web context of a running server (the server is started otherwise).", type=str, default=None)
+    parser.add_argument("--pid", help="With --url, process id of the server whose RSS is measured.", type=int, default=None)
+    parser.add_argument("--port", help="Port of the started server.", type=int, default=8995)
+    parser.add_argument("--config", help="JSON file overriding the configuration of the started server.", type=str, default=None)
+    parser.add_argument("--asgi", help="Serve the started server with an ASGI server (requires asgiref and uvicorn).", action="store_true")
+    parser.add_argument("--start_timeout", help="Delay (in secs) to wait for the started server.", type=float, default=30)
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    parser.add_argument("--compare", help="JSON file of previous results to compare with.", type=str, default=None)
+    parser.add_argument("--serve", help=argparse.SUPPRESS, type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    if args.serve:
+        with open(args.serve, encoding='utf-8') as f:
+            serve(json.load(f), args.port, args.asgi)
+        sys.exit(0)
+
+    if args.concurrency < 2:
+        parser.error("At least 2 participants must play at the same time so that they can be paired.")
+
+    server_process = None
+    if args.url:
+        url = args.url
+        pid = args.pid
+    else:
+        server_process, url = start_server(args)
+        pid = server_process.pid
+
+    latencies = {route: [] for route in ROUTES}
+    pairing_waits = []
+    errors = []
+    rss_samples = []
+    stop = threading.Event()
+
+    def sample_rss():
+        process = psutil.Process(pid)
+        while True:
+            rss_samples.append(process.memory_info().rss)
+            if stop.wait(0.2):
+                return
+
+    participants = queue.SimpleQueue()
+    for p in range(args.pairs * 2):
+        participants.put(p)
+
+    def work():
+        while True:
+            try:
+                participants.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                play(Participant(url, latencies, args.poll_interval + 10), args.messages, args.think_time,
+                     args.partner_timeout, pairing_waits)
+            except Exception as e:
+                errors.append(repr(e))
+
+    sampler = None
+    if pid is not None:
+        sampler = threading.Thread(target=sample_rss)
+        sampler.start()
+    try:
+        start = time.perf_counter()
+        workers = [threading.Thread(target=work) for w in range(args.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        if sampler is not None:
+            sampler.join()
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    requests = sum(len(values) for values in latencies.values())
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "url": url if args.url else None,
+        "asgi": args.asgi,
+        "pairs": args.pairs,
+        "concurrency": args.concurrency,
+        "messages": args.messages,
+        "think_time": args.think_time,
+        "elapsed": elapsed,
+        "conversations_per_sec": args.pairs / elapsed if elapsed > 0 else 0.0,
+        "requests_per_sec": requests / elapsed if elapsed > 0 else 0.0,
+        "routes": {route: summarize(values) for route, values in latencies.items()},
+        "pairing_wait": summarize(pairing_waits),
+        "rss_mb": {
+            "start": rss_samples[0] / 2 ** 20,
+            "peak": max(rss_samples) / 2 ** 20,
+            "end": rss_samples[-1] / 2 ** 20
+        } if rss_samples else None,
+        "errors": len(errors),
+        "first_errors": errors[:10]
+    }
+
+    report(results, args.output)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
@@ -0,0 +1,111 @@
+"""Measure the delay between a posted message and the wakeup of the partner's parked poll.
+
+N chatrooms are filled with 2 users.  For each chatroom, one thread keeps polling the chatroom
+(like default_chat.js does) while another thread posts messages at random intervals.
+The delay between the post and the moment the poll returns is reported.
+"""
+from datetime import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import report, summarize
+from server.base import BaseApi
+
+
+def run_chatroom(api, chatroom_id, poster_id, poller_id, msg_count, max_pause, delays):
+    posted = {}
+    stop = threading.Event()
+
+    def poll():
+        timestamp = None
+        seen = 0
+        while not stop.is_set():
+            data = api.get_chatroom(chatroom_id, poller_id, timestamp)
+            if data is None:
+                return
+            if data == "expired":
+                continue
+            now = time.perf_counter()
+            chatroom = data['chatroom']
+            timestamp = chatroom.modified
+            for evt in chatroom.events[seen:]:
+                if evt['body'] in posted:
+                    delays.append(now - posted[evt['body']])
+            seen = len(chatroom.events)
+            if seen >= msg_count:
+                return
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    for m in range(msg_count):
+        time.sleep(random.random() * max_pause)
+        body = f"{chatroom_id}-{m}"
+        posted[body] = time.perf_counter()
+        api.post_message(poster_id, chatroom_id, body)
+    poller.join(timeout=api.cfg['poll_interval'] * 2)
+    stop.set()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the wakeup latency of the chatroom poll requests.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--chatrooms", help="Number of concurrent chatrooms.", type=int, default=100)
+    parser.add_argument("--messages", help="Number of messages posted in each chatroom.", type=int, default=10)
+    parser.add_argument("--max_pause", help="Maximum pause (in secs) between 2 messages.", type=float, default=0.2)
+    parser.add_argument("--poll_interval", help="Poll interval (in secs).", type=int, default=30)
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    cfg = {
+        "archives": tempfile.mkdtemp(prefix="dialogs-"),
+        "poll_interval": args.poll_interval,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": "benchmark",
+        "prevent_multiple_tabs": "False"
+    }
+    api = BaseApi(cfg, logger)
+
+    chatrooms = []
+    for c in range(args.chatrooms):
+        first = api.join(f"session{c}a_1")
+        api.join(f"session{c}b_1")
+        chatrooms.append((first['chatroom'].id, f"session{c}a_1", f"session{c}b_1"))
+
+    delays = []
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_chatroom,
+                                args=(api, chatroom_id, poster_id, poller_id, args.messages, args.max_pause, delays))
+               for chatroom_id, poster_id, poller_id in chatrooms]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for chatroom_id, poster_id, poller_id in chatrooms:
+        api.leave_chatroom(poster_id, chatroom_id)
+        api.leave_chatroom(poller_id, chatroom_id)
+    api.shutdown()
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "chatrooms": args.chatrooms,
+        "messages": len(delays),
+        "elapsed": elapsed,
+        **summarize(delays, "delay_")
+    }
+    report(results, args.output)
@@ -0,0 +1,111 @@
+"""Stress the chatroom registry with many threads joining, chatting and leaving at the same time.
+
+Each thread plays complete conversations: two users join, post a few messages and leave.
+Meanwhile, a thread keeps running the cleaner so that join, leave and cleanup all compete
+for the locks of the server.  The throughput and the latencies of each operation are reported
+along with the consistency of the server at the end (no remaining chatrooms nor overfull chatrooms).
+"""
+from datetime import datetime
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import report, summarize
+from server.base import BaseApi
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Stress test of the chatroom registry.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--active_chatrooms", help="Number of active conversations before the stress test.", type=int, default=5000)
+    parser.add_argument("--threads", help="Number of threads playing conversations.", type=int, default=32)
+    parser.add_argument("--conversations", help="Number of conversations played by each thread.", type=int, default=200)
+    parser.add_argument("--messages", help="Number of messages posted in each conversation.", type=int, default=4)
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    cfg = {
+        "archives": tempfile.mkdtemp(prefix="dialogs-"),
+        "poll_interval": 30,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": "benchmark",
+        "prevent_multiple_tabs": "False",
+        # Large enough so that the dialogs are never archived synchronously during the test.
+        "archive_queue_size": 1000000
+    }
+    api = BaseApi(cfg, logger)
+
+    for c in range(args.active_chatrooms):
+        api.join(f"active{c}a_1")
+        api.join(f"active{c}b_1")
+
+    latencies = {"join": [], "post": [], "leave": [], "clean": []}
+    errors = []
+    stop = threading.Event()
+
+    def timed(operation, function, *function_args):
+        start = time.perf_counter()
+        result = function(*function_args)
+        latencies[operation].append(time.perf_counter() - start)
+        return result
+
+    def play(t):
+        for c in range(args.conversations):
+            user_ids = [f"user{t}x{c}a_1", f"user{t}x{c}b_1"]
+            chatroom_ids = []
+            for user_id in user_ids:
+                data = timed("join", api.join, user_id)
+                if data is None or len(data['chatroom'].users) > 2:
+                    errors.append(user_id)
+                    return
+                chatroom_ids.append(data['chatroom'].id)
+            for m in range(args.messages):
+                timed("post", api.post_message, user_ids[m % 2], chatroom_ids[m % 2], f"Message {m}")
+            for user_id, chatroom_id in zip(user_ids, chatroom_ids):
+                timed("leave", api.leave_chatroom, user_id, chatroom_id)
+
+    def clean():
+        while not stop.is_set():
+            timed("clean", api.clean_inactive_users)
+            time.sleep(0.001)
+
+    cleaner = threading.Thread(target=clean)
+    cleaner.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=play, args=(t,)) for t in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    cleaner.join()
+
+    conversations = args.threads * args.conversations
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "active_chatrooms": args.active_chatrooms,
+        "threads": args.threads,
+        "conversations": conversations,
+        "elapsed": elapsed,
+        "conversations_per_sec": conversations / elapsed if elapsed > 0 else 0.0,
+        "operations": {operation: summarize(values) for operation, values in latencies.items()},
+        "errors": len(errors),
+        "remaining_chatrooms": len(api.chatrooms) - args.active_chatrooms,
+        "overfull_chatrooms": sum(1 for chatroom in api.chatrooms.values() if len(chatroom.users) > 2)
+    }
+    api.shutdown()
+
+    report(results, args.output)
@@ -0,0 +1,86 @@
+"""Compare the cost of the chatroom responses built from the chatroom.json template and built directly.
+
+For each mode, the chatroom response of a dialog of a given length is built many times and
+the CPU time and the size of each response are reported.
+"""
+from datetime import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+
+from common import report
+import server.base
+from server.base import BaseApi, BaseApp
+
+
+def measure(app, user_id, data, repeat):
+    with app.app_context():
+        start = time.process_time()
+        for r in range(repeat):
+            response = app._make_chatroom_response(user_id, data)
+            body = response.get_data()
+        elapsed = time.process_time() - start
+    return {
+        "us_per_response": elapsed / repeat * 1000000,
+        "bytes_per_response": len(body)
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the serialization of the chatroom responses.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--messages", help="Number of messages in the chatroom.", type=int, default=15)
+    parser.add_argument("--repeat", help="Number of responses built for each mode.", type=int, default=5000)
+    parser.add_argument("--output", help="JSON file where the results are saved.", type=str, default=None)
+    args = parser.parse_args(args=None)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    tmp_dir = tempfile.mkdtemp(prefix="serialization-")
+    cfg = {
+        "sessions": f"{tmp_dir}/sessions",
+        "cookiePath": "/ChatCollectionServer",
+        "archives": f"{tmp_dir}/dialogs",
+        "web_context": "ChatCollectionServer",
+        "poll_interval": 30,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": "benchmark"
+    }
+    api = BaseApi(cfg, logger)
+    # The templates are found relatively to the current directory.
+    os.chdir(ROOT_DIR)
+    app = BaseApp('benchmark', api)
+
+    chatroom_id = api.join("sessiona_1")['chatroom'].id
+    api.join("sessionb_1")
+    for m in range(args.messages):
+        user_id = "sessiona_1" if m % 2 == 0 else "sessionb_1"
+        api.post_message(user_id, chatroom_id, f"メッセージ {m}: What do you think about it?")
+    data = api._get_chatroom_data(chatroom_id)
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "messages": args.messages
+    }
+    app.chatroom_response_template = True
+    results["template"] = measure(app, "sessiona_1", data, args.repeat)
+    app.chatroom_response_template = False
+    results["direct"] = measure(app, "sessiona_1", data, args.repeat)
+    if server.base.orjson is not None:
+        orjson = server.base.orjson
+        server.base.orjson = None
+        results["direct_without_orjson"] = measure(app, "sessiona_1", data, args.repeat)
+        server.base.orjson = orjson
+    api.shutdown()
+
+    report(results, args.output)
@@ -0,0 +1,309 @@
+from datetime import datetime, timezone
+import json
+import os
+from pathlib import Path
+import pytz
+import queue
+import sys
+import threading
+import time
+import traceback
+
+
+tz = pytz.timezone('Asia/Tokyo')
+
+
+def get_sender(evt, chatroom):
+    return f"U{1 if evt['from'] == chatroom.initiator else 2}"
+
+
+class ArchiveBackend(object):
+    # Interface of the archive formats.
+    # write() is called by the DialogArchiver thread with a batch of released chatrooms.
+
+    def __init__(self, cfg, logger):
+        self.cfg = cfg
+        self.logger = logger
+        self.fsync = 'archive_fsync' in cfg and cfg['archive_fsync'] == 'True'
+
+    def write(self, chatrooms):
+        raise NotImplementedError()
+
+    def read(self, chatroom_id):
+        # Returns the archived record of a chatroom as a dictionary or None if it cannot be found.
+        return None
+
+    def close(self):
+        pass
+
+
+class TextArchiveBackend(ArchiveBackend):
+    # Default format: one text file per dialog in archives/YYYY/MM/DD/<chatroom_id>.txt
+    # with one "timestamp|U1: body" line per event.
+
+    def __init__(self, cfg, logger):
+        ArchiveBackend.__init__(self, cfg, logger)
+        self.dirs = set()
+
+    def write(self, chatrooms):
+        for chatroom in chatrooms:
+            self.write_dialog(chatroom)
+
+    def write_dialog(self, chatroom):
+        creation_date = datetime.fromtimestamp(chatroom.created_at, timezone.utc)
+
+        dialog_dir = f"{self.cfg['archives']}/{creation_date.year}/{creation_date.month:02}/{creation_date.day:02}"
+        if dialog_dir not in self.dirs:
+            Path(dialog_dir).mkdir(parents=True, exist_ok=True)
+            self.dirs.add(dialog_dir)
+        dialog_filename = f"{chatroom.id}.txt"
+        with open(f"{dialog_dir}/{dialog_filename}", mode="w") as output_file:
+            if chatroom.experiment_id:
+                output_file.write(f"Experiment: {chatroom.experiment_id}\n")
+            for evt in chatroom.events:
+                timestamp = datetime.fromisoformat(f"{evt['timestamp']}+00:00").astimezone(tz).isoformat()
+                output_file.write(f"{timestamp}|{get_sender(evt, chatroom)}: {evt['body']}\n")
+            if self.fsync:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+        self.logger.debug("Dialog has been archived in %s/%s", dialog_dir, dialog_filename)
+
+
+class JsonlArchiveBackend(ArchiveBackend):
+    # Append-only format: the dialogs are appended as JSON lines to rolling segment files
+    # archives/segments/dialogs-NNNNNN.jsonl.  A new segment is started when the current one
+    # exceeds archive_segment_size bytes.  The index.tsv file gives, for each chatroom,
+    # the segment, the offset and the length of its record so that it can be read back directly.
+    # A whole batch is written with a single write (and a single fsync).
+
+    def __init__(self, cfg, logger):
+        ArchiveBackend.__init__(self, cfg, logger)
+        self.segment_size = cfg.get('archive_segment_size', 64 * 1024 * 1024)
+        self.dir = Path(cfg['archives']) / 'segments'
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.dir / 'index.tsv'
+        self.lock = threading.Lock()
+        self.index = {}
+        if self.index_path.exists():
+            with open(self.index_path, encoding='utf-8') as index_file:
+                for line in index_file:
+                    chatroom_id, segment, offset, length = line.rstrip('\n').split('\t')
+                    self.index[chatroom_id] = (segment, int(offset), int(length))
+        segments = sorted(self.dir.glob('dialogs-*.jsonl'))
+        self.segment_number = int(segments[-1].stem.split('-')[1]) if segments else 1
+
+    def segment_name(self):
+        return f"dialogs-{self.segment_number:06}.jsonl"
+
+    def write(self, chatrooms):
+        records = [(chatroom.id, (json.dumps(chatroom_to_record(chatroom), ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+                   for chatroom in chatrooms]
+        with self.lock:
+            segment_path = self.dir / self.segment_name()
+            offset = segment_path.stat().st_size if segment_path.exists() else 0
+            if offset >= self.segment_size:
+                self.segment_number += 1
+                segment_path = self.dir / self.segment_name()
+                offset = 0
+            index_lines = []
+            for chatroom_id, record in records:
+                index_lines.append(f"{chatroom_id}\t{segment_path.name}\t{offset}\t{len(record)}\n")
+                self.index[chatroom_id] = (segment_path.name, offset, len(record))
+                offset += len(record)
+            with open(segment_path, mode='ab') as segment_file:
+                segment_file.write(b''.join(record for chatroom_id, record in records))
+                if self.fsync:
+                    segment_file.flush()
+                    os.fsync(segment_file.fileno())
+            with open(self.index_path, mode='a', encoding='utf-8') as index_file:
+                index_file.write(''.join(index_lines))
+                if self.fsync:
+                    index_file.flush()
+                    os.fsync(index_file.fileno())
+        self.logger.debug("%s dialogs have been archived in %s", len(records), segment_path)
+
+    def read(self, chatroom_id):
+        with self.lock:
+            if chatroom_id not in self.index:
+                return None
+            segment, offset, length = self.index[chatroom_id]
+        with open(self.dir / segment, mode='rb') as segment_file:
+            segment_file.seek(offset)
+            return json.loads(segment_file.read(length).decode('utf-8'))
+
+
+archive_backends = {
+    'text': TextArchiveBackend,
+    'jsonl': JsonlArchiveBackend
+}
+
+
+def chatroom_to_record(chatroom):
+    return {
+        'id': chatroom.id,
+        'experimentId': chatroom.experiment_id,
+        'initiator': chatroom.initiator,
+        'created': chatroom.created,
+        'modified': chatroom.modified,
+        'users': chatroom.leaved_users,
+        'attribs': chatroom.attribs,
+        'events': [dict(evt, sender=get_sender(evt, chatroom)) for evt in chatroom.events]
+    }
+
+
+def read_segments(segment_dir):
+    # Iterates over all the records of the JSONL segments of a directory.
+    for segment_path in sorted(Path(segment_dir).glob('dialogs-*.jsonl')):
+        with open(segment_path, encoding='utf-8') as segment_file:
+            for line in segment_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def records_to_columns(records):
+    # Flattens the events of the records into columns (one row per event).
+    columns = {
+        'chatroom_id': [],
+        'experiment_id': [],
+        'seq': [],
+        'timestamp': [],
+        'sender': [],
+        'sender_id': [],
+        'type': [],
+        'body': []
+    }
+    for record in records:
+        for evt in record['events']:
+            columns['chatroom_id'].append(record['id'])
+            columns['experiment_id'].append(None if record['experimentId'] is None else str(record['experimentId']))
+            columns['seq'].append(evt.get('seq'))
+            columns['timestamp'].append(evt['timestamp'])
+            columns['sender'].append(evt.get('sender'))
+            columns['sender_id'].append(evt.get('from'))
+            columns['type'].append(evt.get('type'))
+            columns['body'].append(evt.get('body'))
+    return columns
+
+
+def export_parquet(segment_dir, output_path):
+    # Exports the events of the JSONL segments into a Parquet file for corpus analysis.
+    # This requires the pyarrow package.
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The pyarrow package is required to export the archives to Parquet.")
+    columns = records_to_columns(read_segments(segment_dir))
+    table = pyarrow.table(columns)
+    pyarrow.parquet.write_table(table, output_path)
+    return table.num_rows
+
+
+class DialogArchiver(threading.Thread):
+    # Background thread archiving the dialogs of the released chatrooms.
+    # The chatrooms are put in a bounded queue and written by batches so that
+    # the disk I/O does not delay the requests.  When the queue is full,
+    # the dialog is written synchronously by the caller so that no dialog is lost.
+
+    _STOP = object()
+
+    def __init__(self, write_batch, logger, queue_size=1000, batch_size=50):
+        threading.Thread.__init__(self, name='DialogArchiver', daemon=True)
+        self.write_batch = write_batch
+        self.logger = logger
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats_lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.sync_writes = 0
+        self.write_latency_last = 0.0
+        self.write_latency_max = 0.0
+        self.write_latency_total = 0.0
+        self.batches = 0
+
+    def submit(self, chatroom):
+        try:
+            self.queue.put_nowait(chatroom)
+        except queue.Full:
+            self.logger.warning("The archive queue is full. Archiving chatroom %s synchronously.", chatroom.id)
+            with self.stats_lock:
+                self.sync_writes += 1
+            self._write([chatroom])
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            chatroom = self.queue.get()
+            if chatroom is self._STOP:
+                self.queue.task_done()
+                break
+            batch = [chatroom]
+            while len(batch) < self.batch_size:
+                try:
+                    chatroom = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if chatroom is self._STOP:
+                    self.queue.task_done()
+                    stopped = True
+                    break
+                batch.append(chatroom)
+            self._write(batch)
+            for chatroom in batch:
+                self.queue.task_done()
+
+    def drain(self):
+        # Wait until all the submitted dialogs have been written.
+        self.queue.join()
+
+    def close(self, timeout=None):
+        # Write the pending dialogs and stop the thread.
+        if self.is_alive():
+            self.queue.put(self._STOP)
+            self.join(timeout)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'written': self.written,
+                'failed': self.failed,
+                'sync_writes': self.sync_writes,
+                'write_latency_last': self.write_latency_last,
+                'write_latency_max': self.write_latency_max,
+                'write_latency_mean': self.write_latency_total / self.batches if self.batches > 0 else 0.0
+            }
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        try:
+            self.write_batch(batch)
+            failed = 0
+        except:
+            failed = len(batch)
+            (typ, val, tb) = sys.exc_info()
+            error_msg = "An exception occurred in the DialogArchiver:\n"
+            for line in traceback.format_exception(typ, val, tb):
+                error_msg += line + "\n"
+            self.logger.error(error_msg)
+        latency = time.perf_counter() - start
+        with self.stats_lock:
+            self.written += len(batch) - failed
+            self.failed += failed
+            self.batches += 1
+            self.write_latency_last = latency
+            self.write_latency_max = max(self.write_latency_max, latency)
+            self.write_latency_total += latency
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Export the JSONL archives into a Parquet file.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--archives", help="Location of the archives (see config.json).", type=str, required=True)
+    parser.add_argument("--output", help="Parquet file to write.", type=str, default="dialogs.parquet")
+    args = parser.parse_args(args=None)
+
+    row_count = export_parquet(Path(args.archives) / 'segments', args.output)
+    print(f"{row_count} events have been exported to {args.output}.")
@@ -0,0 +1,161 @@
+import asyncio
+import io
+
+from server.base import BaseApi, BaseApp
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+
+def build_environ(scope, body=b''):
+    # Builds a minimal WSGI environ from an ASGI http scope so that
+    # the Flask request and session machinery can be reused.
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+        'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = f"HTTP_{name.upper().replace('-', '_')}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+# ASGI application serving a BaseApp.
+# The /chatroom poll requests are handled as coroutines waiting for a change notification
+# of their chatroom so that a parked poll does not hold a thread.  All the other requests
+# are forwarded to the Flask application that runs them in a thread pool.
+# The /events streams of server-sent events are handled the same way.
+# If the App overrides get_chatroom() (or stream_chatroom()), the requests are forwarded to the Flask application too.
+# If the Api overrides get_chatroom() or if its state store is shared with other processes,
+# get_chatroom() is run in a thread pool.
+class AsgiApp:
+
+    def __init__(self, app):
+        if WsgiToAsgi is None:
+            raise ImportError("The asgiref package is required to serve the application with ASGI.")
+        self.app = app
+        self.api = app.api
+        self.logger = app.logger
+        self.wsgi_app = WsgiToAsgi(app)
+        self.chatroom_path = f"/{app.cfg['web_context']}/chatroom"
+        self.events_path = f"/{app.cfg['web_context']}/events"
+        self.handles_polls = type(app).get_chatroom is BaseApp.get_chatroom
+        self.handles_streams = app.push_transport == 'sse' and type(app).stream_chatroom is BaseApp.stream_chatroom
+        # The locks of a shared state store may block on network I/O so they are not used in the event loop.
+        self.api_polls_async = type(app.api).get_chatroom is BaseApi.get_chatroom and not app.api.store.shared
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and self.handles_polls and \
+                scope['method'] == 'GET' and scope['path'] == self.chatroom_path:
+            await self.get_chatroom(scope, receive, send)
+        elif scope['type'] == 'http' and self.handles_streams and \
+                scope['method'] == 'GET' and scope['path'] == self.events_path:
+            await self.stream_chatroom(scope, receive, send)
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.api.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_chatroom(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope)
+
+        # Opening the session may require some I/O so it is done outside of the event loop.
+        poll = await loop.run_in_executor(None, self._get_poll_params, environ)
+        if poll is None:
+            await self._send(send, 400, [], b'')
+            return
+
+        data = await self._poll(loop, poll)
+
+        with self.app.app_context():
+            response = self.app._get_poll_response(poll, data)
+        headers = [(name.encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()]
+        await self._send(send, response.status_code, headers, response.get_data())
+
+    async def stream_chatroom(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope)
+
+        poll = await loop.run_in_executor(None, self._get_poll_params, environ)
+        if poll is None:
+            await self._send(send, 400, [], b'')
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]
+        })
+        # The parked poll is cancelled as soon as the client closes the connection.
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            while True:
+                polled = asyncio.ensure_future(self._poll(loop, poll))
+                await asyncio.wait([polled, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    # Wait for the cancelled poll so that it removes its listener from the chatroom.
+                    polled.cancel()
+                    await asyncio.wait([polled])
+                    return
+                data = polled.result()
+                with self.app.app_context():
+                    event = self.app._get_stream_event(poll, data)
+                await send({'type': 'http.response.body', 'body': event, 'more_body': data is not None})
+                if data is None:
+                    return
+        finally:
+            disconnected.cancel()
+
+    async def _poll(self, loop, poll):
+        if self.api_polls_async:
+            return await self.api.get_chatroom_async(poll['chatroom_id'], poll['user_id'], poll['client_timestamp'])
+        return await loop.run_in_executor(None, self.api.get_chatroom,
+                                          poll['chatroom_id'], poll['user_id'], poll['client_timestamp'])
+
+    async def _wait_for_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    def _get_poll_params(self, environ):
+        with self.app.request_context(environ) as ctx:
+            return self.app._get_poll_params(ctx.session, ctx.request)
+
+    async def _send(self, send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
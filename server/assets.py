@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Types of the files that are worth compressing.
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# Cache lifetime (in secs) of the fingerprinted URLs.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def gzip_compress(data):
+    # Equivalent of gzip.compress(data, compresslevel=9, mtime=0), whose mtime argument requires Python 3.8.
+    # The modification time is left out so that the compressed data only depends on the content.
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
+
+
+class Asset(object):
+    # Content of a static file along with its precompressed variants by encoding ("gzip" and "br").
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.fingerprint = hashlib.sha256(data).hexdigest()[:16]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.variants = {}
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            self._add_variant('gzip', gzip_compress(data))
+            if brotli is not None:
+                self._add_variant('br', brotli.compress(data))
+
+    def _add_variant(self, encoding, compressed_data):
+        if len(compressed_data) < len(self.data):
+            self.variants[encoding] = compressed_data
+
+    def etag(self, encoding=None):
+        # Each variant has its own entity tag.
+        return f"{self.fingerprint}-{encoding}" if encoding else self.fingerprint
+
+    def select(self, accept_encodings):
+        # Returns the encoding of the smallest variant accepted by the client (a werkzeug Accept object)
+        # or None when the file must be sent as is.
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding] > 0:
+                return encoding
+        return None
+
+
+class StaticAssets(object):
+    # Static files of a directory kept in memory with their fingerprints and their compressed variants.
+    # The directory is scanned once (see load()) so that serving a file does not touch the disk.
+    # The files bigger than max_size and the files added after the scan are not kept:
+    # get() returns None and the caller sends them from the disk.
+
+    def __init__(self, directory, max_size=1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.assets = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        assets = {}
+        if os.path.isdir(self.directory):
+            for root, dirs, files in os.walk(self.directory):
+                for name in files:
+                    file_path = os.path.join(root, name)
+                    if os.path.getsize(file_path) > self.max_size:
+                        continue
+                    path = os.path.relpath(file_path, self.directory).replace(os.sep, '/')
+                    with open(file_path, mode='rb') as f:
+                        assets[path] = Asset(path, f.read())
+        self.assets = assets
+
+    def get(self, path):
+        if self.assets is None:
+            with self.lock:
+                if self.assets is None:
+                    self.load()
+        return self.assets.get(path)
+
+    def url(self, prefix, path):
+        # Returns the URL of a file fingerprinted with its content so that it can be cached forever.
+        asset = self.get(path)
+        if asset is None:
+            return f"{prefix}/{path}"
+        return f"{prefix}/{path}?v={asset.fingerprint}"
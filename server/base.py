@@ -1,19 +1,39 @@
-from datetime import date, datetime
-import dateutil.parser
-from flask import Flask, jsonify, render_template, request, send_from_directory, session
+import asyncio
+import atexit
+import bisect
+from collections import deque, OrderedDict
+from datetime import datetime, timezone
+import heapq
+import itertools
+from flask import Flask, jsonify, render_template, request, send_from_directory, session, stream_with_context
 from flask_session import Session
+from jinja2.environment import TemplateStream
 from jinja2.exceptions import TemplateNotFound
 import jinja2
 import json
 import os
 from pathlib import Path
+import pickle
 import pytz
+from urllib.parse import urlencode
+from server.archive import archive_backends, chatroom_to_record, DialogArchiver
+from server.assets import IMMUTABLE_MAX_AGE, StaticAssets
+from server.journal import EventJournal
+from server.log import QueueLogging, RequestLogger
+from server.metrics import ServerMetrics
+from server.session import MemorySessionInterface, TabTokens, TabTokenSessionInterface
+import secrets
 import sys
 import threading
 import time
 import traceback
 import uuid
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 tz = pytz.timezone('Asia/Tokyo')
 
@@ -28,7 +48,9 @@ def flatten(l):
     return [item for sublist in l for item in sublist]
 
 def get_session_id(user_id):
-    index_of_underscore = user_id.find('_')
+    # The user ids are made of the session id and the client tab id.
+    # The session ids might contain underscores so the last one is the separator.
+    index_of_underscore = user_id.rfind('_')
     if index_of_underscore == -1:
         return user_id
     return user_id[:index_of_underscore]
@@ -39,13 +61,65 @@ def events_for_user(evt, user_id):
         'timestamp': evt['timestamp'],
         'type': evt['type']
     }
+    if 'seq' in evt:
+        event_for_user['seq'] = evt['seq']
     if 'body' in evt:
         event_for_user['body'] = evt['body']
     return event_for_user
 
+def dumps_json(obj):
+    # Encodes obj into UTF-8 JSON bytes, using orjson when it is available.
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def parse_seq(str_seq):
+    # Returns None when the client did not provide a valid sequence number
+    # so that all the events are sent back.
+    try:
+        seq = int(str_seq)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+def parse_events(str_events, max_count):
+    # Parses the events posted in a batch (see BaseApp.post_events()).
+    # Returns None when they are invalid: not a list of at most max_count objects having a known type and a body.
+    try:
+        events = json.loads(str_events)
+    except ValueError:
+        return None
+    if not isinstance(events, list) or len(events) == 0 or len(events) > max_count:
+        return None
+    for event in events:
+        if not isinstance(event, dict) or event.get('type') not in evt_type or not isinstance(event.get('body'), str):
+            return None
+    return events
+
+def parse_version(str_version):
+    # The clients send back the version of their chatroom (see BaseChatroom.version).
+    # Any other value (for instance, the ISO modification time sent by older clients) is returned as is.
+    if str_version is None or str_version == '':
+        return None
+    try:
+        return int(str_version)
+    except ValueError:
+        return str_version
+
+def epoch_to_utc(epoch_timestamp):
+    # Returns the ISO representation of an epoch timestamp in the same format as datetime.utcnow().isoformat().
+    return datetime.fromtimestamp(epoch_timestamp, timezone.utc).replace(tzinfo=None).isoformat()
+
+def utc_to_epoch(utc_timestamp):
+    # Inverse of epoch_to_utc().
+    return datetime.fromisoformat(utc_timestamp).replace(tzinfo=timezone.utc).timestamp()
+
 def utc_to_local(utc_timestamp):
     return datetime.fromisoformat(f"{utc_timestamp}+00:00").astimezone(tz).isoformat() if utc_timestamp else ""
 
+def epoch_to_local(epoch_timestamp):
+    return datetime.fromtimestamp(epoch_timestamp, tz).isoformat() if epoch_timestamp is not None else ""
+
 def convert_chatroom_to_dict(chatroom):
     return {
         "id": chatroom.id,
@@ -56,10 +130,51 @@ def convert_chatroom_to_dict(chatroom):
         "modified": chatroom.modified,
         "initiator": chatroom.initiator,
         "closed": chatroom.closed,
-        "events": len(chatroom.events),
+        "events": chatroom.last_seq(),
         "poll_requests": chatroom.poll_requests
     }
 
+def convert_chatroom_to_row(chatroom):
+    # Same as convert_chatroom_to_dict() with the dates already converted to the local time
+    # so that the admin page does not parse them again for each cell.
+    row = convert_chatroom_to_dict(chatroom)
+    row["created_local"] = epoch_to_local(chatroom.created_at)
+    row["modified_local"] = epoch_to_local(chatroom.modified_at)
+    if len(chatroom.users) > 0:
+        row["polls"] = [(f"U{u + 1}" if len(chatroom.users) == 2 else None, user_id,
+                         epoch_to_local(chatroom.poll_requests[user_id].last), chatroom.poll_requests[user_id].count)
+                        for u, user_id in enumerate(chatroom.users)]
+    else:
+        row["polls"] = [(str_user, user_info['user_id'], utc_to_local(user_info['last_poll']), user_info['poll_num'])
+                        for str_user, user_info in chatroom.leaved_users.items()]
+    return row
+
+def convert_chatroom_to_admin_dict(chatroom):
+    # JSON representation of a chatroom for the admin API.
+    return {
+        "id": chatroom.id,
+        "experimentId": chatroom.experiment_id,
+        "users": list(chatroom.users),
+        "leavedUsers": dict(chatroom.leaved_users),
+        "created": chatroom.created,
+        "modified": chatroom.modified,
+        "closed": chatroom.closed,
+        "events": chatroom.last_seq(),
+        "polls": {user_id: {"last": poll_stats.last_isoformat(), "count": poll_stats.count}
+                  for user_id, poll_stats in chatroom.poll_requests.items()}
+    }
+
+def chatroom_has_user(chatroom, user_prefix):
+    # True if a user id of the chatroom (or of a user who left it) starts with the prefix,
+    # for instance a session id.
+    return any(user_id.startswith(user_prefix) for user_id in chatroom.users) or \
+        any(user_info['user_id'].startswith(user_prefix) for user_info in chatroom.leaved_users.values())
+
+def estimate_chatroom_size(chatroom):
+    # Rough estimate of the memory used by a chatroom in bytes: a fixed overhead for
+    # the chatroom and for each event plus the length of the bodies.
+    return 2048 + sum(256 + len(evt.get('body') or '') for evt in chatroom.events)
+
 
 class BaseUser(object):
 
@@ -80,13 +195,77 @@ class BaseUser(object):
         # In this default implementation, any user is considered ok to chat with.
         return True
 
+    def matching_key(self):
+        # This can be overridden by the superclass.
+        # Users are only matched with users having the same key, so the key should be a hashable
+        # value that partitions the users into groups that can never be matched together
+        # (for instance, a language or a topic).  has_matching_attribs() is still checked afterwards.
+        # In this default implementation, all the users are in the same group.
+        return None
+
+
+class PollStats(object):
+    # Compact record of the poll requests of a user.
+    # Instead of keeping all the poll timestamps, only the last one (as an epoch timestamp) and
+    # the number of polls are kept.  Optionally, the most recent polls are kept in a fixed-size buffer.
+
+    def __init__(self, timestamp=None, history_size=0):
+        self.count = 0
+        self.last = None
+        self.recent = deque(maxlen=history_size) if history_size > 0 else None
+        if timestamp is not None:
+            self.record(timestamp)
+
+    def record(self, timestamp):
+        self.count += 1
+        self.last = timestamp
+        if self.recent is not None:
+            self.recent.append(timestamp)
+
+    def last_isoformat(self):
+        return epoch_to_utc(self.last) if self.last is not None else None
+
+    # The following methods allow to use a PollStats object like the list of ISO timestamps
+    # that was used before, for instance with poll_requests[user_id][-1] and poll_requests[user_id]|length.
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index == -1 and self.last is not None:
+            return self.last_isoformat()
+        if self.recent is not None:
+            return epoch_to_utc(self.recent[index])
+        raise IndexError("Only the last poll is kept.")
+
 
 class BaseChatroom(object):
 
+    # Number of recent poll timestamps kept for each user in addition to the last one.
+    poll_history_size = 0
+
     def __init__(self, id_=None, experiment_id=None, initiator=None, attribs=dict()):
         self.id = id_
-        self.created = datetime.utcnow().isoformat()
-        self.modified = self.created
+        # This condition is used as the lock of the chatroom.  It is notified each time
+        # the chatroom changes so that the parked poll requests can be woken up immediately.
+        # The underlying lock is reentrant so that the methods below can be called
+        # whether or not the caller already holds it.
+        self.lock = threading.Condition()
+        # Callbacks invoked when the chatroom changes.  They are used to wake up
+        # the poll requests that are waiting in an event loop instead of a thread.
+        self.listeners = set()
+        # Events already encoded in JSON from the point of view of each user of the chatroom
+        # (see events_for_user()).  They are appended by add_event() so that the responses
+        # only have to join them instead of converting all the events for each poll.
+        self.serialized_events = {}
+        # Monotonic time of the last change notified to the parked polls (see notify_change()).
+        self.changed_at = None
+        # The times are kept as epoch timestamps and only converted to ISO strings when they are
+        # serialized (see the created and modified properties).
+        self.created_at = time.time()
+        self.modified_at = self.created_at
+        # Incremented each time the chatroom changes.  The clients send it back when they poll
+        # so that has_changed() compares integers instead of timestamps.
+        self.version = 0
         self.events = []
         self.users = []
         self.leaved_users = {}
@@ -94,6 +273,9 @@ class BaseChatroom(object):
         self.initiator = initiator
         self.closed = False
         self.poll_requests = {}
+        # Id of the last batch of events posted by each user (see BaseApi.post_events())
+        # so that a batch sent again by a client is only added once.
+        self.posted_batches = {}
         if initiator is not None:
             self.add_user(initiator)
         self.attribs = attribs
@@ -104,58 +286,536 @@ class BaseChatroom(object):
     def __eq__(self, other):
         return self.__class__ == other.__class__ and self.id == other.id
 
+    @property
+    def created(self):
+        # ISO representation in the same format as datetime.utcnow().isoformat().
+        return epoch_to_utc(self.created_at)
+
+    @property
+    def modified(self):
+        return epoch_to_utc(self.modified_at)
+
+    def __getstate__(self):
+        # The lock, the listeners, the encoded events and the time of the last change belong to the process and are not pickled.
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['listeners']
+        del state['serialized_events']
+        del state['changed_at']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Condition()
+        self.listeners = set()
+        self.serialized_events = {}
+        self.changed_at = None
+
+    def update_state(self, state):
+        # Replaces the state of the chatroom with a state returned by __getstate__(),
+        # for instance when it has been modified by another process.
+        # The lock must be held by the caller.  The events are only appended so the encoded events are kept.
+        self.__dict__.update(state)
+        for user in list(self.serialized_events):
+            if user not in self.users:
+                del self.serialized_events[user]
+                continue
+            serialized_events = self.serialized_events[user]
+            serialized_events.extend(dumps_json(events_for_user(evt, user)) for evt in self.events[len(serialized_events):])
+
     def add_event(self, event):
-        timestamp = datetime.utcnow()
-        self.events.append(event)
-        self.modified = timestamp.isoformat()
-        # print(f"add_event modified={self.modified}")
-        if 'from' in event:
-            self.poll_requests[event['from']].append(self.modified)
+        self.add_events([event])
+
+    def add_events(self, events):
+        # Adds several events at once: the chatroom changes (and its poll requests are woken up) only once.
+        with self.lock:
+            for event in events:
+                # The sequence number of an event is its position (starting at 1) in the events list
+                # so that the events that a client has not received yet can be retrieved directly.
+                event['seq'] = len(self.events) + 1
+                self.events.append(event)
+                for user, serialized_events in self.serialized_events.items():
+                    serialized_events.append(dumps_json(events_for_user(event, user)))
+            self.touch()
+            for user in set(event['from'] for event in events if 'from' in event):
+                self.poll_requests[user].record(self.modified_at)
+            self.notify_change()
 
     def add_user(self, user):
-        timestamp = datetime.utcnow()
-        self.modified = timestamp.isoformat()
-        self.users.append(user)
-        if len(self.users) == 2:
-            self.closed = True
-        self.poll_requests[user] = [self.modified]
+        with self.lock:
+            self.touch()
+            self.users.append(user)
+            if len(self.users) == 2:
+                self.closed = True
+            self.poll_requests[user] = PollStats(self.modified_at, self.poll_history_size)
+            self.notify_change()
 
     def remove_user(self, user):
-        if user in self.users:
+        with self.lock:
+            if user not in self.users:
+                return
             if len(self.leaved_users) == 0:
                 str_user = f"U{self.users.index(user) + 1}"
             else:
                 str_user = 'U2' if 'U1' in self.leaved_users else 'U1'
             self.leaved_users[str_user] = {
                 'user_id': user,
-                'last_poll': self.poll_requests[user][-1],
-                'poll_num': len(self.poll_requests[user])
+                'last_poll': self.poll_requests[user].last_isoformat(),
+                'poll_num': self.poll_requests[user].count
             }
 
             self.users.remove(user)
-            self.modified = datetime.utcnow().isoformat()
+            self.touch()
             if user in self.poll_requests:
                 del self.poll_requests[user]
+            self.serialized_events.pop(user, None)
+            self.posted_batches.pop(user, None)
+            self.notify_change()
+
+    def touch(self):
+        # Records a change of the chatroom.  The lock must be held by the caller.
+        self.modified_at = time.time()
+        self.version += 1
+
+    def notify_change(self):
+        # Wake up all the poll requests waiting for this chatroom.
+        # The lock must be held by the caller.
+        self.changed_at = time.monotonic()
+        self.lock.notify_all()
+        for listener in list(self.listeners):
+            listener()
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.add(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+
+    def wait_for_change(self, timeout):
+        # Park the caller until the chatroom changes or until the timeout expires.
+        # The lock must be held by the caller.  It is released while waiting.
+        return self.lock.wait(timeout)
+
+    def has_changed(self, version):
+        # version is the version of the chatroom known by the client.
+        # The ISO modification time (the modified property) is also accepted for the clients that send it instead.
+        if isinstance(version, str):
+            return self.modified > version
+        return self.version > version
+
+    def last_seq(self):
+        return len(self.events)
+
+    def events_since(self, seq):
+        # Returns the events having a sequence number greater than seq.
+        if not seq:
+            return self.events
+        return self.events[seq:]
+
+    def serialized_events_since(self, user, seq):
+        # Same as events_since() but the events are encoded in JSON for the given user.
+        # The encoded events are cached only for the users of the chatroom.
+        with self.lock:
+            serialized_events = self.serialized_events.get(user)
+            if serialized_events is None:
+                serialized_events = [dumps_json(events_for_user(evt, user)) for evt in self.events]
+                if user in self.users:
+                    self.serialized_events[user] = serialized_events
+            return serialized_events[seq or 0:]
+
+    def has_polled(self, user, timestamp=None):
+        # The timestamp is an epoch timestamp.
+        self.poll_requests[user].record(timestamp if timestamp is not None else time.time())
+
+
+class ChatroomRegistry(object):
+    # Dictionary of chatrooms organized by chatroom ids and split into shards.
+    # Each shard has its own lock so that the requests on different chatrooms
+    # do not contend for a single lock.
+
+    def __init__(self, shard_count=16):
+        self.shards = [{} for s in range(shard_count)]
+        self.locks = [threading.Lock() for s in range(shard_count)]
+
+    def _shard_index(self, chatroom_id):
+        return hash(chatroom_id) % len(self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, chatroom_id):
+        return chatroom_id in self.shards[self._shard_index(chatroom_id)]
+
+    def __getitem__(self, chatroom_id):
+        return self.shards[self._shard_index(chatroom_id)][chatroom_id]
+
+    def get(self, chatroom_id, default=None):
+        return self.shards[self._shard_index(chatroom_id)].get(chatroom_id, default)
+
+    def add(self, chatroom):
+        index = self._shard_index(chatroom.id)
+        with self.locks[index]:
+            self.shards[index][chatroom.id] = chatroom
+
+    def pop(self, chatroom_id, default=None):
+        index = self._shard_index(chatroom_id)
+        with self.locks[index]:
+            return self.shards[index].pop(chatroom_id, default)
+
+    def values(self):
+        # Returns a snapshot of the chatrooms.
+        chatrooms = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                chatrooms.extend(shard.values())
+        return chatrooms
+
+
+class TimeIndex(object):
+    # Chatroom ids sorted by a timestamp (the creation or the modification time of the chatrooms)
+    # so that the admin pages can list the chatrooms page by page without sorting all of them.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Sorted (timestamp, chatroom_id) pairs.
+        self.keys = []
+        self.timestamps = {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __contains__(self, chatroom_id):
+        return chatroom_id in self.timestamps
+
+    def update(self, chatroom_id, timestamp):
+        with self.lock:
+            previous = self.timestamps.get(chatroom_id)
+            if previous == timestamp:
+                return
+            if previous is not None:
+                del self.keys[bisect.bisect_left(self.keys, (previous, chatroom_id))]
+            bisect.insort(self.keys, (timestamp, chatroom_id))
+            self.timestamps[chatroom_id] = timestamp
+
+    def remove(self, chatroom_id):
+        with self.lock:
+            timestamp = self.timestamps.pop(chatroom_id, None)
+            if timestamp is not None:
+                del self.keys[bisect.bisect_left(self.keys, (timestamp, chatroom_id))]
+
+    def chatroom_ids(self):
+        with self.lock:
+            return list(self.timestamps)
+
+    def iterate(self, since=None, until=None, reverse=True, chunk_size=100):
+        # Yields the ids of the chatrooms whose timestamp is between since and until (included),
+        # the most recent ones first when reverse is True.  The lock is only held while a chunk is read
+        # so the index can change meanwhile.
+        last_key = None
+        while True:
+            with self.lock:
+                start = 0 if since is None else bisect.bisect_left(self.keys, (since,))
+                end = len(self.keys) if until is None else bisect.bisect_left(self.keys, (until, chr(0x10ffff)))
+                if reverse:
+                    if last_key is not None:
+                        end = min(end, bisect.bisect_left(self.keys, last_key))
+                    chunk = self.keys[max(start, end - chunk_size):end][::-1]
+                else:
+                    if last_key is not None:
+                        start = max(start, bisect.bisect_right(self.keys, last_key))
+                    chunk = self.keys[start:min(end, start + chunk_size)]
+            if len(chunk) == 0:
+                return
+            for timestamp, chatroom_id in chunk:
+                yield chatroom_id
+            last_key = chunk[-1]
+
+
+class ChatroomSummary(object):
+    # Compact record of a released chatroom that is no longer kept in memory.
+    # It has the same attributes as a chatroom except for the events, whose count is kept instead.
+    # The full dialog can still be read from the archive (see BaseApi.get_released_dialog()).
+
+    closed = True
+
+    def __init__(self, chatroom):
+        self.id = chatroom.id
+        self.experiment_id = chatroom.experiment_id
+        self.initiator = chatroom.initiator
+        self.created_at = chatroom.created_at
+        self.modified_at = chatroom.modified_at
+        self.leaved_users = chatroom.leaved_users
+        self.attribs = chatroom.attribs
+        self.event_count = chatroom.last_seq()
+        self.users = []
+        self.poll_requests = {}
+
+    @property
+    def created(self):
+        return epoch_to_utc(self.created_at)
+
+    @property
+    def modified(self):
+        return epoch_to_utc(self.modified_at)
+
+    def last_seq(self):
+        return self.event_count
+
+
+class ReleasedChatrooms(object):
+    # Bounded registry of the released chatrooms with the same interface as ChatroomRegistry.
+    # The most recently used chatrooms are kept in full.  When there are more than max_count of them,
+    # when they use more than max_bytes (see estimate_chatroom_size()) or when they have been released
+    # for more than max_age seconds, the least recently used ones collapse into a ChatroomSummary.
+    # At most max_summaries summaries are kept, the oldest ones are forgotten.
+    # A limit set to None is not enforced.
+
+    def __init__(self, max_count=1000, max_bytes=None, max_age=None, max_summaries=100000):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_summaries = max_summaries
+        self.lock = threading.Lock()
+        # chatroom_id -> (chatroom, release time, estimated size) from the least to the most recently used.
+        self.chatrooms = OrderedDict()
+        self.summaries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return len(self.chatrooms) + len(self.summaries)
+
+    def __contains__(self, chatroom_id):
+        return chatroom_id in self.chatrooms or chatroom_id in self.summaries
+
+    def __getitem__(self, chatroom_id):
+        chatroom = self.get(chatroom_id)
+        if chatroom is None:
+            raise KeyError(chatroom_id)
+        return chatroom
+
+    def get(self, chatroom_id, default=None):
+        # Returns the chatroom, its summary if it has been evicted or default.
+        with self.lock:
+            entry = self.chatrooms.get(chatroom_id)
+            if entry is not None:
+                self.chatrooms.move_to_end(chatroom_id)
+                return entry[0]
+            return self.summaries.get(chatroom_id, default)
+
+    def add(self, chatroom):
+        size = estimate_chatroom_size(chatroom)
+        with self.lock:
+            self.summaries.pop(chatroom.id, None)
+            previous = self.chatrooms.pop(chatroom.id, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.chatrooms[chatroom.id] = (chatroom, time.monotonic(), size)
+            self.size += size
+            self._evict(time.monotonic())
+
+    def pop(self, chatroom_id, default=None):
+        with self.lock:
+            entry = self.chatrooms.pop(chatroom_id, None)
+            if entry is not None:
+                self.size -= entry[2]
+                return entry[0]
+            return self.summaries.pop(chatroom_id, default)
+
+    def values(self):
+        # Returns a snapshot of the summaries followed by the chatrooms kept in full.
+        with self.lock:
+            self._evict(time.monotonic())
+            return list(self.summaries.values()) + [entry[0] for entry in self.chatrooms.values()]
+
+    def _evict(self, now):
+        # The lock must be held by the caller.
+        while len(self.chatrooms) > 0:
+            chatroom, released, size = next(iter(self.chatrooms.values()))
+            if not ((self.max_count is not None and len(self.chatrooms) > self.max_count) or
+                    (self.max_bytes is not None and self.size > self.max_bytes) or
+                    (self.max_age is not None and now - released > self.max_age)):
+                break
+            self.chatrooms.popitem(last=False)
+            self.size -= size
+            self.summaries[chatroom.id] = ChatroomSummary(chatroom)
+        if self.max_summaries is not None:
+            while len(self.summaries) > self.max_summaries:
+                self.summaries.popitem(last=False)
+
+
+class WaitingRooms(object):
+    # Index of the chatrooms that have a single user waiting for a partner.
+    # The chatrooms are grouped by the matching key of their initiator and kept in
+    # the order they were created so that the oldest one is found first.
+
+    def __init__(self):
+        self.buckets = {}
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, chatroom_id):
+        return chatroom_id in self.keys
+
+    def add(self, chatroom, key=None):
+        self.buckets.setdefault(key, OrderedDict())[chatroom.id] = chatroom
+        self.keys[chatroom.id] = key
+
+    def remove(self, chatroom_id):
+        if chatroom_id not in self.keys:
+            return
+        key = self.keys.pop(chatroom_id)
+        bucket = self.buckets[key]
+        bucket.pop(chatroom_id, None)
+        if len(bucket) == 0:
+            del self.buckets[key]
+
+    def find(self, user):
+        # Returns the oldest chatroom whose user can be matched with the given user or None.
+        bucket = self.buckets.get(user.matching_key())
+        if bucket is None:
+            return None
+        for chatroom in bucket.values():
+            if len(chatroom.users) == 1 and not chatroom.closed and \
+                    user.id not in chatroom.users and user.has_matching_attribs(chatroom.users[0]):
+                return chatroom
+        return None
+
+
+class SessionIndex(object):
+    # Index of the active users organized by session ids.
+    # For each session, it keeps the user ids (one per tab) and the chatrooms they are in.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def __len__(self):
+        return len(self.sessions)
 
-    def has_changed(self, timestamp):
-        return self.modified > timestamp
+    def __contains__(self, session_id):
+        return session_id in self.sessions
 
-    def has_polled(self, user, timestamp):
-        self.poll_requests[user].append(timestamp)
+    def add(self, user_id, chatroom_id):
+        with self.lock:
+            tabs = self.sessions.setdefault(get_session_id(user_id), {})
+            tabs.setdefault(user_id, set()).add(chatroom_id)
+
+    def remove(self, user_id, chatroom_id):
+        with self.lock:
+            session_id = get_session_id(user_id)
+            tabs = self.sessions.get(session_id)
+            if tabs is None or user_id not in tabs:
+                return
+            tabs[user_id].discard(chatroom_id)
+            if len(tabs[user_id]) == 0:
+                del tabs[user_id]
+            if len(tabs) == 0:
+                del self.sessions[session_id]
+
+    def tabs(self, session_id):
+        with self.lock:
+            return {user_id: sorted(chatroom_ids) for user_id, chatroom_ids in self.sessions.get(session_id, {}).items()}
+
+    def to_dict(self):
+        with self.lock:
+            return {session_id: {user_id: sorted(chatroom_ids) for user_id, chatroom_ids in tabs.items()}
+                    for session_id, tabs in self.sessions.items()}
+
+    def page(self, offset, limit):
+        # Same as to_dict() for limit sessions only, in the order they started.
+        with self.lock:
+            return {session_id: {user_id: sorted(chatroom_ids) for user_id, chatroom_ids in tabs.items()}
+                    for session_id, tabs in itertools.islice(self.sessions.items(), offset, offset + limit)}
+
+
+class InactivityIndex(object):
+    # Min-heap of the deadlines after which the users will be considered inactive.
+    # The deadlines are not updated on each poll: when a deadline expires, the cleaner checks
+    # the actual last poll of the user and reschedules him if he has polled meanwhile.
+    # This way, the cleaner only visits the users whose deadline has expired.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deadlines = []
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, user_id, chatroom_id, deadline):
+        with self.lock:
+            heapq.heappush(self.deadlines, (deadline, user_id, chatroom_id))
+
+    def pop_expired(self, now):
+        # Returns the (user_id, chatroom_id) pairs whose deadline has expired.
+        expired = []
+        with self.lock:
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                deadline, user_id, chatroom_id = heapq.heappop(self.deadlines)
+                expired.append((user_id, chatroom_id))
+        return expired
+
+
+class StateStore(object):
+    # Storage of the state shared by the requests: the chatrooms, the waiting rooms and the sessions.
+    # The default MemoryStateStore keeps them in the memory of the process.  RedisStateStore
+    # (see server/redis_store.py) shares them between several processes.
+    #
+    # A store provides the following attributes:
+    # - chatrooms and released_chatrooms: the registries of the chatrooms (see ChatroomRegistry),
+    # - waiting_rooms: the chatrooms waiting for a partner (see WaitingRooms),
+    # - session_index: the active users organized by session ids (see SessionIndex),
+    # - pairing_lock: the lock protecting the waiting rooms while the users are paired.
+
+    # True when the state is shared with other processes.
+    shared = False
+
+    def lock(self, chatroom):
+        # Returns the lock protecting the chatroom.  It behaves like a threading.Condition:
+        # wait() releases it until the chatroom changes or until the timeout expires.
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+
+    def __init__(self, cfg, logger):
+        shard_count = cfg.get('chatroom_shards', 16)
+        self.chatrooms = ChatroomRegistry(shard_count)
+        self.released_chatrooms = ReleasedChatrooms(
+            max_count=cfg.get('released_chatrooms_max_count', 1000),
+            max_bytes=cfg.get('released_chatrooms_max_bytes', None),
+            max_age=cfg.get('released_chatrooms_max_age', None),
+            max_summaries=cfg.get('released_chatrooms_max_summaries', 100000))
+        self.waiting_rooms = WaitingRooms()
+        self.session_index = SessionIndex()
+        self.pairing_lock = threading.Lock()
+
+    def lock(self, chatroom):
+        return chatroom.lock
 
 
 class ChatroomCleaner(threading.Thread):
 
     def __init__(self, server, logger, check_interval=30):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.server = server
         self.logger = logger
         self.check_interval = check_interval
+        self.stopped = threading.Event()
 
     def run(self):
-        while True:
+        while not self.stopped.is_set():
             try:
-                time.sleep(self.check_interval)
+                if self.stopped.wait(self.check_interval):
+                    break
                 self.server.clean_inactive_users()
             except:
                 (typ, val, tb) = sys.exc_info()
@@ -164,6 +824,9 @@ class ChatroomCleaner(threading.Thread):
                     error_msg += line + "\n"
                 self.logger.debug(error_msg)
 
+    def stop(self):
+        self.stopped.set()
+
 
 class BaseApi:
 
@@ -173,64 +836,184 @@ class BaseApi:
         self.user_class = user_class
         self.chatroom_class = chatroom_class
 
-        self.mutex = threading.Lock()
+        # The debug messages of the requests are only built when DEBUG is enabled,
+        # and then only for one request out of debug_log_sampling.
+        self.request_logger = RequestLogger(logger, self.cfg.get('debug_log_sampling', 1))
+        # With log_queue, the log records are written by background threads.
+        self.queue_logging = QueueLogging(logger) if self.cfg.get('log_queue', 'False') == 'True' else None
+
+        # The shared state is kept in the store.
+        self.store = self._create_state_store()
+
+        # This lock serializes the pairing of the users in join().
+        # It protects the waiting rooms and the check of the multiple tabs.
+        # It is always acquired before the lock of a chatroom, never after.
+        self.mutex = self.store.pairing_lock
 
         self.users = {}
 
-        # Dictionaries organized by chatroom ids.
-        self.chatrooms = {}
-        self.chatroom_locks = {}
-        self.released_chatrooms = {}
+        # Registries organized by chatroom ids.
+        # A chatroom is added to chatrooms when it is created and moved to
+        # released_chatrooms when its last user leaves.  Each chatroom is protected by
+        # its own lock (see StateStore.lock()).
+        self.chatrooms = self.store.chatrooms
+        self.released_chatrooms = self.store.released_chatrooms
+
+        # Chatrooms waiting for a partner.
+        self.waiting_rooms = self.store.waiting_rooms
+
+        # Active users organized by session ids.
+        self.session_index = self.store.session_index
+
+        # Deadlines after which the active users will be considered inactive.
+        self.inactivity_index = InactivityIndex()
+
+        # Latencies and counters exported by the /metrics route.
+        self.metrics = ServerMetrics(self)
+
+        # Indexes of the active and released chatrooms by creation and modification times (see get_chatroom_page()).
+        self.chatroom_indexes = {status: {'created': TimeIndex(), 'modified': TimeIndex()} for status in ('active', 'released')}
+
+        # The dialogs are archived in the background.
+        self.archive_backend = self._create_archive_backend()
+        self.archiver = DialogArchiver(self._write_dialogs, self.logger,
+                                       queue_size=self.cfg.get('archive_queue_size', 1000),
+                                       batch_size=self.cfg.get('archive_batch_size', 50))
+        self.archiver.start()
+
+        # With the journal parameter, the changes of the chatrooms are written in a journal
+        # so that the active chatrooms are recovered when the server restarts.
+        # The released chatrooms whose dialog has not been archived yet are kept by id until it is.
+        self.unarchived_chatrooms = {}
+        self.journal = self._create_journal()
+        if self.journal is not None:
+            self._recover_journal()
 
         self.chatroom_cleaner = ChatroomCleaner(self, self.logger,
                                                 check_interval=self.cfg['chatroom_cleaning_interval'])
         self.chatroom_cleaner.start()
 
+        # Make sure that the pending dialogs are archived when the server stops.
+        atexit.register(self.shutdown)
+
     def version(self):
         return "1.0"
 
+    def shutdown(self):
+        if self.chatroom_cleaner.is_alive():
+            self.chatroom_cleaner.stop()
+            self.chatroom_cleaner.join()
+        self.archiver.close()
+        if self.journal is not None and not self.journal.closed:
+            # The next start only has to load the snapshot.
+            self.journal.snapshot()
+            self.journal.close()
+        self.archive_backend.close()
+        self.store.close()
+        if self.queue_logging is not None:
+            self.queue_logging.stop()
+            self.queue_logging = None
+
+    def get_archive_stats(self):
+        return self.archiver.stats()
+
     def get_chatrooms(self):
         return {
-            "chatrooms": list(self.chatrooms.values()),
-            "released_chatrooms": list(self.released_chatrooms.values())
+            "chatrooms": self.chatrooms.values(),
+            "released_chatrooms": self.released_chatrooms.values(),
+            "sessions": self.session_index.to_dict(),
+            "archive": self.get_archive_stats()
         }
 
+    def get_chatroom_page(self, status='active', order='modified', offset=0, limit=100, user=None, since=None, until=None, reverse=True):
+        # Returns a page of the active or released chatrooms sorted by creation or modification time,
+        # the most recent ones first unless reverse is False.
+        # The chatrooms can be filtered by user id prefix (for instance a session id) and by time range
+        # (since and until are epoch timestamps).
+        if status not in self.chatroom_indexes:
+            raise ValueError(f"Unknown status: {status}.")
+        if order not in ('created', 'modified'):
+            raise ValueError(f"Unknown order: {order}.")
+        registry = self.chatrooms if status == 'active' else self.released_chatrooms
+        chatrooms = []
+        skipped = 0
+        more = False
+        for chatroom_id in self._get_chatroom_index(status, order).iterate(since, until, reverse):
+            chatroom = registry.get(chatroom_id)
+            if chatroom is None or (user is not None and not chatroom_has_user(chatroom, user)):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(chatrooms) == limit:
+                more = True
+                break
+            chatrooms.append(chatroom)
+        return {
+            "total": len(registry),
+            "offset": offset,
+            "limit": limit,
+            "more": more,
+            "chatrooms": chatrooms
+        }
+
+    def get_released_dialog(self, chatroom_id):
+        # Returns the record of a released chatroom (see chatroom_to_record()) or None.
+        # When the chatroom has been evicted from the memory, it is read back from the archive,
+        # which is only possible with an archive format that supports it (see ArchiveBackend.read()).
+        chatroom = self.released_chatrooms.get(chatroom_id)
+        if chatroom is None:
+            return None
+        if isinstance(chatroom, ChatroomSummary):
+            return self.archive_backend.read(chatroom_id)
+        return chatroom_to_record(chatroom)
+
     def join(self, user_id, attribs=dict()):
-        self.logger.debug(f"join user={user_id} attribs={attribs}")
-        self.mutex.acquire()
+        trace = self.request_logger.sample()
+        if trace:
+            self.request_logger.debug("join", user=user_id, attribs=attribs)
+        start = time.perf_counter()
         try:
             user = self.user_class(user_id, attribs)
             self.users[user_id] = user
 
-            if 'prevent_multiple_tabs' in self.cfg and self.cfg['prevent_multiple_tabs'] == 'True':
-                all_users = flatten([chatroom.users for chatroom in self.chatrooms.values()])
-                all_sessions = set([get_session_id(user_id) for user_id in all_users])
-                if get_session_id(user_id) in all_sessions:
-                    return f"Error: MultipleTabAccessForbidden for user: {user_id}."
-
-            # Try to find an available partner.
-            # If none is found, assign the user to a new chatroom.
-            available_chatrooms = [self.chatrooms[id_] for id_ in self.chatrooms if
-                                    len(self.chatrooms[id_].users) == 1 and
-                                    not self.chatrooms[id_].closed and
-                                    user_id not in self.chatrooms[id_].users and
-                                    user.has_matching_attribs(self.chatrooms[id_].users[0])]
-
-            if len(available_chatrooms) > 0:
-                chatroom = sorted(available_chatrooms, key=lambda x: x.created, reverse=False)[0]
-                if chatroom.id in self.chatroom_locks:
-                    self.chatroom_locks[chatroom.id].acquire()
-                    try:
-                        chatroom.add_user(user_id)
-                    finally:
-                        self.chatroom_locks[chatroom.id].release()
-            else:
-                experiment_id = self.cfg['experiment_id']
-                chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=experiment_id, initiator=user_id)
-                self.chatrooms[chatroom.id] = chatroom
-                self.chatroom_locks[chatroom.id] = threading.Lock()
-
-            self.logger.debug(f"User {user_id} is assigned to chatroom {chatroom.id}.")
+            self.mutex.acquire()
+            try:
+                if 'prevent_multiple_tabs' in self.cfg and self.cfg['prevent_multiple_tabs'] == 'True':
+                    if get_session_id(user_id) in self.session_index:
+                        return f"Error: MultipleTabAccessForbidden for user: {user_id}."
+
+                # Try to find an available partner.
+                # If none is found, assign the user to a new chatroom.
+                chatroom = self.waiting_rooms.find(user)
+                while chatroom is not None and not self._add_partner(chatroom, user_id):
+                    # The chatroom has been released since it was found.
+                    self.waiting_rooms.remove(chatroom.id)
+                    chatroom = self.waiting_rooms.find(user)
+                if chatroom is not None:
+                    if chatroom.closed:
+                        self.waiting_rooms.remove(chatroom.id)
+                else:
+                    experiment_id = self.cfg['experiment_id']
+                    chatroom = self.chatroom_class(id_=str(uuid.uuid4()), experiment_id=experiment_id, initiator=user_id)
+                    # The chatroom is journaled once it is registered so that a snapshot either includes it
+                    # or follows its creation record (see _snapshot_journal()).
+                    with self.store.lock(chatroom):
+                        self.chatrooms.add(chatroom)
+                        self._journal('create', chatroom.id, chatroom, attribs)
+                    self._index_new_chatroom(chatroom)
+                    self.waiting_rooms.add(chatroom, user.matching_key())
+
+                if user_id in chatroom.users:
+                    self.session_index.add(user_id, chatroom.id)
+            finally:
+                self.mutex.release()
+            self._commit_journal()
+
+            self.inactivity_index.add(user_id, chatroom.id, time.time() + self._get_inactivity_timeout())
+
+            if trace:
+                self.request_logger.debug("assigned", user=user_id, chatroom=chatroom.id)
 
             data = self._get_chatroom_data(chatroom.id)
             return data
@@ -238,55 +1021,127 @@ class BaseApi:
             self.logger.info('data is None!')
             return None
         finally:
-            self.mutex.release()
+            self.metrics.join.observe(time.perf_counter() - start)
 
     def get_chatroom(self, chatroom_id, user_id, client_timestamp):
-        self.logger.debug(f"get_chatroom chatroom={chatroom_id} user={user_id} client_timestamp={client_timestamp}")
+        trace = self.request_logger.sample()
+        if trace:
+            self.request_logger.debug("get_chatroom", chatroom=chatroom_id, user=user_id, client_timestamp=client_timestamp)
 
-        request_time = datetime.utcnow()
-        while True:
+        request_time = time.time()
+        # Make sure that the function terminates after a certain delay.
+        # Otherwise, the poll requests will accumulate and make the web server crash.
+        deadline = time.monotonic() + self.cfg['poll_interval']
 
-            if chatroom_id in self.chatroom_locks:
-                chatroom_lock = self.chatroom_locks[chatroom_id]
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
+            return None
 
-                chatroom_lock.acquire()
-                try:
-                    if chatroom_id not in self.chatrooms:
-                        return None
-                    chatroom = self.chatrooms[chatroom_id]
-                    if user_id not in chatroom.users:
-                        return None
-                    chatroom.has_polled(user_id, request_time.isoformat())
-                    chatroom_has_changed = not client_timestamp or chatroom.has_changed(client_timestamp)
-                    self.logger.debug(f"user {user_id} checks if the chatroom has changed={chatroom_has_changed} "
-                                      f"modified={chatroom.modified} vs client_timestamp={client_timestamp}")
-                    if chatroom_has_changed:
-                        data = self._get_chatroom_data(chatroom_id)
-                        return data
+        parked_since = None
+        chatroom_lock = self.store.lock(chatroom)
+        chatroom_lock.acquire()
+        try:
+            # The chatroom is released while its lock is held so it must be checked again.
+            if chatroom_id not in self.chatrooms:
+                return None
+            if user_id not in chatroom.users:
+                return None
+            chatroom.has_polled(user_id, request_time)
+            while True:
+                chatroom_has_changed = client_timestamp is None or chatroom.has_changed(client_timestamp)
+                if trace:
+                    self.request_logger.debug("check_chatroom", user=user_id, changed=chatroom_has_changed,
+                                              modified=chatroom.modified, client_timestamp=client_timestamp)
+                if chatroom_has_changed:
+                    self._record_poll('changed', parked_since, chatroom)
+                    data = self._get_chatroom_data(chatroom_id)
+                    return data
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._record_poll('expired', parked_since)
+                    return "expired"
+
+                # The chatroom lock is released while the poll is parked.
+                # It is notified as soon as the chatroom changes.
+                if parked_since is None:
+                    parked_since = time.monotonic()
+                chatroom_lock.wait(remaining)
+
+                # The chatroom might have been released or the user might have left while waiting.
+                if chatroom_id not in self.chatrooms or user_id not in chatroom.users:
+                    self._record_poll('gone', parked_since)
+                    return None
+        finally:
+            chatroom_lock.release()
 
-                finally:
-                    chatroom_lock.release()
+    async def get_chatroom_async(self, chatroom_id, user_id, client_timestamp):
+        # Same as get_chatroom() but the poll request is parked as a coroutine
+        # waiting for a change notification instead of blocking a thread.
+        if self.request_logger.sample():
+            self.request_logger.debug("get_chatroom_async", chatroom=chatroom_id, user=user_id, client_timestamp=client_timestamp)
+
+        loop = asyncio.get_running_loop()
+        request_time = time.time()
+        deadline = loop.time() + self.cfg['poll_interval']
+
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
+            return None
 
-            # Make sure that the function terminates after a certain delay.
-            # Otherwise, the poll requests will accumulate and make the web server crash.
-            waiting_period = (datetime.utcnow() - request_time).total_seconds()
-            if waiting_period >= (self.cfg['poll_interval']):
-                # self.logger.debug(f"Waiting period has expired: {waiting_period}")
-                return "expired"
+        changed = asyncio.Event()
 
-            time.sleep(1.0)
+        def listener():
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(changed.set)
+
+        with self.store.lock(chatroom):
+            if chatroom_id not in self.chatrooms:
+                return None
+            if user_id not in chatroom.users:
+                return None
+            chatroom.has_polled(user_id, request_time)
+            if client_timestamp is None or chatroom.has_changed(client_timestamp):
+                self._record_poll('changed', None)
+                return self._get_chatroom_data(chatroom_id)
+            chatroom.add_listener(listener)
+
+        parked_since = time.monotonic()
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self._record_poll('expired', parked_since)
+                    return "expired"
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                changed.clear()
+
+                with self.store.lock(chatroom):
+                    # The chatroom might have been released or the user might have left while waiting.
+                    if chatroom_id not in self.chatrooms or user_id not in chatroom.users:
+                        self._record_poll('gone', parked_since)
+                        return None
+                    if chatroom.has_changed(client_timestamp):
+                        self._record_poll('changed', parked_since, chatroom)
+                        return self._get_chatroom_data(chatroom_id)
+        finally:
+            chatroom.remove_listener(listener)
 
     def post_message(self, user_id, chatroom_id, message):
-        self.logger.debug(f"post_message user_id={user_id} chatroom_id={chatroom_id} message={message}")
-        if chatroom_id not in self.chatroom_locks:
+        if self.request_logger.sample():
+            self.request_logger.debug("post_message", user=user_id, chatroom=chatroom_id, message=message)
+        start = time.perf_counter()
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
             return
-
-        chatroom_lock = self.chatroom_locks[chatroom_id]
+        chatroom_lock = self.store.lock(chatroom)
         chatroom_lock.acquire()
         try:
             if chatroom_id not in self.chatrooms:
                 return
-            chatroom = self.chatrooms[chatroom_id]
             if user_id not in chatroom.users:
                 return
             evt = {
@@ -296,60 +1151,119 @@ class BaseApi:
                 'timestamp': datetime.utcnow().isoformat()
             }
             chatroom.add_event(evt)
+            self._journal('add_events', chatroom_id, [evt], chatroom.modified_at)
+            self._index_modified_chatroom(chatroom)
 
             data = self._get_chatroom_data(chatroom_id)
             return data
         finally:
             chatroom_lock.release()
-
-    def leave_chatroom(self, user_id, chatroom_id):
-        self.logger.debug(f"leave_chatroom user_id={user_id} chatroom_id={chatroom_id}")
-        self.mutex.acquire()
+            self._commit_journal()
+            self.metrics.post.observe(time.perf_counter() - start)
+
+    def post_events(self, user_id, chatroom_id, events, batch_id=None):
+        # Adds several events posted by a user under a single acquisition of the chatroom lock.
+        # events is a list of dictionaries with the type (see evt_type) and the body of each event.
+        # A client retrying a post whose response was lost sends the same batch_id again: the batch
+        # is then only acknowledged since it is the last one added for this user.
+        # Returns the sequence number of the last event and the version of the chatroom,
+        # or None when the chatroom or the user is gone.  The clients receive the events with their next poll.
+        if self.request_logger.sample():
+            self.request_logger.debug("post_events", user=user_id, chatroom=chatroom_id, count=len(events))
+        start = time.perf_counter()
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
+            return
+        chatroom_lock = self.store.lock(chatroom)
+        chatroom_lock.acquire()
         try:
-            data = self._leave_chatroom(user_id, chatroom_id)
-            return data
+            if chatroom_id not in self.chatrooms:
+                return
+            if user_id not in chatroom.users:
+                return
+            if batch_id is not None and chatroom.posted_batches.get(user_id) == batch_id:
+                return {'lastSeq': chatroom.last_seq(), 'version': chatroom.version}
+            timestamp = datetime.utcnow().isoformat()
+            events = [{
+                'type': event['type'],
+                'from': user_id,
+                'body': event['body'],
+                'timestamp': timestamp
+            } for event in events]
+            chatroom.add_events(events)
+            if batch_id is not None:
+                chatroom.posted_batches[user_id] = batch_id
+            self._journal('add_events', chatroom_id, events, chatroom.modified_at, batch_id)
+            self._index_modified_chatroom(chatroom)
+            return {'lastSeq': chatroom.last_seq(), 'version': chatroom.version}
         finally:
-            self.mutex.release()
+            chatroom_lock.release()
+            self._commit_journal()
+            self.metrics.post.observe(time.perf_counter() - start)
+
+    def leave_chatroom(self, user_id, chatroom_id):
+        if self.request_logger.sample():
+            self.request_logger.debug("leave_chatroom", user=user_id, chatroom=chatroom_id)
+        data = self._leave_chatroom(user_id, chatroom_id)
+        self._commit_journal()
+        return data
 
     def clean_inactive_users(self):
-        self.logger.debug("clean_inactive_users")
+        trace = self.request_logger.sample()
+        if trace:
+            self.request_logger.debug("clean_inactive_users")
         start = time.time()
-        self.mutex.acquire()
         try:
             inactive_users = []
-            now = datetime.utcnow()
-            for chatroom_id in self.chatrooms:
-                if chatroom_id in self.chatroom_locks:
-                    chatroom_lock = self.chatroom_locks[chatroom_id]
-                    chatroom_lock.acquire()
-                    try:
-                        chatroom = self.chatrooms[chatroom_id]
-                        for user_id in chatroom.users:
-                            if user_id in chatroom.poll_requests.keys():
-                                last_poll = datetime.fromisoformat(chatroom.poll_requests[user_id][-1])
-                                self.logger.debug(f"now={now} type={type(now)} last_poll={last_poll} type={type(last_poll)}")
-                                delta = now - last_poll
-
-                                # Fix to prevent this normalization issue that occurs when the now and last_poll values are very close to each other:
-                                # https://stackoverflow.com/questions/28677673/why-does-datetime-datetime-now-datetime-datetime-now-equal-to-datetime-tim
-                                delta_in_secs = delta.seconds if delta.days >= 0 else 0
-
-                                self.logger.debug(
-                                    f"Check user {user_id}... Last poll: {last_poll.isoformat()} Now: {now.isoformat()}"
-                                    " Delta(s): {delta_in_secs}"
-                                )
-                                # To play safe, I use a larger value than poll_interval
-                                if delta_in_secs > self.cfg['poll_interval'] * 3:
-                                    self.logger.debug(f"{user_id} has been inactive for too long. Let's kick him out of room {chatroom_id}")
-                                    inactive_users.append((user_id, chatroom_id))
-                    finally:
-                        chatroom_lock.release()
+            now = time.time()
+            timeout = self._get_inactivity_timeout()
+            # Only the users whose deadline has expired are checked.
+            for user_id, chatroom_id in self.inactivity_index.pop_expired(now):
+                chatroom = self.chatrooms.get(chatroom_id)
+                if chatroom is None:
+                    continue
+                chatroom_lock = self.store.lock(chatroom)
+                chatroom_lock.acquire()
+                try:
+                    if chatroom_id not in self.chatrooms or user_id not in chatroom.users or user_id not in chatroom.poll_requests:
+                        continue
+                    last_poll = chatroom.poll_requests[user_id].last
+                    delta_in_secs = max(now - last_poll, 0)
+
+                    if trace:
+                        self.request_logger.debug("check_user", user=user_id, last_poll=last_poll, now=now, delta=delta_in_secs)
+                    if delta_in_secs > timeout:
+                        if trace:
+                            self.request_logger.debug("inactive_user", user=user_id, chatroom=chatroom_id)
+                        inactive_users.append((user_id, chatroom_id))
+                    else:
+                        # The user has polled meanwhile.
+                        self.inactivity_index.add(user_id, chatroom_id, last_poll + timeout)
+                finally:
+                    chatroom_lock.release()
+
             for inactive_user in inactive_users:
                 user_id, chatroom_id = inactive_user
                 self._leave_chatroom(user_id, chatroom_id)
         finally:
-            self.mutex.release()
-            self.logger.debug(f"clean_inactive_users performed in {time.time() - start}")
+            duration = time.time() - start
+            self.metrics.cleaner_pause.observe(duration)
+            if trace:
+                self.request_logger.debug("clean_inactive_users_done", duration=duration)
+
+    def _record_poll(self, result, parked_since, chatroom=None):
+        # Records the result of a poll request and, if it has been parked, how long it waited.
+        # When it has been woken up by a change of the chatroom, the delay since the change is recorded too.
+        self.metrics.polls.labels(result).inc()
+        if parked_since is not None:
+            now = time.monotonic()
+            self.metrics.poll_park.observe(now - parked_since)
+            if chatroom is not None and chatroom.changed_at is not None and chatroom.changed_at >= parked_since:
+                self.metrics.poll_wakeup.observe(now - chatroom.changed_at)
+
+    def _get_inactivity_timeout(self):
+        # To play safe, I use a larger value than poll_interval
+        return self.cfg['poll_interval'] * 3
 
     def _get_chatroom_data(self, chatroom_id):
         chatroom = self.chatrooms[chatroom_id]
@@ -363,46 +1277,201 @@ class BaseApi:
         }
         return data
 
+    def _add_partner(self, chatroom, user_id):
+        # Adds the user to a waiting chatroom found by join().
+        # Returns False if the chatroom is no longer waiting for a partner.
+        with self.store.lock(chatroom):
+            if chatroom.id not in self.chatrooms or len(chatroom.users) != 1 or chatroom.closed:
+                return False
+            chatroom.add_user(user_id)
+            user = self.users.get(user_id)
+            self._journal('add_user', chatroom.id, user_id, user.attribs if user is not None else {}, chatroom.modified_at)
+            self._index_modified_chatroom(chatroom)
+            self.metrics.pairing_wait.observe(max(chatroom.modified_at - chatroom.created_at, 0))
+            return True
+
     def _leave_chatroom(self, user_id, chatroom_id):
-        if chatroom_id not in self.chatrooms:
-            return
-        chatroom = self.chatrooms[chatroom_id]
-        if user_id not in chatroom.users:
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
             return
 
-        chatroom.remove_user(user_id)
-        if len(chatroom.users) == 0:
+        # Hold the chatroom lock so that the parked polls are woken up
+        # only once the chatroom has been released.
+        with self.store.lock(chatroom):
+            if chatroom_id not in self.chatrooms or user_id not in chatroom.users:
+                return
+            chatroom.remove_user(user_id)
+            self._journal('remove_user', chatroom_id, user_id, dict(chatroom.leaved_users), chatroom.modified_at)
+            self.session_index.remove(user_id, chatroom_id)
+            self.users.pop(user_id, None)
+            if len(chatroom.users) > 0:
+                self._index_modified_chatroom(chatroom)
+                data = self._get_chatroom_data(chatroom_id)
+                return data
+            if self.journal is not None:
+                self._journal('release', chatroom_id)
+                self.unarchived_chatrooms[chatroom_id] = chatroom
             self._archive_dialog(chatroom_id)
-            self.released_chatrooms[chatroom_id] = self.chatrooms[chatroom_id]
             self.chatrooms.pop(chatroom_id)
-            self.chatroom_locks.pop(chatroom_id)
+            self.released_chatrooms.add(chatroom)
+            self._index_released_chatroom(chatroom)
+
+        # The mutex must not be acquired while holding the lock of a chatroom (see join()).
+        # Meanwhile, join() skips the released chatroom.
+        with self.mutex:
+            self.waiting_rooms.remove(chatroom_id)
+
+    def _index_modified_chatroom(self, chatroom):
+        # Must be called with the lock of the chatroom held each time an active chatroom changes.
+        if not self.store.shared:
+            self.chatroom_indexes['active']['modified'].update(chatroom.id, chatroom.modified_at)
+
+    def _index_new_chatroom(self, chatroom):
+        # With a shared store, the indexes are built when they are needed (see _get_chatroom_index()).
+        if self.store.shared:
             return
+        self._index_chatroom('active', chatroom)
 
-        data = self._get_chatroom_data(chatroom_id)
-        return data
-
-    def _archive_dialog(self, chatroom_id):
-        self.logger.debug(f"Archiving dialog from chatroom {chatroom_id}...")
-
-        creation_date = dateutil.parser.parse(self.chatrooms[chatroom_id].created)
+    def _index_chatroom(self, status, chatroom):
+        indexes = self.chatroom_indexes[status]
+        indexes['created'].update(chatroom.id, chatroom.created_at)
+        indexes['modified'].update(chatroom.id, chatroom.modified_at)
 
-        tz = pytz.timezone('Asia/Tokyo')
+    def _index_released_chatroom(self, chatroom):
+        if self.store.shared:
+            return
+        for index in self.chatroom_indexes['active'].values():
+            index.remove(chatroom.id)
+        self._index_chatroom('released', chatroom)
+        # The released chatrooms that have been forgotten (see ReleasedChatrooms) are removed
+        # from the indexes from time to time so that the indexes stay bounded too.
+        indexes = self.chatroom_indexes['released']
+        if len(indexes['created']) > 2 * len(self.released_chatrooms) + 1000:
+            for chatroom_id in indexes['created'].chatroom_ids():
+                if chatroom_id not in self.released_chatrooms:
+                    for index in indexes.values():
+                        index.remove(chatroom_id)
+
+    def _get_chatroom_index(self, status, order):
+        if not self.store.shared:
+            return self.chatroom_indexes[status][order]
+        # With a shared store, the chatrooms are also created and modified by the other processes
+        # so a temporary index is built from the store.
+        index = TimeIndex()
+        registry = self.chatrooms if status == 'active' else self.released_chatrooms
+        for chatroom in registry.values():
+            index.update(chatroom.id, getattr(chatroom, f"{order}_at"))
+        return index
 
-        dialog_dir = f"{self.cfg['archives']}/{creation_date.year}/{creation_date.month:02}/{creation_date.day:02}"
-        Path(dialog_dir).mkdir(parents=True, exist_ok=True)
-        dialog_filename = f"{chatroom_id}.txt"
-        with open(f"{dialog_dir}/{dialog_filename}", mode="w") as output_file:
-            if self.chatrooms[chatroom_id].experiment_id:
-                output_file.write(f"Experiment: {self.chatrooms[chatroom_id].experiment_id}\n")
-            for evt in self.chatrooms[chatroom_id].events:
-                str_from = f"U{1 if evt['from'] == self.chatrooms[chatroom_id].initiator else 2}"
-                timestamp = datetime.fromisoformat(f"{evt['timestamp']}+00:00").astimezone(tz).isoformat()
-                output_file.write(f"{timestamp}|{str_from}: {evt['body']}\n")
-        self.logger.debug(f"Dialog has been archived in {dialog_dir}/{dialog_filename}")
+    def _archive_dialog(self, chatroom_id):
+        # The dialog is written in the background by the archiver.
+        self.logger.debug("Archiving dialog from chatroom %s...", chatroom_id)
+        self.archiver.submit(self.chatrooms[chatroom_id])
+
+    def _write_dialogs(self, chatrooms):
+        # Called by the archiver with a batch of released chatrooms.
+        self.archive_backend.write(chatrooms)
+        if self.journal is not None:
+            for chatroom in chatrooms:
+                with self.store.lock(chatroom):
+                    if self.unarchived_chatrooms.pop(chatroom.id, None) is not None:
+                        self._journal('archived', chatroom.id)
+
+    def _journal(self, op, chatroom_id, *args):
+        # Appends a record to the journal (see EventJournal).  Must be called with the lock of the chatroom held
+        # each time a chatroom changes so that it can be recovered (see _recover_journal()).
+        # A custom Api modifying the chatrooms should journal its changes with the ops replayed by JournalState.apply(),
+        # for instance self._journal('add_events', chatroom.id, events, chatroom.modified_at) after chatroom.add_events(events).
+        if self.journal is not None:
+            self.journal.append((op, chatroom_id) + args)
+
+    def _commit_journal(self):
+        # Waits until the journaled changes are written.  It must be called without holding any lock,
+        # before acknowledging a request.  The concurrent requests are written together.
+        if self.journal is not None:
+            self.journal.commit()
+
+    def _recover_journal(self):
+        # Rebuilds the active chatrooms from the journal and archives the dialogs that were not archived yet.
+        # The users of the recovered chatrooms have a whole inactivity timeout to poll again.
+        start = time.perf_counter()
+        state = self.journal.recover()
+        now = time.time()
+        for chatroom in state.chatrooms.values():
+            self.chatrooms.add(chatroom)
+            self._index_new_chatroom(chatroom)
+            for user_id in chatroom.users:
+                self.users[user_id] = self.user_class(user_id, state.users.get(user_id, {}))
+                self.session_index.add(user_id, chatroom.id)
+                chatroom.has_polled(user_id, now)
+                self.inactivity_index.add(user_id, chatroom.id, now + self._get_inactivity_timeout())
+            if len(chatroom.users) == 1 and not chatroom.closed:
+                self.waiting_rooms.add(chatroom, self.users[chatroom.users[0]].matching_key())
+        for chatroom in state.unarchived_chatrooms.values():
+            self.unarchived_chatrooms[chatroom.id] = chatroom
+            self.released_chatrooms.add(chatroom)
+            self._index_chatroom('released', chatroom)
+            self.archiver.submit(chatroom)
+        self.journal.start()
+        self.logger.info("%s chatrooms recovered from the journal (%s records replayed) in %.3f secs.",
+                         len(state.chatrooms), state.record_count, time.perf_counter() - start)
+        # The next start only has to load this snapshot.
+        self.journal.snapshot()
+
+    def _snapshot_journal(self):
+        # Called by the journal to write a snapshot of the active chatrooms and of the unarchived ones.
+        # Each chatroom is saved under its lock with the sequence number of its last record, if it is still in its registry.
+        # The unarchived chatrooms are listed after the active ones so that a chatroom released meanwhile is in one of the lists.
+        segment_number, lsn = self.journal.rotate()
+        snapshots = {}
+        for key, registry in (('chatrooms', self.chatrooms), ('unarchived_chatrooms', self.unarchived_chatrooms)):
+            snapshots[key] = []
+            for chatroom in list(registry.values()):
+                with self.store.lock(chatroom):
+                    if chatroom.id not in registry:
+                        continue
+                    users = {user_id: self.users[user_id].attribs for user_id in chatroom.users if user_id in self.users}
+                    snapshots[key].append((self.journal.lsn, pickle.dumps(chatroom, protocol=pickle.HIGHEST_PROTOCOL), users))
+        self.journal.write_snapshot(segment_number, lsn, snapshots['chatrooms'], snapshots['unarchived_chatrooms'])
+
+    def _create_state_store(self):
+        # The store is chosen with the state_store parameter.
+        # This can be overridden to use a custom StateStore.
+        state_store = self.cfg.get('state_store', 'memory')
+        if state_store == 'memory':
+            return MemoryStateStore(self.cfg, self.logger)
+        if state_store == 'redis':
+            from server.redis_store import RedisStateStore
+            return RedisStateStore(self.cfg, self.logger)
+        raise ValueError(f"Unknown state_store: {state_store}.")
+
+    def _create_journal(self):
+        # The journal is enabled by the journal parameter (the directory of its files).
+        # It requires the memory state store: the redis store already keeps the chatrooms out of the process.
+        if 'journal' not in self.cfg:
+            return None
+        if self.store.shared:
+            raise ValueError("The journal cannot be used with a shared state_store.")
+        return EventJournal(self.cfg['journal'], self.logger,
+                            fsync=self.cfg.get('journal_fsync', 'False') == 'True',
+                            snapshot_interval=self.cfg.get('journal_snapshot_interval', 10000),
+                            take_snapshot=self._snapshot_journal)
+
+    def _create_archive_backend(self):
+        # The archive format is chosen with the archive_format parameter.
+        # This can be overridden to use a custom ArchiveBackend.
+        archive_format = self.cfg.get('archive_format', 'text')
+        if archive_format not in archive_backends:
+            raise ValueError(f"Unknown archive_format: {archive_format}.")
+        return archive_backends[archive_format](self.cfg, self.logger)
 
 
 class BaseApp(Flask):
 
+    # Templates rendered by the views.  Each one can be customized by a template having the same name,
+    # otherwise the template with the default_ prefix is used.
+    view_templates = ('version.html', 'index.html', 'admin.html', 'chatroom.html', 'errorForbiddenAccess.html', 'chatroom.json')
+
     def __init__(self, import_name, api):
         Flask.__init__(self, import_name)
 
@@ -416,14 +1485,46 @@ class BaseApp(Flask):
         self.cfg = api.cfg
         self.logger = api.logger
 
+        # Determined on the first chatroom response.
+        self.chatroom_response_template = None
+        # Compiled templates of the views by name (see get_view_template()).
+        self.resolved_templates = {}
+
+        # Static files of the application (static) and of the framework (default_static) served from memory.
+        default_static_dir = os.path.join(sys.prefix, 'static')
+        # Useful to test the framework as is.
+        if not os.path.isdir(default_static_dir):
+            default_static_dir = str(Path(sys.prefix).parent / 'static')
+        self.static_assets = StaticAssets(os.path.join(self.root_path, 'static'))
+        self.default_static_assets = StaticAssets(default_static_dir)
+        self.add_template_global(self.static_url, 'static_url')
+        # Transport used by the clients to receive the updates of their chatroom:
+        # "poll" for long-poll requests on /chatroom or "sse" for a stream of server-sent events on /events.
+        # The clients fall back to long-poll requests when the stream cannot be opened.
+        self.push_transport = self.cfg.get('push_transport', 'poll')
+
+        # Storage of the sessions: "filesystem" (Flask-Session) or "memory".
+        self.session_store = self.cfg.get('session_store', 'filesystem')
         self.SESSION_TYPE = 'filesystem'
         self.SESSION_COOKIE_NAME = 'CGISESSID'
-        self.SESSION_FILE_DIR = self.cfg['sessions']
+        self.SESSION_FILE_DIR = self.cfg.get('sessions')
         self.SESSION_COOKIE_PATH = self.cfg['cookiePath']
         self.SESSION_COOKIE_SECURE = True
 
         self.config.from_object(self)
-        Session(self)
+        if self.session_store == 'memory':
+            self.session_interface = MemorySessionInterface(self.cfg.get('sessionTimeout', 30) * 60)
+        elif self.session_store == 'filesystem':
+            Session(self)
+        else:
+            raise ValueError(f"Unknown session store: {self.session_store}")
+
+        # With tab tokens, the join request issues a signed token identifying the user
+        # and the following requests sending it back do not open the session.
+        self.tab_tokens = None
+        if self.cfg.get('tab_tokens', 'False') == 'True':
+            self.tab_tokens = TabTokens(self.cfg.get('tab_token_secret') or secrets.token_hex(32))
+            self.session_interface = TabTokenSessionInterface(self.session_interface)
 
         @self.route(f"/{self.cfg['web_context']}/static/<path:path>")
         def get_static(path):
@@ -445,6 +1546,14 @@ class BaseApp(Flask):
         def admin():
             return self.admin()
 
+        @self.route(f"/{self.cfg['web_context']}/admin/chatrooms")
+        def get_admin_chatrooms():
+            return self.get_admin_chatrooms(request)
+
+        @self.route(f"/{self.cfg['web_context']}/metrics")
+        def get_metrics():
+            return self.get_metrics()
+
         @self.route(f"/{self.cfg['web_context']}/join", methods=['POST'])
         def join():
             return self.join(session, request)
@@ -453,179 +1562,412 @@ class BaseApp(Flask):
         def get_chatroom():
             return self.get_chatroom(session, request)
 
+        @self.route(f"/{self.cfg['web_context']}/events")
+        def stream_chatroom():
+            return self.stream_chatroom(session, request)
+
         @self.route(f"/{self.cfg['web_context']}/post", methods=['POST'])
         def post_message():
             return self.post_message(session, request)
 
+        @self.route(f"/{self.cfg['web_context']}/post_events", methods=['POST'])
+        def post_events():
+            return self.post_events(session, request)
+
         @self.route(f"/{self.cfg['web_context']}/leave")
         def leave_chatroom():
             return self.leave_chatroom(session, request)
 
     def get_static(self, path):
-        return send_from_directory('static', path)
+        return self._send_asset(self.static_assets, path)
 
     def get_default_static(self, path):
-        abs_base_path = os.path.join(sys.prefix, 'static')
-        # Useful to test the framework as is.
-        if not os.path.isdir(abs_base_path):
-            abs_base_path = Path(sys.prefix).parent / 'static'
-        return send_from_directory(abs_base_path, path)
+        return self._send_asset(self.default_static_assets, path)
+
+    def _send_asset(self, assets, path):
+        # Sends a static file from memory, compressed when the client accepts it.
+        # A fingerprinted URL (see static_url()) is cached forever by the clients.  The other URLs
+        # are revalidated with the ETag of the file.
+        asset = assets.get(path)
+        if asset is None:
+            return send_from_directory(assets.directory, path)
+        encoding = asset.select(request.accept_encodings)
+        response = self.response_class(mimetype=asset.mimetype)
+        response.set_etag(asset.etag(encoding))
+        response.vary.add('Accept-Encoding')
+        if request.args.get('v') == asset.fingerprint:
+            response.headers['Cache-Control'] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        if request.if_none_match.contains(asset.etag(encoding)):
+            response.status_code = 304
+            return response
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+            response.set_data(asset.variants[encoding])
+        else:
+            response.set_data(asset.data)
+        return response
+
+    def static_url(self, path):
+        # Returns the fingerprinted URL of a file of the static or default_static directory
+        # (for instance, static_url('default_static/default_chat.js') in a template).
+        prefix, _, file_path = path.partition('/')
+        if prefix == 'static':
+            return self.static_assets.url(prefix, file_path)
+        if prefix == 'default_static':
+            return self.default_static_assets.url(prefix, file_path)
+        return path
+
+    def load_assets(self):
+        # Scans the static directories again, for instance when their files have changed.
+        self.static_assets.load()
+        self.default_static_assets.load()
+
+    def get_view_template(self, name):
+        # Returns the compiled template used by a view: the custom template having this name when it exists,
+        # the template with the default_ prefix otherwise.
+        # The template is looked up once and kept in resolved_templates, unless the templates are reloaded
+        # when they change (TEMPLATES_AUTO_RELOAD or debug mode).  Then it is looked up for each request.
+        template = self.resolved_templates.get(name)
+        if template is None:
+            try:
+                template = self.jinja_env.get_template(name)
+            except TemplateNotFound:
+                template = self.jinja_env.get_template(f"default_{name}")
+            if not self.jinja_env.auto_reload:
+                self.resolved_templates[name] = template
+        return template
+
+    def load_templates(self):
+        # Looks up and compiles the templates of the views again, for instance when they have been
+        # changed or when a loader has been added.  Called before the server starts so that
+        # the first requests do not compile them.
+        self.resolved_templates = {}
+        self.chatroom_response_template = None
+        for name in self.view_templates:
+            self.get_view_template(name)
 
     def version(self):
         version = self.api.version()
-        try:
-            return render_template(template_name_or_list='version.html', version=version)
-        except TemplateNotFound:
-            return render_template(template_name_or_list='default_version.html', version=version)
+        return render_template(self.get_view_template('version.html'), version=version)
 
     def index(self):
-        try:
-            return render_template(template_name_or_list='index.html')
-        except TemplateNotFound:
-            return render_template(template_name_or_list='default_index.html')
+        return render_template(self.get_view_template('index.html'))
 
     def admin(self):
-        data = self.api.get_chatrooms()
-        chatrooms = [convert_chatroom_to_dict(chatroom) for chatroom in data['chatrooms']]
-        released_chatrooms = [convert_chatroom_to_dict(released_chatrooms)
-                                for released_chatrooms in data['released_chatrooms']]
+        # The page shows one page of the active and released chatrooms (see get_chatroom_page())
+        # and its rows are streamed while they are rendered.
+        params = self._get_admin_params(request.args)
+        if params is None:
+            return '', 400
+        active_page = self.api.get_chatroom_page('active', **params)
+        released_page = self.api.get_chatroom_page('released', **params)
+        query = {key: value for key, value in request.args.items() if key != 'offset'}
+        prev_url = f"admin?{urlencode(dict(query, offset=max(params['offset'] - params['limit'], 0)))}" if params['offset'] > 0 else None
+        next_url = f"admin?{urlencode(dict(query, offset=params['offset'] + params['limit']))}" \
+            if active_page['more'] or released_page['more'] else None
+        context = dict(
+            chatrooms=(self._convert_chatroom(convert_chatroom_to_row, chatroom) for chatroom in active_page['chatrooms']),
+            chatroom_count=active_page['total'],
+            released_chatrooms=(self._convert_chatroom(convert_chatroom_to_row, chatroom) for chatroom in released_page['chatrooms']),
+            released_chatroom_count=released_page['total'],
+            sessions=self.api.session_index.page(params['offset'], params['limit']),
+            session_count=len(self.api.session_index),
+            archive=self.api.get_archive_stats(),
+            params=params,
+            prev_url=prev_url,
+            next_url=next_url,
+            experiment_id=self.cfg['experiment_id'],
+            utc_to_local=utc_to_local)
+        # The small fragments rendered by the template are sent by groups.
+        # (flask.stream_template requires Flask 2.2.)
+        self.update_template_context(context)
+        stream = TemplateStream(self.get_view_template('admin.html').generate(**context))
+        stream.enable_buffering(500)
+        return self.response_class(stream_with_context(stream))
+
+    def get_metrics(self):
+        # Metrics of the server in the Prometheus text format.
+        return self.response_class(self.api.metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+    def get_admin_chatrooms(self, request):
+        # JSON API of the admin page.  The status parameter selects the active (default) or released chatrooms.
+        params = self._get_admin_params(request.args)
+        status = request.args.get('status', 'active')
+        if params is None or status not in ('active', 'released'):
+            return '', 400
+        page = self.api.get_chatroom_page(status, **params)
+        page['chatrooms'] = [self._convert_chatroom(convert_chatroom_to_admin_dict, chatroom) for chatroom in page['chatrooms']]
+        return self.response_class(dumps_json(page), mimetype='application/json')
+
+    def _convert_chatroom(self, convert, chatroom):
+        # The users of an active chatroom may leave while the admin pages are built,
+        # so its row is built under its lock.  A ChatroomSummary does not change anymore.
+        if isinstance(chatroom, ChatroomSummary):
+            return convert(chatroom)
+        with self.api.store.lock(chatroom):
+            return convert(chatroom)
+
+    def _get_admin_params(self, args):
+        # Returns the pagination and filtering parameters of the admin pages or None if they are invalid.
+        # The since and until parameters are UTC ISO times and the indexes use epoch timestamps.
         try:
-            return render_template(
-                template_name_or_list='admin.html',
-                chatrooms=chatrooms,
-                released_chatrooms=released_chatrooms,
-                experiment_id=self.cfg['experiment_id'],
-                utc_to_local=utc_to_local)
-        except TemplateNotFound:
-            return render_template(
-                template_name_or_list='default_admin.html',
-                chatrooms=chatrooms,
-                released_chatrooms=released_chatrooms,
-                experiment_id=self.cfg['experiment_id'],
-                utc_to_local=utc_to_local)
+            offset = int(args.get('offset', 0))
+            limit = int(args.get('limit', 100))
+            since = utc_to_epoch(args['since']) if args.get('since') else None
+            until = utc_to_epoch(args['until']) if args.get('until') else None
+        except ValueError:
+            return None
+        order = args.get('order', 'modified')
+        if offset < 0 or limit <= 0 or limit > 1000 or order not in ('created', 'modified'):
+            return None
+        return {
+            'order': order,
+            'offset': offset,
+            'limit': limit,
+            'user': args.get('user') or None,
+            'since': since,
+            'until': until,
+            'reverse': args.get('reverse', 'True') == 'True'
+        }
 
     def join(self, session, request):
         if 'clientTabId' not in request.form:
             return '', 400
 
         client_tab_id = request.form['clientTabId']
+        # Flask-Session only keeps (and sends the cookie of) the sessions holding some data,
+        # so the session is marked to identify the following requests of the user with the same id.
+        if 'joined' not in session:
+            session['joined'] = True
         user_id = f'{session.sid}_{client_tab_id}'
         data = self.api.join(user_id)
 
         if isinstance(data, str) and data.startswith("Error: MultipleTabAccessForbidden"):
             return self.error_forbidden_access_multiple_tabs()
 
-        try:
-            return render_template(
-                template_name_or_list='chatroom.html',
-                client_tab_id=client_tab_id,
-                msg_count_low=data['msg_count_low'],
-                msg_count_high=data['msg_count_high'],
-                poll_interval=data['poll_interval'],
-                delay_for_partner=0 if data['chatroom'].closed else data['delay_for_partner'],
-                experiment_id=data['chatroom'].experiment_id,
-                chatroom_id=data['chatroom'].id,
-                is_first_user=(data['chatroom'].initiator == user_id),
-                server_url=''
-            )
-        except TemplateNotFound:
-            return render_template(
-                template_name_or_list='default_chatroom.html',
-                client_tab_id=client_tab_id,
-                msg_count_low=data['msg_count_low'],
-                msg_count_high=data['msg_count_high'],
-                poll_interval=data['poll_interval'],
-                delay_for_partner=0 if data['chatroom'].closed else data['delay_for_partner'],
-                experiment_id=data['chatroom'].experiment_id,
-                chatroom_id=data['chatroom'].id,
-                is_first_user=(data['chatroom'].initiator == user_id)
-            )
+        tab_token = self.tab_tokens.issue(user_id) if self.tab_tokens is not None else ''
+
+        return render_template(
+            self.get_view_template('chatroom.html'),
+            client_tab_id=client_tab_id,
+            msg_count_low=data['msg_count_low'],
+            msg_count_high=data['msg_count_high'],
+            poll_interval=data['poll_interval'],
+            delay_for_partner=0 if data['chatroom'].closed else data['delay_for_partner'],
+            experiment_id=data['chatroom'].experiment_id,
+            chatroom_id=data['chatroom'].id,
+            is_first_user=(data['chatroom'].initiator == user_id),
+            push_transport=self.push_transport,
+            tab_token=tab_token,
+            server_url=''
+        )
 
     def get_chatroom(self, session, request):
+        poll = self._get_poll_params(session, request)
+        if poll is None:
+            return '', 400
+        data = self.api.get_chatroom(poll['chatroom_id'], poll['user_id'], poll['client_timestamp'])
+        return self._get_poll_response(poll, data)
+
+    def stream_chatroom(self, session, request):
+        # Stream of server-sent events sending the updates of the chatroom over a single connection.
+        # The stream polls the chatroom like the /chatroom requests and sends each result as an event.
+        if self.push_transport != 'sse':
+            return '', 404
+        poll = self._get_poll_params(session, request)
+        if poll is None:
+            return '', 400
+
+        def generate():
+            while True:
+                data = self.api.get_chatroom(poll['chatroom_id'], poll['user_id'], poll['client_timestamp'])
+                yield self._get_stream_event(poll, data)
+                if data is None:
+                    return
+
+        return self.response_class(stream_with_context(generate()), mimetype='text/event-stream',
+                                   headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def _get_stream_event(self, poll, data):
+        # Returns the server-sent event of a poll result and updates the poll parameters
+        # so that the next poll waits only for the changes that have not been sent yet.
+        # An expired poll produces a comment that keeps the connection alive.
+        # An empty object is sent when the chatroom or the user is gone and the stream ends.
+        if data == "expired":
+            return b': keepalive\n\n'
+        if data is None:
+            return b'data: {}\n\n'
+        chatroom = data['chatroom']
+        with self.api.store.lock(chatroom):
+            body = self._make_chatroom_response(poll['user_id'], data, poll['last_seq']).get_data()
+            poll['client_timestamp'] = chatroom.version
+            poll['last_seq'] = chatroom.last_seq()
+        return b''.join(b'data: ' + line + b'\n' for line in body.rstrip(b'\n').split(b'\n')) + b'\n'
+
+    def _get_poll_params(self, session, request):
+        # Returns None when the poll request is invalid.
         params = request.args.to_dict()
         if 'clientTabId' not in params or 'id' not in params or 'timestamp' not in params:
-            return '', 400
-        client_tab_id = params.get('clientTabId')
-        chatroom_id = params.get('id')
-        client_timestamp = params.get('timestamp')
-        user_id = f'{session.sid}_{client_tab_id}'
-        data = self.api.get_chatroom(chatroom_id, user_id, client_timestamp if client_timestamp != '' else None)
-        response = "{}"
-        if data is not None:
-            if data == "expired":
-                response = '{"msg": "poll expired"}'
-            else:
-                response = self._get_chatroom_response(user_id, data)
-        return jsonify(response)
+            return None
+        user_id = self._get_user_id(session, params)
+        if user_id is None:
+            return None
+        return {
+            'user_id': user_id,
+            'chatroom_id': params.get('id'),
+            # The timestamp parameter is the version of the chatroom received by the client.
+            'client_timestamp': parse_version(params.get('timestamp')),
+            'last_seq': parse_seq(params.get('lastSeq'))
+        }
+
+    def _get_poll_response(self, poll, data):
+        if data == "expired":
+            if self._uses_chatroom_template():
+                return jsonify('{"msg": "poll expired"}')
+            return self._json_response({"msg": "poll expired"})
+        return self._make_chatroom_response(poll['user_id'], data, poll['last_seq'])
 
     def post_message(self, session, request):
         if 'clientTabId' not in request.form or 'chatroom' not in request.form or 'message' not in request.form:
             return '', 400
-        client_tab_id = request.form['clientTabId']
         chatroom_id = request.form['chatroom']
         message = request.form['message']
-        user_id = f'{session.sid}_{client_tab_id}'
+        last_seq = parse_seq(request.form.get('lastSeq'))
+        user_id = self._get_user_id(session, request.form)
+        if user_id is None:
+            return '', 400
         data = self.api.post_message(user_id, chatroom_id, message)
-        response = "{}"
-        if data is not None:
-            response = self._get_chatroom_response(user_id, data)
-        return jsonify(response)
+        return self._make_chatroom_response(user_id, data, last_seq)
+
+    def post_events(self, session, request):
+        # Batched version of /post: the events parameter is a JSON array of {"type": ..., "body": ...} objects.
+        # The optional batchId parameter identifies the batch so that it is added once when it is sent again.
+        # Only an acknowledgment with the new lastSeq and version is returned (an empty object when
+        # the chatroom or the user is gone).
+        if 'clientTabId' not in request.form or 'chatroom' not in request.form or 'events' not in request.form:
+            return '', 400
+        events = parse_events(request.form['events'], self.cfg.get('post_events_max', 100))
+        if events is None:
+            return '', 400
+        user_id = self._get_user_id(session, request.form)
+        if user_id is None:
+            return '', 400
+        data = self.api.post_events(user_id, request.form['chatroom'], events, request.form.get('batchId'))
+        return self._json_response(data if data is not None else {})
 
     def leave_chatroom(self, session, request):
         params = request.args.to_dict()
         if 'clientTabId' not in params or 'chatroom' not in params:
             return '', 400
-        client_tab_id = params.get('clientTabId')
         chatroom_id = params.get('chatroom')
-        user_id = f'{session.sid}_{client_tab_id}'
+        last_seq = parse_seq(params.get('lastSeq'))
+        user_id = self._get_user_id(session, params)
+        if user_id is None:
+            return '', 400
         data = self.api.leave_chatroom(user_id, chatroom_id)
-        response = "{}"
-        if data is not None:
-            response = self._get_chatroom_response(user_id, data)
-        return jsonify(response)
+        return self._make_chatroom_response(user_id, data, last_seq)
+
+    def _get_user_id(self, session, params):
+        # Returns the id of the user sending a request with the given parameters.
+        # A request sending a tab token is identified by the token only (its session is not opened).
+        # Returns None when the token is invalid.
+        token = params.get('token')
+        if self.tab_tokens is not None and token:
+            return self.tab_tokens.user_id(token)
+        return f"{session.sid}_{params.get('clientTabId')}"
 
     def error_forbidden_access_multiple_tabs(self):
+        return render_template(self.get_view_template('errorForbiddenAccess.html'))
+
+    def _make_chatroom_response(self, user_id, data, last_seq=None):
+        # By default, the chatroom payload is built as a dictionary and encoded once.
+        # When the chatroom.json template is used, the rendered template is sent as a JSON string.
+        # The events and the rest of the chatroom are read under the same lock so that the version
+        # sent to the client is the one of its lastSeq.  Otherwise, a post between them would never be polled.
+        if self._uses_chatroom_template():
+            response = "{}"
+            if data is not None:
+                # The overrides of _get_chatroom_response() keep its (user_id, data) signature.
+                with self.api.store.lock(data['chatroom']):
+                    response = self._get_chatroom_response(user_id, dict(data, last_seq=last_seq))
+            return jsonify(response)
+        if data is None:
+            return self._json_response({})
+        with self.api.store.lock(data['chatroom']):
+            latest_events, last_seq = self._get_serialized_events(user_id, data['chatroom'], last_seq)
+            payload = dumps_json(self._get_chatroom_payload(user_id, data, last_seq))
+        # The events are already encoded so they are inserted in the encoded payload.
+        return self.response_class(b'{"latestEvents":' + latest_events + b',' + payload[1:], mimetype='application/json')
+
+    def _uses_chatroom_template(self):
+        # The chatroom.json template is used when it is requested in the config,
+        # when a custom chatroom.json template exists or when _get_chatroom_response() is overridden.
+        if self.chatroom_response_template is None:
+            self.chatroom_response_template = \
+                ('chatroom_response_template' in self.cfg and self.cfg['chatroom_response_template'] == 'True') or \
+                type(self)._get_chatroom_response is not BaseApp._get_chatroom_response or \
+                self._has_custom_template('chatroom.json')
+        return self.chatroom_response_template
+
+    def _has_custom_template(self, name):
+        # Returns whether a custom template replaces the default template of a view.
         try:
-            return render_template(
-                template_name_or_list='errorForbiddenAccess.html'
-            )
+            return self.get_view_template(name).name == name
         except TemplateNotFound:
-            return render_template(
-                template_name_or_list='default_errorForbiddenAccess.html'
-            )
+            return False
+
+    def _json_response(self, payload):
+        return self.response_class(dumps_json(payload), mimetype='application/json')
+
+    def _get_serialized_events(self, user_id, chatroom, last_seq=None):
+        # Returns the JSON array of the events that the client has not received yet
+        # and the sequence number of the last one.  When last_seq is None, all the events are sent.
+        with self.api.store.lock(chatroom):
+            first_seq = min(last_seq or 0, chatroom.last_seq())
+            serialized_events = chatroom.serialized_events_since(user_id, first_seq)
+        return b'[' + b','.join(serialized_events) + b']', first_seq + len(serialized_events)
+
+    def _get_chatroom_payload(self, user_id, data, last_seq):
+        # The latestEvents are added by _make_chatroom_response().
+        # last_seq is the sequence number of the last event sent.
+        chatroom = data['chatroom']
+        return {
+            'id': chatroom.id,
+            'experimentId': str(chatroom.experiment_id),
+            'users': list(chatroom.users),
+            'created': chatroom.created,
+            'modified': chatroom.modified,
+            'version': chatroom.version,
+            'initiator': "self" if chatroom.initiator == user_id else "other",
+            'closed': chatroom.closed,
+            'lastSeq': last_seq,
+            'msgCountLow': data['msg_count_low'],
+            'msgCountHigh': data['msg_count_high'],
+            'pollInterval': data['poll_interval'],
+            'delayForPartner': data['delay_for_partner']
+        }
 
     def _get_chatroom_response(self, user_id, data):
-        formatted_events = [events_for_user(evt, user_id) for evt in data['chatroom'].events]
-        try:
-            response = render_template(
-                template_name_or_list='chatroom.json',
-                chatroom_id=data['chatroom'].id,
-                experiment_id=data['chatroom'].experiment_id,
-                users=json.dumps(data['chatroom'].users),
-                created=data['chatroom'].created,
-                modified=data['chatroom'].modified,
-                initiator="self" if data['chatroom'].initiator == user_id else "other",
-                closed="true" if data['chatroom'].closed else "false",
-                events=json.dumps(formatted_events, ensure_ascii=False),
-                msg_count_low=data['msg_count_low'],
-                msg_count_high=data['msg_count_high'],
-                poll_interval=data['poll_interval'],
-                delay_for_partner=data['delay_for_partner']
-            )
-        except TemplateNotFound:
-            response = render_template(
-                template_name_or_list='default_chatroom.json',
-                chatroom_id=data['chatroom'].id,
-                experiment_id=data['chatroom'].experiment_id,
-                users=json.dumps(data['chatroom'].users),
-                created=data['chatroom'].created,
-                modified=data['chatroom'].modified,
-                initiator="self" if data['chatroom'].initiator == user_id else "other",
-                closed="true" if data['chatroom'].closed else "false",
-                events=json.dumps(formatted_events, ensure_ascii=False),
-                msg_count_low=data['msg_count_low'],
-                msg_count_high=data['msg_count_high'],
-                poll_interval=data['poll_interval'],
-                delay_for_partner=data['delay_for_partner']
-            )
-        return response
+        # Called with the lock of the chatroom held (see _make_chatroom_response()).
+        # data['last_seq'] is the sequence number of the last event received by the client.
+        latest_events, last_seq = self._get_serialized_events(user_id, data['chatroom'], data.get('last_seq'))
+        latest_events = latest_events.decode('utf-8')
+        return render_template(
+            self.get_view_template('chatroom.json'),
+            chatroom_id=data['chatroom'].id,
+            experiment_id=data['chatroom'].experiment_id,
+            users=json.dumps(data['chatroom'].users),
+            created=data['chatroom'].created,
+            modified=data['chatroom'].modified,
+            version=data['chatroom'].version,
+            initiator="self" if data['chatroom'].initiator == user_id else "other",
+            closed="true" if data['chatroom'].closed else "false",
+            events=latest_events,
+            last_seq=last_seq,
+            msg_count_low=data['msg_count_low'],
+            msg_count_high=data['msg_count_high'],
+            poll_interval=data['poll_interval'],
+            delay_for_partner=data['delay_for_partner']
+        )
@@ -0,0 +1,364 @@
+import os
+from pathlib import Path
+import pickle
+import struct
+import sys
+import threading
+import traceback
+import zlib
+
+
+# Header of the journal records: the length and the CRC32 of the body.
+# The body is the sequence number of the record (see RECORD_LSN) followed by the pickled record.
+RECORD_HEADER = struct.Struct('<II')
+RECORD_LSN = struct.Struct('<Q')
+
+
+def encode_record(lsn, record):
+    body = RECORD_LSN.pack(lsn) + pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(segment_path):
+    # Iterates over the (lsn, record) pairs of a segment.  It stops at the first incomplete
+    # or corrupted record (for instance, a record that was being written when the process crashed)
+    # and yields its offset as a None record so that the caller can truncate the segment.
+    with open(segment_path, mode='rb') as segment_file:
+        data = segment_file.read()
+    offset = 0
+    while offset < len(data):
+        if offset + RECORD_HEADER.size > len(data):
+            yield offset, None
+            return
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        body = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            yield offset, None
+            return
+        try:
+            record = pickle.loads(body[RECORD_LSN.size:])
+        except Exception:
+            yield offset, None
+            return
+        yield RECORD_LSN.unpack_from(body)[0], record
+        offset += RECORD_HEADER.size + length
+
+
+class JournalState(object):
+    # State rebuilt from the journal by EventJournal.recover():
+    # - chatrooms: the active chatrooms by id, in the order they were created,
+    # - unarchived_chatrooms: the released chatrooms whose dialog has not been archived yet,
+    # - users: the attributes of the users of these chatrooms by user id.
+
+    def __init__(self):
+        self.chatrooms = {}
+        self.unarchived_chatrooms = {}
+        self.users = {}
+        # Sequence number of the last record of each chatroom already included in the snapshot.
+        self.snapshot_lsns = {}
+        self.lsn = 0
+        self.record_count = 0
+
+    def apply(self, lsn, record):
+        # Replays a record.  The records of the chatrooms that are unknown (for instance, the ones
+        # archived before the snapshot) or that are already included in the snapshot are skipped.
+        op, chatroom_id = record[0], record[1]
+        self.lsn = max(self.lsn, lsn)
+        if lsn <= self.snapshot_lsns.get(chatroom_id, 0):
+            return
+        self.record_count += 1
+        if op == 'create':
+            chatroom, attribs = record[2], record[3]
+            self.chatrooms[chatroom_id] = chatroom
+            self.users[chatroom.initiator] = attribs
+            return
+        if op == 'archived':
+            self.unarchived_chatrooms.pop(chatroom_id, None)
+            return
+        chatroom = self.chatrooms.get(chatroom_id)
+        if chatroom is None:
+            return
+        if op == 'add_user':
+            user_id, attribs, modified_at = record[2:]
+            chatroom.add_user(user_id)
+            self.users[user_id] = attribs
+            chatroom.modified_at = modified_at
+        elif op == 'add_events':
+            # The records of BaseApi.post_events() also have the id of the batch.
+            events, modified_at = record[2:4]
+            chatroom.add_events(events)
+            chatroom.modified_at = modified_at
+            if len(record) > 4 and record[4] is not None:
+                chatroom.posted_batches[events[0]['from']] = record[4]
+        elif op == 'remove_user':
+            user_id, leaved_users, modified_at = record[2:]
+            chatroom.remove_user(user_id)
+            chatroom.leaved_users = leaved_users
+            chatroom.modified_at = modified_at
+        elif op == 'release':
+            self.unarchived_chatrooms[chatroom_id] = self.chatrooms.pop(chatroom_id)
+
+    def load_snapshot(self, snapshot):
+        for key in ('chatrooms', 'unarchived_chatrooms'):
+            registry = getattr(self, key)
+            for lsn, pickled_chatroom, users in snapshot[key]:
+                chatroom = pickle.loads(pickled_chatroom)
+                registry[chatroom.id] = chatroom
+                self.snapshot_lsns[chatroom.id] = lsn
+                self.users.update(users)
+        # A chatroom saved after the rotation may have records that are not in the segments anymore
+        # (they were not written before a crash), so the next records follow its sequence number too.
+        self.lsn = max([snapshot['lsn']] + list(self.snapshot_lsns.values()))
+
+
+class EventJournal(object):
+    # Append-only write-ahead journal of the changes of the active chatrooms so that they can be
+    # rebuilt when the server restarts (see recover() and BaseApi._recover_journal()).
+    #
+    # The records are tuples (op, chatroom_id, ...) appended by the requests with append() while they
+    # hold the lock of the chatroom, so the records of a chatroom are in the order of its changes.
+    # append() only encodes the record.  commit() waits until the records appended so far are written
+    # so that a request is only acknowledged once its changes are in the journal.  The records are written
+    # by groups (group commit): the first request calling commit() writes all the pending records at once,
+    # with a single fsync when fsync is True, while the other ones wait for it and the records appended
+    # meanwhile are written by the next one.  A background thread writes the records that nobody waits for
+    # every flush_interval seconds.
+    #
+    # The records are written in the segment files journal-NNNNNN.log.  Every snapshot_interval records,
+    # a new segment is started and the take_snapshot callback writes the state of the chatrooms with
+    # write_snapshot().  The snapshot is fuzzy: the chatrooms are saved one after the other while the journal
+    # goes on, each one with the sequence number of its last record.  Once the snapshot is written,
+    # the previous segments and snapshots are deleted.
+
+    def __init__(self, directory, logger, fsync=False, snapshot_interval=10000, take_snapshot=None, flush_interval=0.05):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.logger = logger
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self.take_snapshot = take_snapshot
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition()
+        # Encoded records waiting to be written as (lsn, bytes) pairs.
+        self.pending = []
+        # Sequence numbers of the last record appended and of the last record written.
+        self.lsn = 0
+        self.written_lsn = 0
+        # True while a thread is writing a group of records.
+        self.writing = False
+        # When set, the records following this sequence number are written in a new segment.
+        self.rotate_at = None
+        self.segment_number = 0
+        self.segment_file = None
+        self.closed = False
+        self.failed = False
+        self.records_since_snapshot = 0
+        self.stopped = threading.Event()
+        self.snapshot_lock = threading.Lock()
+        self.records = 0
+        self.commits = 0
+        self.bytes = 0
+        self.flusher = threading.Thread(target=self._flush_records, name='EventJournal', daemon=True)
+
+    def segments(self):
+        return sorted(self.dir.glob('journal-*.log'))
+
+    def snapshots(self):
+        return sorted(self.dir.glob('snapshot-*.pickle'))
+
+    def recover(self):
+        # Rebuilds the state of the chatrooms from the last snapshot and the following segments.
+        # It must be called before start().
+        state = JournalState()
+        snapshot_segment = 0
+        for snapshot_path in reversed(self.snapshots()):
+            try:
+                with open(snapshot_path, mode='rb') as snapshot_file:
+                    snapshot = pickle.load(snapshot_file)
+            except Exception:
+                self.logger.warning("The journal snapshot %s cannot be read.", snapshot_path)
+                continue
+            state.load_snapshot(snapshot)
+            snapshot_segment = snapshot['segment']
+            break
+        for segment_path in self.segments():
+            segment_number = int(segment_path.stem.split('-')[1])
+            self.segment_number = max(self.segment_number, segment_number)
+            if segment_number < snapshot_segment:
+                continue
+            for lsn, record in read_records(segment_path):
+                if record is None:
+                    # The end of the segment was not written completely.
+                    self.logger.warning("The journal segment %s is truncated at offset %s.", segment_path, lsn)
+                    with open(segment_path, mode='r+b') as segment_file:
+                        segment_file.truncate(lsn)
+                    break
+                state.apply(lsn, record)
+        self.lsn = self.written_lsn = state.lsn
+        return state
+
+    def start(self):
+        # The records are written in a new segment.
+        self.segment_number += 1
+        self.segment_file = open(self._segment_path(self.segment_number), mode='ab')
+        self.flusher.start()
+
+    def append(self, record):
+        # Returns the sequence number of the record.
+        with self.cond:
+            if self.failed:
+                # The journal cannot be written anymore (see _write_pending()).
+                return self.lsn
+            self.lsn += 1
+            self.pending.append((self.lsn, encode_record(self.lsn, record)))
+            return self.lsn
+
+    def commit(self, lsn=None):
+        # Waits until the record having the given sequence number (by default, the last one) is written.
+        with self.cond:
+            if lsn is None:
+                lsn = self.lsn
+            while self.written_lsn < lsn and self.writing and not self.failed:
+                self.cond.wait()
+            if self.written_lsn >= lsn or self.failed or self.segment_file is None:
+                return
+        self._write_pending()
+
+    def rotate(self):
+        # Starts a new segment after the last record appended.  Returns the number of the new segment
+        # and the sequence number of the last record of the previous one.
+        with self.cond:
+            while self.rotate_at is not None and self.segment_file is not None and not self.failed:
+                self.cond.wait()
+            rotate_at = self.rotate_at = self.lsn
+            segment_number = self.segment_number + 1
+        self._write_pending()
+        return segment_number, rotate_at
+
+    def snapshot(self):
+        # Writes a snapshot with the take_snapshot callback (see write_snapshot()).
+        if self.take_snapshot is None or self.closed:
+            return
+        with self.snapshot_lock:
+            self.take_snapshot()
+
+    def write_snapshot(self, segment_number, lsn, chatrooms, unarchived_chatrooms):
+        # chatrooms and unarchived_chatrooms are lists of (lsn, pickled chatroom, users) tuples where lsn is
+        # the sequence number of the last record of the chatroom and users the attributes of its users.
+        # The snapshot replaces the segments preceding segment_number.
+        snapshot_path = self.dir / f"snapshot-{segment_number:06}.pickle"
+        tmp_path = snapshot_path.with_suffix('.tmp')
+        with open(tmp_path, mode='wb') as snapshot_file:
+            pickle.dump({
+                'segment': segment_number,
+                'lsn': lsn,
+                'chatrooms': chatrooms,
+                'unarchived_chatrooms': unarchived_chatrooms
+            }, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(tmp_path, snapshot_path)
+        for path in self.snapshots():
+            if path != snapshot_path:
+                path.unlink()
+        for path in self.segments():
+            if int(path.stem.split('-')[1]) < segment_number:
+                path.unlink()
+        self.logger.debug("Journal snapshot of %s chatrooms written in %s", len(chatrooms), snapshot_path)
+
+    def close(self):
+        # Writes the pending records and stops the background thread.
+        if self.closed:
+            return
+        self.closed = True
+        self.stopped.set()
+        if self.flusher.is_alive():
+            self.flusher.join()
+        self._write_pending()
+        with self.cond:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'records': self.records,
+                'commits': self.commits,
+                'bytes': self.bytes,
+                'segment': self.segment_number
+            }
+
+    def _segment_path(self, segment_number):
+        return self.dir / f"journal-{segment_number:06}.log"
+
+    def _write_pending(self):
+        # Writes all the pending records.  Only one thread writes at a time.
+        with self.cond:
+            while self.writing and not self.failed:
+                self.cond.wait()
+            if self.failed or self.segment_file is None or (len(self.pending) == 0 and self.rotate_at is None):
+                return
+            self.writing = True
+            batch = self.pending
+            self.pending = []
+            rotate_at = self.rotate_at
+        try:
+            if rotate_at is not None:
+                # The records up to rotate_at belong to the previous segment.
+                self._write_batch([frame for lsn, frame in batch if lsn <= rotate_at])
+                self.segment_file.close()
+                self.segment_file = open(self._segment_path(self.segment_number + 1), mode='ab')
+                self.segment_number += 1
+                self._write_batch([frame for lsn, frame in batch if lsn > rotate_at])
+            else:
+                self._write_batch([frame for lsn, frame in batch])
+        except:
+            (typ, val, tb) = sys.exc_info()
+            error_msg = "An exception occurred in the EventJournal:\n"
+            for line in traceback.format_exception(typ, val, tb):
+                error_msg += line + "\n"
+            self.logger.error(error_msg)
+            with self.cond:
+                # The requests waiting in commit() are released.
+                self.failed = True
+                self.writing = False
+                self.cond.notify_all()
+            return
+        with self.cond:
+            self.writing = False
+            if rotate_at is not None:
+                self.rotate_at = None
+            if len(batch) > 0:
+                self.written_lsn = batch[-1][0]
+                self.records += len(batch)
+                self.commits += 1
+            self.records_since_snapshot += len(batch)
+            self.cond.notify_all()
+
+    def _write_batch(self, frames):
+        if len(frames) == 0:
+            return
+        data = b''.join(frames)
+        self.segment_file.write(data)
+        self.segment_file.flush()
+        if self.fsync:
+            os.fsync(self.segment_file.fileno())
+        self.bytes += len(data)
+
+    def _flush_records(self):
+        # Writes the records that nobody commits (for instance, the changes made by the cleaner)
+        # and takes the snapshots.
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self._write_pending()
+                if self.take_snapshot is not None and self.records_since_snapshot >= self.snapshot_interval:
+                    self.records_since_snapshot = 0
+                    self.snapshot()
+            except:
+                (typ, val, tb) = sys.exc_info()
+                error_msg = "An exception occurred in the EventJournal:\n"
+                for line in traceback.format_exception(typ, val, tb):
+                    error_msg += line + "\n"
+                self.logger.error(error_msg)
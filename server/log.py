@@ -0,0 +1,56 @@
+import itertools
+import logging
+import logging.handlers
+import queue
+
+
+class RequestLogger(object):
+    # Debug logging of the request paths (joins, polls, posts, cleanings) that costs almost nothing
+    # when DEBUG is disabled: the messages are only built for the traced requests.
+    # A request is traced (all its debug messages are logged) when sample() returns True, that is when
+    # DEBUG is enabled for one request out of sampling.  The messages are "event key=value ..." lines.
+
+    def __init__(self, logger, sampling=1):
+        self.logger = logger
+        self.sampling = sampling
+        self.counter = itertools.count()
+
+    def sample(self):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        return self.sampling <= 1 or next(self.counter) % self.sampling == 0
+
+    def debug(self, event, **fields):
+        # The caller must check that the request is traced (see sample()).
+        self.logger.debug('%s %s', event, ' '.join(f"{name}={value}" for name, value in fields.items()))
+
+
+class QueueLogging(object):
+    # Moves the handlers of a logger and of its ancestors behind QueueHandlers.
+    # The records are put in queues by the request threads and written by background threads,
+    # so the logging I/O never blocks a request, even one holding the lock of a chatroom.
+
+    def __init__(self, logger):
+        self.listeners = []
+        current = logger
+        while current is not None:
+            if len(current.handlers) > 0:
+                handlers = list(current.handlers)
+                record_queue = queue.SimpleQueue()
+                queue_handler = logging.handlers.QueueHandler(record_queue)
+                listener = logging.handlers.QueueListener(record_queue, *handlers, respect_handler_level=True)
+                for handler in handlers:
+                    current.removeHandler(handler)
+                current.addHandler(queue_handler)
+                listener.start()
+                self.listeners.append((current, handlers, queue_handler, listener))
+            current = current.parent if current.propagate else None
+
+    def stop(self):
+        # Writes the pending records and puts the handlers back.
+        for current, handlers, queue_handler, listener in self.listeners:
+            listener.stop()
+            current.removeHandler(queue_handler)
+            for handler in handlers:
+                current.addHandler(handler)
+        self.listeners = []
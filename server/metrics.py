@@ -0,0 +1,185 @@
+import bisect
+import threading
+
+
+# Upper bounds (in seconds) of the buckets of the histograms.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric(object):
+    # Base class of the metrics.  A metric with label names has a child per combination of label values
+    # (see labels()).  A metric without label names records its values itself.
+    # The recording methods only hold a lock while updating a few numbers so that they can be
+    # called on the poll path.
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if len(self.labelnames) == 0:
+            self.children[()] = self
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"The metric {self.name} has the labels {self.labelnames}.")
+            with self.lock:
+                child = self.children.setdefault(values, self._create_child())
+        return child
+
+    def _create_child(self):
+        raise NotImplementedError()
+
+    def child_samples(self):
+        # Returns the (suffix, labels, value) samples of this metric or child.
+        raise NotImplementedError()
+
+    def samples(self):
+        samples = []
+        for values, child in sorted(self.children.items()):
+            for suffix, labels, value in child.child_samples():
+                samples.append((suffix, dict(zip(self.labelnames, values), **labels), value))
+        return samples
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    # Value that only increases.  When a function is given, it returns the value instead.
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.value = 0
+        self.function = function
+        Metric.__init__(self, name, help, labelnames)
+
+    def _create_child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def child_samples(self):
+        return [('', {}, self.function() if self.function is not None else self.value)]
+
+
+class Gauge(Metric):
+    # Value that can go up and down.  When a function is given, it returns the value instead.
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.value = 0
+        self.function = function
+        Metric.__init__(self, name, help, labelnames)
+
+    def _create_child(self):
+        return Gauge(self.name, self.help)
+
+    def set(self, value):
+        self.value = value
+
+    def child_samples(self):
+        return [('', {}, self.function() if self.function is not None else self.value)]
+
+
+class Histogram(Metric):
+    # Distribution of durations (in seconds) counted in cumulative buckets.
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        Metric.__init__(self, name, help, labelnames)
+
+    def _create_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def child_samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative_count = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative_count += count
+            samples.append(('_bucket', {'le': format_value(float(bound))}, cumulative_count))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, cumulative_count))
+        return samples
+
+
+class MetricsRegistry(object):
+    # Set of metrics exposed in the Prometheus text format.
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=(), function=None):
+        return self.register(Counter(name, help, labelnames, function))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self.register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def expose(self):
+        return ''.join(metric.expose() for metric in self.metrics)
+
+
+class ServerMetrics(MetricsRegistry):
+    # Metrics of the chat server (see BaseApi.metrics and the /metrics route).
+
+    def __init__(self, api):
+        MetricsRegistry.__init__(self)
+        self.join = self.histogram('chat_join_seconds', "Duration of the join requests.")
+        self.pairing_wait = self.histogram('chat_pairing_wait_seconds', "Time spent by the initiators of the chatrooms waiting for a partner.")
+        self.polls = self.counter('chat_polls_total', "Number of poll requests by result (changed, expired or gone).", ['result'])
+        self.poll_park = self.histogram('chat_poll_park_seconds', "Time spent by the poll requests parked waiting for a change.")
+        self.poll_wakeup = self.histogram('chat_poll_wakeup_seconds', "Delay between a change of a chatroom and the wakeup of its parked poll requests.")
+        self.post = self.histogram('chat_post_seconds', "Duration of the post requests.")
+        self.cleaner_pause = self.histogram('chat_cleaner_pause_seconds', "Duration of the cleanings of the inactive users.")
+        self.gauge('chat_active_chatrooms', "Number of active chatrooms.", function=lambda: len(api.chatrooms))
+        self.gauge('chat_released_chatrooms', "Number of released chatrooms kept by the server.", function=lambda: len(api.released_chatrooms))
+        self.gauge('chat_waiting_chatrooms', "Number of chatrooms waiting for a partner.", function=lambda: len(api.waiting_rooms))
+        self.gauge('chat_archive_queue_depth', "Number of dialogs waiting to be archived.", function=lambda: api.archiver.queue.qsize())
+        self.counter('chat_archived_dialogs_total', "Number of archived dialogs.", function=lambda: api.archiver.stats()['written'])
+        self.counter('chat_archive_failures_total', "Number of dialogs that could not be archived.", function=lambda: api.archiver.stats()['failed'])
@@ -0,0 +1,407 @@
+import pickle
+import threading
+import time
+import uuid
+
+from server.base import StateStore, get_session_id
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# State store sharing the chatrooms, the waiting rooms and the sessions between several processes
+# (for instance, the workers of a server or several nodes behind a load balancer) through a Redis server.
+#
+# The chatrooms are pickled in {prefix}:chatroom:<id> and their ids are kept in the {prefix}:chatrooms
+# and {prefix}:released_chatrooms sets.  Each process keeps its own copy of the active chatrooms
+# that it uses so that the parked polls can wait on their condition as usual.  The copy is reloaded
+# each time the lock of the chatroom is acquired and it is saved when the lock is released.
+# When a chatroom changes, its id is published on the {prefix}:changes channel so that the other
+# processes reload their copy and wake up their parked polls.
+class RedisStateStore(StateStore):
+
+    shared = True
+
+    def __init__(self, cfg, logger, client=None):
+        if redis is None:
+            raise ImportError("The redis package is required to use the redis state store.")
+        self.cfg = cfg
+        self.logger = logger
+        self.client = client if client is not None else redis.Redis.from_url(cfg.get('state_store_url', 'redis://localhost:6379/0'))
+        self.prefix = cfg.get('state_store_prefix', 'ChatCollectionServer')
+        self.lock_timeout_ms = int(cfg.get('state_store_lock_timeout', 30) * 1000)
+        # Identifies the notifications sent by this process.
+        self.node_id = uuid.uuid4().hex
+
+        self.chatrooms = RedisChatroomRegistry(self, 'chatrooms', cached=True)
+        self.released_chatrooms = RedisChatroomRegistry(self, 'released_chatrooms', cached=False)
+        self.waiting_rooms = RedisWaitingRooms(self)
+        self.session_index = RedisSessionIndex(self)
+        self.pairing_lock = RedisLock(self, self.key('lock', 'pairing'), threading.Lock())
+
+        # Depth of the chatroom locks held by the current thread, by chatroom id.
+        self.held = threading.local()
+
+        self.channel = self.key('changes')
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.channel)
+        self.stopped = threading.Event()
+        self.listener = threading.Thread(target=self._listen, name='RedisStateStore', daemon=True)
+        self.listener.start()
+
+    def key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def lock(self, chatroom):
+        return RedisChatroomLock(self, chatroom)
+
+    def close(self):
+        if self.listener.is_alive():
+            self.stopped.set()
+            # Wake up the listener.  The other processes ignore this notification.
+            self.client.publish(self.channel, f"{self.node_id} ")
+            self.listener.join()
+        self.pubsub.close()
+
+    def acquire_key(self, key):
+        # Spins until the key can be set.  The key expires in case the process holding it dies.
+        token = uuid.uuid4().hex.encode('ascii')
+        delay = 0.0005
+        while not self.client.set(key, token, nx=True, px=self.lock_timeout_ms):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        return token
+
+    def release_key(self, key, token, chatroom=None, notify=False):
+        # Deletes the key if it is still held with the token.
+        # The chatroom is saved (and the change is published) in the same transaction.
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != token:
+                    pipe.unwatch()
+                    self.logger.warning("The lock %s has expired before being released.", key)
+                    if chatroom is not None:
+                        self.save(chatroom, notify)
+                    return
+                pipe.multi()
+                if chatroom is not None:
+                    self._save(pipe, chatroom, notify)
+                pipe.delete(key)
+                pipe.execute()
+            except redis.WatchError:
+                self.logger.warning("The lock %s has expired before being released.", key)
+
+    def save(self, chatroom, notify=False):
+        with self.client.pipeline() as pipe:
+            self._save(pipe, chatroom, notify)
+            pipe.execute()
+
+    def _save(self, pipe, chatroom, notify):
+        pipe.set(self.key('chatroom', chatroom.id), pickle.dumps(chatroom))
+        if notify:
+            pipe.publish(self.channel, f"{self.node_id} {chatroom.id}")
+
+    def load(self, chatroom_id):
+        data = self.client.get(self.key('chatroom', chatroom_id))
+        return pickle.loads(data) if data is not None else None
+
+    def refresh(self, chatroom):
+        # Reloads the copy of the chatroom.  The lock of the chatroom must be held.
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self.key('chatroom', chatroom.id))
+            pipe.sismember(self.chatrooms.ids_key, chatroom.id)
+            data, is_active = pipe.execute()
+        if data is not None:
+            chatroom.update_state(pickle.loads(data).__getstate__())
+        if not is_active:
+            # The chatroom has been released by another process.
+            self.chatrooms.uncache(chatroom.id)
+
+    def _listen(self):
+        while not self.stopped.is_set():
+            try:
+                message = self.pubsub.get_message(timeout=1.0)
+                if message is None or message['type'] != 'message':
+                    continue
+                node_id, chatroom_id = message['data'].decode('utf-8').split(' ', 1)
+                if node_id != self.node_id:
+                    self._on_change(chatroom_id)
+            except Exception as exception:
+                if not self.stopped.is_set():
+                    self.logger.error("An exception occurred in the RedisStateStore listener: %s", exception)
+                    self.stopped.wait(1.0)
+
+    def _on_change(self, chatroom_id):
+        # Wakes up the polls of this process that are waiting for the chatroom.
+        chatroom = self.chatrooms.cache.get(chatroom_id)
+        if chatroom is None:
+            return
+        with chatroom.lock:
+            self.refresh(chatroom)
+            chatroom.notify_change()
+
+
+class RedisLock(object):
+    # Lock shared by all the processes.  The threads of a process first compete for the local lock.
+
+    def __init__(self, store, key, local_lock):
+        self.store = store
+        self.key = key
+        self.local_lock = local_lock
+        self.token = None
+
+    def acquire(self):
+        self.local_lock.acquire()
+        try:
+            self.token = self.store.acquire_key(self.key)
+        except:
+            self.local_lock.release()
+            raise
+        return True
+
+    def release(self):
+        token, self.token = self.token, None
+        try:
+            self.store.release_key(self.key, token)
+        finally:
+            self.local_lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RedisChatroomLock(object):
+    # Lock of a chatroom shared by all the processes.
+    # The local lock is the condition of the chatroom so that the local polls can wait on it.
+    # The lock is reentrant for the thread holding it.
+
+    def __init__(self, store, chatroom):
+        self.store = store
+        self.chatroom = chatroom
+        self.key = store.key('lock', 'chatroom', chatroom.id)
+
+    def _held(self):
+        if not hasattr(self.store.held, 'locks'):
+            self.store.held.locks = {}
+        return self.store.held.locks
+
+    def acquire(self):
+        held = self._held()
+        self.chatroom.lock.acquire()
+        if self.chatroom.id in held:
+            token, depth, version = held[self.chatroom.id]
+            held[self.chatroom.id] = (token, depth + 1, version)
+            return True
+        try:
+            token = self.store.acquire_key(self.key)
+            self.store.refresh(self.chatroom)
+        except:
+            self.chatroom.lock.release()
+            raise
+        held[self.chatroom.id] = (token, 1, self.chatroom.version)
+        return True
+
+    def release(self):
+        held = self._held()
+        token, depth, version = held[self.chatroom.id]
+        try:
+            if depth > 1:
+                held[self.chatroom.id] = (token, depth - 1, version)
+                return
+            del held[self.chatroom.id]
+            # The poll timestamps may have changed so the chatroom is always saved.
+            # The other processes are only notified of the actual changes.
+            self.store.release_key(self.key, token, self.chatroom, notify=self.chatroom.version != version)
+        finally:
+            self.chatroom.lock.release()
+
+    def wait(self, timeout=None):
+        # Releases the lock until the chatroom changes in this process or in another one.
+        held = self._held()
+        token, depth, version = held.pop(self.chatroom.id)
+        self.store.release_key(self.key, token, self.chatroom, notify=self.chatroom.version != version)
+        try:
+            return self.chatroom.lock.wait(timeout)
+        finally:
+            token = self.store.acquire_key(self.key)
+            self.store.refresh(self.chatroom)
+            held[self.chatroom.id] = (token, depth, self.chatroom.version)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RedisChatroomRegistry(object):
+    # Registry of the chatrooms (see ChatroomRegistry) stored in Redis.
+    # When cached is True, the process keeps a copy of the chatrooms that it has used.
+
+    def __init__(self, store, name, cached):
+        self.store = store
+        self.client = store.client
+        self.ids_key = store.key(name)
+        self.cached = cached
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+    def __len__(self):
+        return self.client.scard(self.ids_key)
+
+    def __contains__(self, chatroom_id):
+        return chatroom_id in self.cache or self.client.sismember(self.ids_key, chatroom_id)
+
+    def __getitem__(self, chatroom_id):
+        chatroom = self.get(chatroom_id)
+        if chatroom is None:
+            raise KeyError(chatroom_id)
+        return chatroom
+
+    def get(self, chatroom_id, default=None):
+        chatroom = self.cache.get(chatroom_id)
+        if chatroom is not None:
+            return chatroom
+        if not self.client.sismember(self.ids_key, chatroom_id):
+            return default
+        chatroom = self.store.load(chatroom_id)
+        if chatroom is None:
+            return default
+        if self.cached:
+            with self.cache_lock:
+                chatroom = self.cache.setdefault(chatroom_id, chatroom)
+        return chatroom
+
+    def add(self, chatroom):
+        with self.client.pipeline() as pipe:
+            pipe.set(self.store.key('chatroom', chatroom.id), pickle.dumps(chatroom))
+            pipe.sadd(self.ids_key, chatroom.id)
+            pipe.execute()
+        if self.cached:
+            with self.cache_lock:
+                self.cache[chatroom.id] = chatroom
+
+    def pop(self, chatroom_id, default=None):
+        self.client.srem(self.ids_key, chatroom_id)
+        chatroom = self.uncache(chatroom_id)
+        return chatroom if chatroom is not None else default
+
+    def uncache(self, chatroom_id):
+        with self.cache_lock:
+            return self.cache.pop(chatroom_id, None)
+
+    def values(self):
+        # Returns a snapshot of the chatrooms loaded from Redis.
+        chatroom_ids = sorted(chatroom_id.decode('utf-8') for chatroom_id in self.client.smembers(self.ids_key))
+        chatrooms = [self.store.load(chatroom_id) for chatroom_id in chatroom_ids]
+        return [chatroom for chatroom in chatrooms if chatroom is not None]
+
+
+class RedisWaitingRooms(object):
+    # Waiting rooms (see WaitingRooms) stored in Redis.
+    # For each matching key, the ids of the chatrooms are kept in a list in the order they were created.
+    # The pairing lock must be held by the caller.
+
+    def __init__(self, store):
+        self.store = store
+        self.client = store.client
+        self.keys_key = store.key('waiting_keys')
+
+    def _bucket_key(self, key):
+        return self.store.key('waiting', repr(key))
+
+    def __len__(self):
+        return self.client.hlen(self.keys_key)
+
+    def __contains__(self, chatroom_id):
+        return self.client.hexists(self.keys_key, chatroom_id)
+
+    def add(self, chatroom, key=None):
+        with self.client.pipeline() as pipe:
+            pipe.rpush(self._bucket_key(key), chatroom.id)
+            pipe.hset(self.keys_key, chatroom.id, repr(key))
+            pipe.execute()
+
+    def remove(self, chatroom_id):
+        bucket_key = self.client.hget(self.keys_key, chatroom_id)
+        if bucket_key is None:
+            return
+        with self.client.pipeline() as pipe:
+            pipe.lrem(self.store.key('waiting', bucket_key.decode('utf-8')), 0, chatroom_id)
+            pipe.hdel(self.keys_key, chatroom_id)
+            pipe.execute()
+
+    def find(self, user):
+        # Returns the oldest chatroom whose user can be matched with the given user or None.
+        # The copies of the chatrooms might be outdated but they are checked again under their lock by join().
+        for chatroom_id in self.client.lrange(self._bucket_key(user.matching_key()), 0, -1):
+            chatroom_id = chatroom_id.decode('utf-8')
+            chatroom = self.store.chatrooms.get(chatroom_id)
+            if chatroom is None:
+                self.remove(chatroom_id)
+                continue
+            if len(chatroom.users) == 1 and not chatroom.closed and \
+                    user.id not in chatroom.users and user.has_matching_attribs(chatroom.users[0]):
+                return chatroom
+        return None
+
+
+class RedisSessionIndex(object):
+    # Index of the active users organized by session ids (see SessionIndex) stored in Redis.
+    # The {prefix}:session:<session_id> set contains the user ids (one per tab) of a session and
+    # the {prefix}:tab:<user_id> set contains the chatrooms of a user.  Empty sets are deleted by Redis.
+
+    def __init__(self, store):
+        self.store = store
+        self.client = store.client
+
+    def __len__(self):
+        return len(self._session_ids())
+
+    def __contains__(self, session_id):
+        return self.client.exists(self.store.key('session', session_id)) > 0
+
+    def add(self, user_id, chatroom_id):
+        with self.client.pipeline() as pipe:
+            pipe.sadd(self.store.key('tab', user_id), chatroom_id)
+            pipe.sadd(self.store.key('session', get_session_id(user_id)), user_id)
+            pipe.execute()
+
+    def remove(self, user_id, chatroom_id):
+        tab_key = self.store.key('tab', user_id)
+        session_key = self.store.key('session', get_session_id(user_id))
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    # The user is removed from the session only if he has no chatroom left.
+                    pipe.watch(tab_key)
+                    tab_is_empty = pipe.smembers(tab_key) <= {chatroom_id.encode('utf-8')}
+                    pipe.multi()
+                    pipe.srem(tab_key, chatroom_id)
+                    if tab_is_empty:
+                        pipe.srem(session_key, user_id)
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def tabs(self, session_id):
+        user_ids = sorted(user_id.decode('utf-8') for user_id in self.client.smembers(self.store.key('session', session_id)))
+        return {user_id: sorted(chatroom_id.decode('utf-8') for chatroom_id in self.client.smembers(self.store.key('tab', user_id)))
+                for user_id in user_ids}
+
+    def to_dict(self):
+        return {session_id: self.tabs(session_id) for session_id in self._session_ids()}
+
+    def page(self, offset, limit):
+        return {session_id: self.tabs(session_id) for session_id in self._session_ids()[offset:offset + limit]}
+
+    def _session_ids(self):
+        session_prefix = self.store.key('session', '')
+        return sorted(key.decode('utf-8')[len(session_prefix):] for key in self.client.scan_iter(match=f"{session_prefix}*"))
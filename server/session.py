@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, URLSafeSerializer
+import secrets
+import threading
+import time
+from werkzeug.datastructures import CallbackDict
+
+
+class MemorySession(CallbackDict, SessionMixin):
+    # Session kept by a MemorySessionInterface.  Like the sessions of Flask-Session, it has a sid.
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class MemorySessionInterface(SessionInterface):
+    # Keeps the sessions in memory instead of files so that opening the session of a request
+    # (for instance, a poll) is a dictionary lookup.
+    # A session that has not been used for timeout seconds is forgotten.  The sessions are ordered
+    # by last use so that the expired ones are always at the front.
+    # The sessions are lost when the server stops, like the chatrooms of the memory state store.
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            now = time.monotonic()
+            with self.lock:
+                self._evict(now)
+                entry = self.sessions.get(sid)
+                if entry is not None:
+                    entry[1] = now + self.timeout
+                    self.sessions.move_to_end(sid)
+                    return MemorySession(entry[0], sid=sid)
+        # A new session id is generated for an unknown or expired session.
+        return MemorySession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                with self.lock:
+                    self.sessions.pop(session.sid, None)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        with self.lock:
+            self.sessions[session.sid] = [dict(session), time.monotonic() + self.timeout]
+            self.sessions.move_to_end(session.sid)
+        if session.new:
+            response.set_cookie(name, session.sid, domain=domain, path=path,
+                                httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+    def _evict(self, now):
+        # The lock must be held by the caller.
+        while len(self.sessions) > 0:
+            sid, entry = next(iter(self.sessions.items()))
+            if entry[1] > now:
+                return
+            del self.sessions[sid]
+
+
+class TabTokenSessionInterface(SessionInterface):
+    # Does not open the session of the requests identified by a tab token (see TabTokens)
+    # so that the polls, the posts and the leaves never read the session store.
+    # The other requests use the sessions of interface.
+
+    def __init__(self, interface):
+        self.interface = interface
+
+    def open_session(self, app, request):
+        if request.values.get('token'):
+            return self.make_null_session(app)
+        return self.interface.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        self.interface.save_session(app, session, response)
+
+
+class TabTokens(object):
+    # Signed tokens carrying the user id of a tab.  A token is issued by the join request and sent back
+    # by the client with its following requests so that the server identifies the user without its session.
+    # The tokens are stateless: any server process sharing the secret key can verify them.
+
+    def __init__(self, secret_key):
+        self.serializer = URLSafeSerializer(secret_key, salt='tab-token')
+
+    def issue(self, user_id):
+        return self.serializer.dumps(user_id)
+
+    def user_id(self, token):
+        # Returns None when the token is invalid.
+        try:
+            return self.serializer.loads(token)
+        except BadSignature:
+            return None
@@ -15,14 +15,30 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=[
         'flask-session',
-        'pytz',
-        'python-dateutil'
+        'pytz'
     ],
     extras_require={
         'tests': [
             'pytest',
             'psutil',
-            'bs4'
+            'bs4',
+            'fakeredis'
+        ],
+        'asgi': [
+            'asgiref',
+            'uvicorn'
+        ],
+        'parquet': [
+            'pyarrow'
+        ],
+        'fast_json': [
+            'orjson'
+        ],
+        'redis': [
+            'redis'
+        ],
+        'compression': [
+            'brotli'
         ]
     },
     data_files=[
@@ -7,8 +7,24 @@ console.log('Loading default_chat.js...');
 var isTooShortDialogShown = false;
 var isTooLongDialogShown = false;
 
+// Events waiting to be posted.  The events added while a post is in progress are sent together by the next one.
+var pendingEvents = [];
+var isPosting = false;
+// Batch whose post has not been acknowledged yet.  After a failure, it is sent again as is, with the same id,
+// so that the server adds it only once even if the failed request had reached it.
+var unconfirmedBatch = null;
+// The ids of the batches are unique for the page: a reloaded page starts again with another prefix.
+var batchIdPrefix = Math.random().toString(36).slice(2);
+var batchCount = 0;
+// Delay (in ms) before a failed post is sent again.
+var postRetryDelay = 1000;
+
 var chatroomTimestamp = null;
 
+// Sequence number of the last event received from the server.
+// Only the events that are more recent are sent back by the server.
+var lastEventSeq = 0;
+
 var confirmBeforeStopChat = true;            
 var needsLeavingChatroom = true;
 
@@ -18,6 +34,11 @@ var isLeaving = false;
 var stopChatConfirmed = false;
 var events = [];
 var pollXhr = null;
+// Stream of server-sent events used instead of the poll requests when the server pushes the updates.
+var eventSource = null;
+var usesEventSource = (typeof PUSH_TRANSPORT !== 'undefined' && PUSH_TRANSPORT == 'sse' && !!window.EventSource);
+// Signed token identifying the tab when the server issues tab tokens (empty otherwise).
+var TAB_TOKEN = (typeof tabToken !== 'undefined') ? tabToken : '';
 var dialog = null;
 var waitStartTime = null;
 var waitingInterval = null;
@@ -66,12 +87,24 @@ function updateModel(data) {
         console.log('data is null!');
         return;
     }
-    chatroomTimestamp = data.modified;
+    // The version of the chatroom is sent back with the next poll (a custom chatroom.json template might only provide the modification time).
+    chatroomTimestamp = data.version !== undefined ? data.version : data.modified;
     var latestEvents = data.latestEvents;
     if (!latestEvents) {
         console.log('latestEvents is null!');
         return;
     }
+    if ('lastSeq' in data) {
+        // The server has sent only the events following lastEventSeq.
+        for (var i = 0; i < latestEvents.length; i++) {
+            if (latestEvents[i].seq > lastEventSeq) {
+                events.push(latestEvents[i]);
+                lastEventSeq = latestEvents[i].seq;
+            }
+        }
+        updateProgress(data);
+        return;
+    }
     for (var i = 0, j = 0; i < latestEvents.length; i++) {
         while (j < events.length && events[j].timestamp < latestEvents[i].timestamp) 
             j++;
@@ -188,17 +221,80 @@ function stopDialog() {
     isDialogOver = true;
 }
 
+// The chatroom is sent as a JSON object by default
+// or as a JSON string when the chatroom.json template is used.
+function parseChatroom(result) {
+    return (typeof result === 'string' ? JSON.parse(result) : result);
+}
+
+// Updates the page with the chatroom sent by the server.
+function handleChatroom(data) {
+    var needsPolling = true;
+    if (data.users.length > 1) {
+        if (!isDialogStarted)
+            startDialog();
+    }
+    else {
+        console.log('data.closed='+data.closed+ ' stopChatConfirmed='+stopChatConfirmed);
+        if (data.closed) {
+            isLeaving = true;
+            $('#message-waiting').hide();
+            $('#notification').css({visibility: 'hidden'});
+            $('#controls').hide();
+            $('#chatbox').removeClass('shadowed');
+            var mainBoxHeight = $('#main-box').css('height');
+            $('#main-box').css('height', 'calc(' + mainBoxHeight + ' - ' + mainBoxMargin + ')');
+            if (!stopChatConfirmed) {
+                $('#stop-chat').hide();
+                $('#message-chat-over').show();
+                $('#chatroom-infobox').show();
+                $('#first-user-left-panel input').attr('disabled', true);
+                //if ($('#table-movie-selector').is(':visible'))
+                //    $('#console').hide();
+                $('#notification').hide();
+                $('#messages').prop('scrollTop', 1000000);
+            }
+            // Show the chatbox in the case where the page is reloaded
+            // when the conversation is over.
+            $('#chatbox-wrapper').show();
+            // Leave the chatroom immediately.
+            $.ajax({
+                url: "leave",
+                data: {
+                    clientTabId: clientTabId,
+                    token: TAB_TOKEN,
+                    chatroom: chatroomId,
+                    call: 1
+                },
+                success: function(data) {
+                    needsPolling = false;
+                    stopListening();
+                }
+            });
+        }
+    }
+    
+    updateModel(data);
+    updateView();
+    if (!isTooLongDialogShown && getMessageCountFor('self') >= MSG_COUNT_HIGH && getMessageCountFor('other') >= MSG_COUNT_HIGH) {
+        showSimpleDialog('注意', '対話が十分な長さになりました。数回のやり取りで自然な形で対話を終了させて下さい。');
+        isTooLongDialogShown = true;
+    }
+}
+
 function pollServer() {
     pollXhr = $.ajax({
         url: "chatroom",
         data: {
             clientTabId: clientTabId,
+            token: TAB_TOKEN,
             id: chatroomId,
-            timestamp: chatroomTimestamp
+            timestamp: chatroomTimestamp,
+            lastSeq: lastEventSeq
         },
         timeout: timeoutInMs,
         success: function(result) {
-            var data = JSON.parse(result);
+            var data = parseChatroom(result);
             console.dir(data);
             // In the case that the polling request is done just after that the chatroom has been
             // deallocated on the server, the result might be empty so just ignore it.
@@ -208,7 +304,6 @@ function pollServer() {
             // if ('chosenTopic' in data)
             //     $('.topic').text(data['chosenTopic']);
 
-            var needsPolling = true;
             if ('msg' in data && data.msg == "poll expired") {
                 // The poll request has expired and has not produced anything.
                 // Let's poll again.
@@ -216,55 +311,8 @@ function pollServer() {
                     pollServer();
                 return;
             }
-            else if (data.users.length > 1) {
-                if (!isDialogStarted)
-                    startDialog();
-            }
-            else {
-                console.log('data.closed='+data.closed+ ' stopChatConfirmed='+stopChatConfirmed);
-                if (data.closed) {
-                    isLeaving = true;
-                    $('#message-waiting').hide();
-                    $('#notification').css({visibility: 'hidden'});
-                    $('#controls').hide();
-                    $('#chatbox').removeClass('shadowed');
-                    var mainBoxHeight = $('#main-box').css('height');
-                    $('#main-box').css('height', 'calc(' + mainBoxHeight + ' - ' + mainBoxMargin + ')');
-                    if (!stopChatConfirmed) {
-                        $('#stop-chat').hide();
-                        $('#message-chat-over').show();
-                        $('#chatroom-infobox').show();
-                        $('#first-user-left-panel input').attr('disabled', true);
-                        //if ($('#table-movie-selector').is(':visible'))
-                        //    $('#console').hide();
-                        $('#notification').hide();
-                        $('#messages').prop('scrollTop', 1000000);
-                    }
-                    // Show the chatbox in the case where the page is reloaded
-                    // when the conversation is over.
-                    $('#chatbox-wrapper').show();
-                    // Leave the chatroom immediately.
-                    $.ajax({
-                        url: "leave",
-                        data: {
-                            clientTabId: clientTabId,
-                            chatroom: chatroomId,
-                            call: 1
-                        },
-                        success: function(data) {
-                            needsPolling = false;
-                            if (pollXhr != null) {
-                                pollXhr.abort();
-                                pollXhr = null;
-                            }
-                        }
-                    });
-                }
-            }
-            
-            updateModel(data);
-            updateView();
-        
+            handleChatroom(data);
+
             if (!isLeaving)
                 pollServer();
         },
@@ -277,48 +325,139 @@ function pollServer() {
     });
 }
 
+// Receives the updates of the chatroom from the stream of server-sent events when the server pushes them
+// or from poll requests otherwise.  The poll requests are also used when the stream cannot be opened.
+function listenServer() {
+    if (!usesEventSource) {
+        pollServer();
+        return;
+    }
+    if (eventSource != null)
+        return;
+    var isOpen = false;
+    var source = new EventSource('events?' + $.param({
+        clientTabId: clientTabId,
+        token: TAB_TOKEN,
+        id: chatroomId,
+        timestamp: chatroomTimestamp,
+        lastSeq: lastEventSeq
+    }));
+    source.onopen = function() {
+        isOpen = true;
+    };
+    source.onmessage = function(e) {
+        var data = parseChatroom(JSON.parse(e.data));
+        console.dir(data);
+        // The chatroom has been deallocated on the server.
+        if (jQuery.isEmptyObject(data)) {
+            stopListening();
+            return;
+        }
+        handleChatroom(data);
+        if (isLeaving)
+            stopListening();
+    };
+    source.onerror = function() {
+        // Once the stream has been opened, the browser reconnects by itself.
+        if (!isOpen || source.readyState == EventSource.CLOSED) {
+            console.log('The event stream is not available. Falling back to poll requests.');
+            source.close();
+            if (eventSource == source)
+                eventSource = null;
+            usesEventSource = false;
+            if (!isLeaving)
+                pollServer();
+        }
+    };
+    eventSource = source;
+}
+
+function stopListening() {
+    if (pollXhr != null) {
+        pollXhr.abort();
+        pollXhr = null;
+    }
+    if (eventSource != null) {
+        eventSource.close();
+        eventSource = null;
+    }
+}
+
 function sendMsg() {
     var msg = $('#new-msg').val().trim();
     // Ignore empty message.
     if (msg == '')
         return;
     
-    if (events.length > 0 && events[events.length - 1].from == 'self' && events[events.length - 1].type == 'msg') {
+    // The messages sent while a post is in progress are queued and posted together by the next one.
+    var isLastMsgFromSelf = (events.length > 0 && events[events.length - 1].from == 'self' && events[events.length - 1].type == 'msg');
+    if (isLastMsgFromSelf) {
         showSimpleDialog('注意', '相手の返信を待ってからメッセージを送信してください。');
         return;
     }
 
     $('#new-msg').val('');
+    $('#notification').css({visibility: 'visible'});
+    postEvent('msg', msg);
+};
+
+// Posts an event of the given type (see evt_type on the server) on behalf of the user.
+// The events are sent by batches: the ones posted while a request is in progress are sent together by the next one.
+// The server only acknowledges them: they are received back, like the events of the partner, by the next poll.
+function postEvent(type, body) {
+    pendingEvents.push({type: type, body: body});
+    flushEvents();
+}
+
+function flushEvents() {
+    if (isPosting || (unconfirmedBatch == null && pendingEvents.length == 0))
+        return;
+    if (unconfirmedBatch == null) {
+        batchCount++;
+        unconfirmedBatch = {id: batchIdPrefix + '-' + batchCount, events: pendingEvents};
+        pendingEvents = [];
+    }
+    var batch = unconfirmedBatch;
+    isPosting = true;
+    // The poll is sent again once the events are added so that it returns them immediately.
     if (pollXhr != null) {
         pollXhr.abort();
         pollXhr = null;
     }
-    $('#notification').css({visibility: 'visible'});
     $.ajax({
-        url: "post",
+        url: "post_events",
         data: {
             clientTabId: clientTabId,
+            token: TAB_TOKEN,
             chatroom: chatroomId,
-            message: msg
+            batchId: batch.id,
+            events: JSON.stringify(batch.events)
         },
         type: 'POST',
         success: function(result) {
-            var data = JSON.parse(result);
-            console.dir(data);
-            updateModel(data);
-            updateView();
-            $('#messages').prop('scrollTop', 1000000);
+            isPosting = false;
+            unconfirmedBatch = null;
             $('#send').attr('disabled', false);
             if (dialog == null)
                 $('#new-msg').attr('disabled', false).focus();
-            if (!isTooLongDialogShown && getMessageCountFor('self') >= MSG_COUNT_HIGH && getMessageCountFor('other') >= MSG_COUNT_HIGH) {
-                showSimpleDialog('注意', '対話が十分な長さになりました。数回のやり取りで自然な形で対話を終了させて下さい。');
-                isTooLongDialogShown = true;
+            if (!isLeaving)
+                listenServer();
+            flushEvents();
+        },
+        error: function(xhr, status, msg) {
+            console.log('error xhr='+xhr+' status='+status+' msg='+msg);
+            isPosting = false;
+            // The batch is sent again, before the events posted in the meantime, unless the server has rejected it as invalid.
+            if (xhr.status == 400)
+                unconfirmedBatch = null;
+            $('#send').attr('disabled', false);
+            if (!isLeaving) {
+                listenServer();
+                setTimeout(flushEvents, postRetryDelay);
             }
-            pollServer();
         }
     });
-};
+}
 
 function stopChat() {
     if (!confirmBeforeStopChat) {
@@ -330,14 +469,12 @@ function stopChat() {
                 url: "leave",
                 data: {
                     clientTabId: clientTabId,
+                    token: TAB_TOKEN,
                     chatroom: chatroomId,
                     call: 3
                 },
                 success: function(result) {
-                    if (pollXhr != null) {
-                        pollXhr.abort();
-                        pollXhr = null;
-                    }
+                    stopListening();
                     stopDialog();
                 }
             });
@@ -381,14 +518,12 @@ function stopChat() {
                     url: "leave",
                     data: {
                         clientTabId: clientTabId,
+                        token: TAB_TOKEN,
                         chatroom: chatroomId,
                         call: 4
                     },
                     success: function(result) {
-                        if (pollXhr != null) {
-                            pollXhr.abort();
-                            pollXhr = null;
-                        }
+                        stopListening();
                         $('#controls').hide();
                         if (isDialogStarted) {
                             $('#chatroom-infobox').show();
@@ -428,16 +563,14 @@ function updateWaitingTimer() {
         $('#message-try-later').show("slow");
         $('#stop-chat').hide();
         needsPolling = false;
-        if (pollXhr != null) {
-            pollXhr.abort();
-            pollXhr = null;
-        }
+        stopListening();
         confirmBeforeStopChat = false;
         // Leave the chatroom immediately.
         $.ajax({
             url: "leave",
             data: {
                 clientTabId: clientTabId,
+                token: TAB_TOKEN,
                 chatroom: chatroomId,
                 call: 2
             },
@@ -484,7 +617,7 @@ $(document).ready(function() {
     else if (!isFirstUser)
         startDialog();
 
-    pollServer();
+    listenServer();
 });
 
 console.log('default_chat.js loaded.');
@@ -0,0 +1,985 @@
+import asyncio
+import gzip
+import jinja2
+import json
+import logging
+from pathlib import Path
+import pickle
+import pytest
+import re
+import threading
+import time
+from urllib.parse import urlencode
+
+from server.archive import JsonlArchiveBackend, read_segments, records_to_columns
+from server.assets import StaticAssets
+from server.base import BaseApi, BaseApp, BaseChatroom, BaseUser, ChatroomRegistry, ChatroomSummary, events_for_user, parse_version, PollStats, ReleasedChatrooms, utc_to_epoch
+from server.journal import EventJournal
+
+
+def make_cfg(tmp_path, **overrides):
+    cfg = {
+        "archives": str(tmp_path / "dialogs"),
+        "poll_interval": 5,
+        "delay_for_partner": 60,
+        "chatroom_cleaning_interval": 3600,
+        "msg_count_low": 5,
+        "msg_count_high": 15,
+        "experiment_id": 123
+    }
+    cfg.update(overrides)
+    return cfg
+
+
+@pytest.fixture
+def make_api(tmp_path):
+    # Creates Api instances with the settings of the test.  They are all shut down at the end of the test.
+    apis = []
+
+    def make_api(user_class=BaseUser, logger=None, **overrides):
+        api = BaseApi(make_cfg(tmp_path, **overrides), logger or logging.getLogger('test'), user_class=user_class)
+        apis.append(api)
+        return api
+
+    yield make_api
+    for api in apis:
+        api.shutdown()
+
+
+@pytest.fixture
+def api(make_api):
+    return make_api(prevent_multiple_tabs="True")
+
+
+@pytest.fixture
+def app(request, api, tmp_path):
+    # The settings of the app are given with @pytest.mark.cfg(...).
+    api.cfg.update({
+        "sessions": str(tmp_path / "sessions"),
+        "cookiePath": "/ChatCollectionServer",
+        "web_context": "ChatCollectionServer"
+    })
+    marker = request.node.get_closest_marker('cfg')
+    if marker is not None:
+        api.cfg.update(marker.kwargs)
+    app = BaseApp('test', api)
+    app.jinja_loader.loaders.append(jinja2.FileSystemLoader(Path(__file__).parent.parent / 'templates'))
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def join_page(client):
+    # Joins a chatroom from the client and returns the tab token given by the page.
+    page = client.post("/ChatCollectionServer/join", data={'clientTabId': '1'}).get_data(as_text=True)
+    return re.search(r"var tabToken = '(.+)';", page).group(1)
+
+
+def crash(api):
+    # Stops the server without writing the final snapshot of the journal.
+    api.journal.close()
+    api.journal = None
+    api.shutdown()
+
+
+def test_parked_poll_is_woken_up_by_post(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    timestamp = api.chatrooms[chatroom_id].modified
+
+    result = {}
+
+    def poll():
+        start = time.monotonic()
+        result['data'] = api.get_chatroom(chatroom_id, 'bbbb_1', timestamp)
+        result['delay'] = time.monotonic() - start
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    time.sleep(0.2)
+    api.post_message('aaaa_1', chatroom_id, 'Hello')
+    poller.join()
+
+    assert result['data'] is not None and result['data'] != "expired"
+    assert result['data']['chatroom'].events[-1]['body'] == 'Hello'
+    assert result['delay'] < 1.0
+
+
+def test_parked_poll_is_released_when_chatroom_is_released(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    timestamp = api.chatrooms[chatroom_id].modified
+
+    result = {}
+
+    def poll():
+        result['data'] = api.get_chatroom(chatroom_id, 'aaaa_1', timestamp)
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    time.sleep(0.2)
+    api.leave_chatroom('aaaa_1', chatroom_id)
+    poller.join(timeout=2)
+
+    assert not poller.is_alive()
+    assert result['data'] is None
+
+
+def test_events_since_returns_only_newer_events(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    for m in range(5):
+        api.post_message('aaaa_1' if m % 2 == 0 else 'bbbb_1', chatroom_id, f"Message {m}")
+
+    chatroom = api.chatrooms[chatroom_id]
+    assert chatroom.last_seq() == 5
+    assert [evt['seq'] for evt in chatroom.events] == [1, 2, 3, 4, 5]
+    assert [evt['body'] for evt in chatroom.events_since(3)] == ["Message 3", "Message 4"]
+    assert len(chatroom.events_since(None)) == 5
+    assert chatroom.events_since(5) == []
+
+
+def test_has_changed_compares_versions(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    chatroom = api.chatrooms[chatroom_id]
+    version = chatroom.version
+    legacy_timestamp = chatroom.modified
+
+    # Two changes in the same clock tick are still seen by the clients.
+    api.post_message('aaaa_1', chatroom_id, "Message 0")
+    chatroom.modified_at = utc_to_epoch(legacy_timestamp)
+    assert chatroom.version == version + 1
+    assert chatroom.has_changed(parse_version(str(version)))
+    assert not chatroom.has_changed(parse_version(str(chatroom.version)))
+    assert api.get_chatroom(chatroom_id, 'bbbb_1', parse_version(str(version)))['chatroom'].events[-1]['body'] == "Message 0"
+
+    # The clients sending the ISO modification time are still served.
+    assert parse_version(legacy_timestamp) == legacy_timestamp
+    assert not chatroom.has_changed(legacy_timestamp)
+    chatroom.modified_at += 1
+    assert chatroom.has_changed(legacy_timestamp)
+    assert parse_version('') is None
+
+
+def test_serialized_events_are_cached_per_user(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    api.post_message('aaaa_1', chatroom_id, "Message 0")
+
+    chatroom = api.chatrooms[chatroom_id]
+    assert [json.loads(evt)['from'] for evt in chatroom.serialized_events_since('aaaa_1', 0)] == ['self']
+    assert [json.loads(evt)['from'] for evt in chatroom.serialized_events_since('bbbb_1', 0)] == ['other']
+
+    # The cached events are appended when new events are added.
+    api.post_message('bbbb_1', chatroom_id, "Message 1")
+    assert chatroom.serialized_events_since('aaaa_1', 1) == chatroom.serialized_events['aaaa_1'][1:]
+    assert [json.loads(evt) for evt in chatroom.serialized_events_since('aaaa_1', 0)] == \
+        [events_for_user(evt, 'aaaa_1') for evt in chatroom.events]
+
+    api.leave_chatroom('bbbb_1', chatroom_id)
+    assert 'bbbb_1' not in chatroom.serialized_events
+
+
+def test_async_poll_is_woken_up_by_post(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    timestamp = api.chatrooms[chatroom_id].modified
+
+    async def poll_and_post():
+        poll = asyncio.ensure_future(api.get_chatroom_async(chatroom_id, 'bbbb_1', timestamp))
+        await asyncio.sleep(0.2)
+        assert not poll.done()
+        await asyncio.get_running_loop().run_in_executor(None, api.post_message, 'aaaa_1', chatroom_id, 'Hello')
+        return await asyncio.wait_for(poll, 1.0)
+
+    data = asyncio.run(poll_and_post())
+    assert data['chatroom'].events[-1]['body'] == 'Hello'
+    assert len(api.chatrooms[chatroom_id].listeners) == 0
+
+
+async def asgi_request(asgi_app, method, path, params, timeout=1):
+    # Sends a request to the ASGI application and returns the status and the body of its response.
+    from asgiref.testing import ApplicationCommunicator
+    body = urlencode(params).encode('ascii') if method == 'POST' else b''
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': b'' if method == 'POST' else urlencode(params).encode('ascii'),
+        'headers': [(b'content-type', b'application/x-www-form-urlencoded'), (b'content-length', str(len(body)).encode('ascii'))]
+    }
+    communicator = ApplicationCommunicator(asgi_app, scope)
+    await communicator.send_input({'type': 'http.request', 'body': body})
+    response_start = await communicator.receive_output(timeout)
+    response_body = b''
+    while True:
+        message = await communicator.receive_output(timeout)
+        response_body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    await communicator.wait(timeout)
+    return response_start['status'], response_body
+
+
+@pytest.mark.cfg(tab_tokens="True")
+def test_asgi_poll_is_woken_up_by_post(api, app):
+    pytest.importorskip('asgiref')
+    from server.asgi import AsgiApp
+    asgi_app = AsgiApp(app)
+    assert asgi_app.handles_polls and asgi_app.api_polls_async
+
+    async def join_post_and_poll():
+        tokens = []
+        for user in range(2):
+            status, page = await asgi_request(asgi_app, 'POST', "/ChatCollectionServer/join", {'clientTabId': '1'})
+            assert status == 200
+            tokens.append(re.search(r"var tabToken = '(.+)';", page.decode('utf8')).group(1))
+        chatroom = next(iter(api.chatrooms.values()))
+        assert len(chatroom.users) == 2
+
+        status, body = await asgi_request(asgi_app, 'POST', "/ChatCollectionServer/post",
+                                          {'clientTabId': '1', 'chatroom': chatroom.id, 'message': "Hello", 'token': tokens[0]})
+        assert status == 200
+        params = {'clientTabId': '1', 'id': chatroom.id, 'timestamp': '', 'token': tokens[1]}
+        status, body = await asgi_request(asgi_app, 'GET', "/ChatCollectionServer/chatroom", params)
+        data = json.loads(body)
+        assert [evt['body'] for evt in data['latestEvents']] == ["Hello"]
+
+        # The poll is parked without a thread until the partner posts a message.
+        params.update(timestamp=data['version'], lastSeq=data['lastSeq'])
+        poll = asyncio.ensure_future(asgi_request(asgi_app, 'GET', "/ChatCollectionServer/chatroom", params, timeout=2))
+        await asyncio.sleep(0.2)
+        assert not poll.done() and len(chatroom.listeners) == 1
+        start = time.monotonic()
+        status, body = await asgi_request(asgi_app, 'POST', "/ChatCollectionServer/post",
+                                          {'clientTabId': '1', 'chatroom': chatroom.id, 'message': "World", 'token': tokens[0]})
+        assert status == 200
+        status, body = await poll
+        assert time.monotonic() - start < 1.0
+        return status, json.loads(body)
+
+    status, data = asyncio.run(join_post_and_poll())
+    assert status == 200
+    assert [evt['body'] for evt in data['latestEvents']] == ["World"]
+    assert len(api.chatrooms[data['id']].listeners) == 0
+
+
+def test_join_pairs_users_by_matching_key(make_api):
+    class LanguageUser(BaseUser):
+
+        def matching_key(self):
+            return self.attribs.get('lang')
+
+    api = make_api(user_class=LanguageUser)
+    ja_1 = api.join('ja1_1', {'lang': 'ja'})['chatroom'].id
+    en_1 = api.join('en1_1', {'lang': 'en'})['chatroom'].id
+    assert ja_1 != en_1
+    assert len(api.waiting_rooms) == 2
+
+    assert api.join('en2_1', {'lang': 'en'})['chatroom'].id == en_1
+    assert api.join('ja2_1', {'lang': 'ja'})['chatroom'].id == ja_1
+    assert len(api.waiting_rooms) == 0
+
+    # A closed chatroom is not available anymore even if one of its users has left.
+    ja_3 = api.join('ja3_1', {'lang': 'ja'})['chatroom'].id
+    api.leave_chatroom('ja1_1', ja_1)
+    assert api.join('ja4_1', {'lang': 'ja'})['chatroom'].id == ja_3
+
+    # A chatroom whose user has left is not available anymore.
+    ja_5 = api.join('ja5_1', {'lang': 'ja'})['chatroom'].id
+    api.leave_chatroom('ja5_1', ja_5)
+    assert len(api.waiting_rooms) == 0
+    assert api.join('ja6_1', {'lang': 'ja'})['chatroom'].id != ja_5
+
+
+@pytest.mark.cfg(push_transport="sse")
+def test_chatroom_updates_are_streamed_as_server_sent_events(api, client):
+    with client.session_transaction() as sess:
+        sess['init'] = True
+        user_id = f"{sess.sid}_1"
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join(user_id)
+    api.post_message('aaaa_1', chatroom_id, "Message 0")
+
+    response = client.get(f"/ChatCollectionServer/events?clientTabId=1&id={chatroom_id}&timestamp=&lastSeq=0", buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    stream = iter(response.response)
+
+    def next_event():
+        event = next(stream)
+        assert event.startswith(b'data: ') and event.endswith(b'\n\n')
+        return json.loads(event[len(b'data: '):])
+
+    data = next_event()
+    assert [evt['body'] for evt in data['latestEvents']] == ["Message 0"]
+    assert data['lastSeq'] == 1
+
+    # Only the new events are sent.
+    api.post_message('aaaa_1', chatroom_id, "Message 1")
+    data = next_event()
+    assert [evt['body'] for evt in data['latestEvents']] == ["Message 1"]
+
+    api.leave_chatroom('aaaa_1', chatroom_id)
+    assert next_event()['users'] == [user_id]
+
+    # The stream ends once the user has left.
+    api.leave_chatroom(user_id, chatroom_id)
+    assert next_event() == {}
+    with pytest.raises(StopIteration):
+        next(stream)
+    response.close()
+
+
+def test_join_keeps_the_session(api, client):
+    response = client.post("/ChatCollectionServer/join", data={'clientTabId': '1'})
+    assert response.status_code == 200
+    chatroom = next(iter(api.chatrooms.values()))
+
+    # The following requests of the user are identified by the cookie of the session.
+    data = client.get(f"/ChatCollectionServer/chatroom?clientTabId=1&id={chatroom.id}&timestamp=").get_json()
+    assert data['id'] == chatroom.id
+    assert data['users'] == chatroom.users
+
+
+@pytest.mark.cfg(session_store="memory", sessionTimeout=30)
+def test_memory_sessions_expire(api, app, client):
+    assert client.post("/ChatCollectionServer/join", data={'clientTabId': '1'}).status_code == 200
+    chatroom = next(iter(api.chatrooms.values()))
+    poll_url = f"/ChatCollectionServer/chatroom?clientTabId=1&id={chatroom.id}&timestamp="
+    assert client.get(poll_url).get_json()['users'] == chatroom.users
+    assert len(app.session_interface) == 1
+
+    # The session is forgotten once it has not been used for sessionTimeout minutes.
+    for entry in app.session_interface.sessions.values():
+        entry[1] = time.monotonic() - 1
+    assert client.get(poll_url).get_json() == {}
+    assert len(app.session_interface) == 0
+
+
+@pytest.mark.cfg(tab_tokens="True")
+def test_tab_tokens_identify_the_users_without_their_session(api, app, client):
+    token = join_page(client)
+    chatroom = next(iter(api.chatrooms.values()))
+
+    # Another client without the session cookie is identified by the token.
+    client = app.test_client()
+    response = client.get(f"/ChatCollectionServer/chatroom?clientTabId=1&id={chatroom.id}&timestamp=&token={token}")
+    assert response.get_json()['users'] == chatroom.users
+    assert 'Set-Cookie' not in response.headers
+    assert client.post("/ChatCollectionServer/post", data={'clientTabId': '1', 'chatroom': chatroom.id,
+                                                          'message': "Hello", 'token': token}).status_code == 200
+    assert chatroom.events[-1]['body'] == "Hello"
+
+    # A forged token is rejected.
+    assert client.get(f"/ChatCollectionServer/leave?clientTabId=1&chatroom={chatroom.id}&token={token[:-2]}xx").status_code == 400
+    assert client.get(f"/ChatCollectionServer/leave?clientTabId=1&chatroom={chatroom.id}&token={token}").status_code == 200
+    assert len(chatroom.users) == 0
+
+
+@pytest.mark.cfg(tab_tokens="True")
+@pytest.mark.parametrize('chatroom_response_template', [False, True])
+def test_chatroom_response_version_matches_its_events(api, app, client, chatroom_response_template):
+    app.chatroom_response_template = chatroom_response_template
+    token = join_page(client)
+    chatroom = next(iter(api.chatrooms.values()))
+    api.join('bbbb_1')
+
+    # A message is posted by the partner right after the events of the response are read.
+    get_serialized_events = app._get_serialized_events
+    poster = threading.Thread(target=api.post_message, args=('bbbb_1', chatroom.id, "Hello"))
+
+    def get_serialized_events_then_post(*args):
+        result = get_serialized_events(*args)
+        poster.start()
+        poster.join(timeout=0.2)
+        return result
+
+    app._get_serialized_events = get_serialized_events_then_post
+    response = app.test_client().get(f"/ChatCollectionServer/chatroom?clientTabId=1&id={chatroom.id}&timestamp=&token={token}")
+    data = response.get_json()
+    if chatroom_response_template:
+        data = json.loads(data)
+    app._get_serialized_events = get_serialized_events
+    poster.join()
+
+    # The next poll returns the message immediately.
+    assert data['lastSeq'] == 0 and data['version'] < chatroom.version
+    start = time.monotonic()
+    response = app.test_client().get(f"/ChatCollectionServer/chatroom?clientTabId=1&id={chatroom.id}"
+                                     f"&timestamp={data['version']}&lastSeq={data['lastSeq']}&token={token}")
+    data = response.get_json()
+    if chatroom_response_template:
+        data = json.loads(data)
+    assert [evt['body'] for evt in data['latestEvents']] == ["Hello"]
+    assert time.monotonic() - start < 1.0
+
+
+def test_overridden_chatroom_response_keeps_its_signature(api, app):
+    class App(BaseApp):
+
+        def _get_chatroom_response(self, user_id, data):
+            return json.dumps({'users': data['chatroom'].users, 'lastSeq': data['last_seq']})
+
+    app = App('test', api)
+    app.jinja_loader.loaders.append(jinja2.FileSystemLoader(Path(__file__).parent.parent / 'templates'))
+    client = app.test_client()
+    assert client.post("/ChatCollectionServer/join", data={'clientTabId': '1'}).status_code == 200
+    chatroom = next(iter(api.chatrooms.values()))
+
+    response = client.get(f"/ChatCollectionServer/chatroom?clientTabId=1&id={chatroom.id}&timestamp=&lastSeq=0")
+    assert json.loads(response.get_json()) == {'users': chatroom.users, 'lastSeq': 0}
+
+
+@pytest.mark.cfg(tab_tokens="True", post_events_max=3)
+def test_posted_events_are_added_at_once(api, client):
+    token = join_page(client)
+    chatroom = next(iter(api.chatrooms.values()))
+    version = chatroom.version
+    notify_change = chatroom.notify_change
+    notifications = []
+    chatroom.notify_change = lambda: notifications.append(1) or notify_change()
+
+    params = {'clientTabId': '1', 'chatroom': chatroom.id, 'token': token}
+    events = [{'type': 'msg', 'body': "Hello"}, {'type': 'msg', 'body': "World"}]
+    response = client.post("/ChatCollectionServer/post_events", data=dict(params, events=json.dumps(events)))
+    assert response.get_json() == {'lastSeq': chatroom.last_seq(), 'version': version + 1}
+    assert [evt['body'] for evt in chatroom.events[-2:]] == ["Hello", "World"]
+    assert chatroom.events[-2]['timestamp'] == chatroom.events[-1]['timestamp']
+    assert len(notifications) == 1
+
+    # Invalid batches are rejected without changing the chatroom.
+    for invalid_events in ("Hello", json.dumps([{'type': 'unknown', 'body': "Hello"}]), json.dumps(events * 2)):
+        response = client.post("/ChatCollectionServer/post_events", data=dict(params, events=invalid_events))
+        assert response.status_code == 400
+    assert chatroom.version == version + 1
+
+
+@pytest.mark.cfg(tab_tokens="True")
+def test_posted_batches_are_added_once(api, client):
+    token = join_page(client)
+    chatroom = next(iter(api.chatrooms.values()))
+    params = {'clientTabId': '1', 'chatroom': chatroom.id, 'token': token, 'events': json.dumps([{'type': 'msg', 'body': "Hello"}])}
+
+    # A batch sent again after a lost response is only acknowledged.
+    acknowledgment = client.post("/ChatCollectionServer/post_events", data=dict(params, batchId='a-1')).get_json()
+    assert client.post("/ChatCollectionServer/post_events", data=dict(params, batchId='a-1')).get_json() == acknowledgment
+    assert [evt['body'] for evt in chatroom.events] == ["Hello"]
+    client.post("/ChatCollectionServer/post_events", data=dict(params, batchId='a-2'))
+    client.post("/ChatCollectionServer/post_events", data=params)
+    assert [evt['body'] for evt in chatroom.events] == ["Hello"] * 3
+
+
+def test_posted_batches_are_recovered_from_the_journal(make_api, tmp_path):
+    api = make_api(journal=str(tmp_path / "journal"))
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.post_events('aaaa_1', chatroom_id, [{'type': 'msg', 'body': "Hello"}], 'a-1')
+    crash(api)
+
+    api = make_api(journal=str(tmp_path / "journal"))
+    api.post_events('aaaa_1', chatroom_id, [{'type': 'msg', 'body': "Hello"}], 'a-1')
+    assert [evt['body'] for evt in api.chatrooms[chatroom_id].events] == ["Hello"]
+
+
+def test_view_templates_are_resolved_once(app, client):
+    app.load_templates()
+    assert set(app.resolved_templates) == set(BaseApp.view_templates)
+    assert app.resolved_templates['version.html'].name == 'default_version.html'
+    assert 'Version: 1.0' in client.get("/ChatCollectionServer/version").get_data(as_text=True)
+
+    # A custom template is only used once the templates are loaded again.
+    app.jinja_loader.loaders.insert(0, jinja2.DictLoader({'version.html': "Custom {{ version }}"}))
+    assert 'Version: 1.0' in client.get("/ChatCollectionServer/version").get_data(as_text=True)
+    app.load_templates()
+    assert client.get("/ChatCollectionServer/version").get_data(as_text=True) == "Custom 1.0"
+
+    # The templates are looked up for each request when they are reloaded automatically.
+    app.jinja_env.auto_reload = True
+    app.load_templates()
+    assert client.get("/ChatCollectionServer/version").get_data(as_text=True) == "Custom 1.0"
+    assert app.resolved_templates == {}
+
+
+def test_static_assets_are_precompressed_and_fingerprinted(app, client):
+    static_dir = Path(__file__).parent.parent / 'static'
+    app.default_static_assets = StaticAssets(str(static_dir))
+    script = (static_dir / 'default_chat.js').read_bytes()
+
+    response = client.get("/ChatCollectionServer/default_static/default_chat.js", headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == script
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    etag = response.headers['ETag']
+    response = client.get("/ChatCollectionServer/default_static/default_chat.js",
+                          headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    assert client.get("/ChatCollectionServer/default_static/default_chat.js").data == script
+    assert 'Content-Encoding' not in client.get("/ChatCollectionServer/default_static/images/red.png",
+                                                headers={'Accept-Encoding': 'gzip'}).headers
+
+    # The pages refer to the fingerprinted URLs, which are cached forever.
+    page = client.get("/ChatCollectionServer/index").get_data(as_text=True)
+    url = app.static_url('default_static/default_utils.js')
+    assert url.startswith('default_static/default_utils.js?v=') and url in page
+    assert 'immutable' in client.get(f"/ChatCollectionServer/{url}").headers['Cache-Control']
+    assert app.static_url('static/missing.css') == 'static/missing.css'
+
+
+def test_chatroom_registry():
+    registry = ChatroomRegistry(shard_count=4)
+    chatrooms = [BaseChatroom(id_=f"chatroom{c}") for c in range(10)]
+    for chatroom in chatrooms:
+        registry.add(chatroom)
+    assert len(registry) == 10
+    assert "chatroom3" in registry and registry["chatroom3"] is chatrooms[3]
+    assert registry.pop("chatroom3") is chatrooms[3]
+    assert "chatroom3" not in registry and registry.get("chatroom3") is None
+    assert sorted(chatroom.id for chatroom in registry.values()) == sorted(f"chatroom{c}" for c in range(10) if c != 3)
+
+
+def test_concurrent_joins_and_leaves(api):
+    api.cfg['prevent_multiple_tabs'] = 'False'
+    errors = []
+
+    def run(t):
+        for c in range(100):
+            user_ids = [f"user{t}x{c}a_1", f"user{t}x{c}b_1"]
+            chatroom_ids = []
+            for user_id in user_ids:
+                data = api.join(user_id)
+                if data is None or len(data['chatroom'].users) > 2:
+                    errors.append(user_id)
+                    return
+                chatroom_ids.append(data['chatroom'].id)
+            for user_id, chatroom_id in zip(user_ids, chatroom_ids):
+                api.post_message(user_id, chatroom_id, "Hello")
+                api.leave_chatroom(user_id, chatroom_id)
+
+    threads = [threading.Thread(target=run, args=(t,)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(api.chatrooms) == 0
+    assert len(api.waiting_rooms) == 0
+    assert len(api.session_index.to_dict()) == 0
+    assert len(api.released_chatrooms) > 0
+
+
+def test_session_index_prevents_multiple_tabs(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    assert api.join('aaaa_2') == "Error: MultipleTabAccessForbidden for user: aaaa_2."
+    assert api.session_index.tabs('aaaa') == {'aaaa_1': [chatroom_id]}
+
+    api.join('bbbb_1')
+    api.leave_chatroom('aaaa_1', chatroom_id)
+    assert 'aaaa' not in api.session_index
+    assert api.get_chatrooms()['sessions'] == {'bbbb': {'bbbb_1': [chatroom_id]}}
+
+    assert api.join('aaaa_2')['chatroom'].id != chatroom_id
+
+    # The session ids might contain underscores.
+    api.join('c_c1_1')
+    assert 'c_c2_1' in api.join('c_c2_1')['chatroom'].users
+
+
+def test_poll_stats_are_bounded(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    chatroom = api.chatrooms[chatroom_id]
+    start = time.time()
+    for p in range(1000):
+        chatroom.has_polled('aaaa_1', start + p)
+
+    poll_stats = chatroom.poll_requests['aaaa_1']
+    assert poll_stats.count == 1001
+    assert len(poll_stats) == 1001
+    assert poll_stats.last == start + 999
+    assert poll_stats[-1] == poll_stats.last_isoformat()
+    assert poll_stats.recent is None
+
+    api.leave_chatroom('aaaa_1', chatroom_id)
+    leaved_user = api.released_chatrooms[chatroom_id].leaved_users['U1']
+    assert leaved_user['poll_num'] == 1001
+    assert leaved_user['last_poll'] == poll_stats.last_isoformat()
+
+
+def test_poll_stats_keep_recent_polls():
+    poll_stats = PollStats(0.0, history_size=3)
+    for p in range(1, 10):
+        poll_stats.record(float(p))
+    assert list(poll_stats.recent) == [7.0, 8.0, 9.0]
+    assert poll_stats[0] == '1970-01-01T00:00:07'
+
+
+def test_cleaner_only_removes_users_whose_deadline_has_expired(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    chatroom = api.chatrooms[chatroom_id]
+    assert len(api.inactivity_index) == 2
+
+    # Nothing has expired yet.
+    api.clean_inactive_users()
+    assert chatroom.users == ['aaaa_1', 'bbbb_1']
+
+    # Both deadlines expire but only bbbb_1 has stopped polling.
+    chatroom.poll_requests['bbbb_1'].last = time.time() - api._get_inactivity_timeout() - 1
+    api.inactivity_index.add('aaaa_1', chatroom_id, 0)
+    api.inactivity_index.add('bbbb_1', chatroom_id, 0)
+    api.clean_inactive_users()
+
+    assert chatroom.users == ['aaaa_1']
+    assert [entry[1] for entry in api.inactivity_index.deadlines].count('aaaa_1') == 2
+
+
+def test_released_chatrooms_are_bounded():
+    released_chatrooms = ReleasedChatrooms(max_count=3, max_summaries=3)
+    chatrooms = [BaseChatroom(id_=f"chatroom{c}") for c in range(7)]
+    for chatroom in chatrooms[:4]:
+        released_chatrooms.add(chatroom)
+    # The least recently used chatroom collapses into a summary.
+    assert isinstance(released_chatrooms.get("chatroom0"), ChatroomSummary)
+    assert released_chatrooms.get("chatroom1") is chatrooms[1]
+    for chatroom in chatrooms[4:6]:
+        released_chatrooms.add(chatroom)
+    assert len(released_chatrooms) == 6
+    assert [chatroom.id for chatroom in released_chatrooms.values()] == \
+        ["chatroom0", "chatroom2", "chatroom3", "chatroom1", "chatroom4", "chatroom5"]
+    assert [chatroom.id for chatroom in released_chatrooms.values() if isinstance(chatroom, BaseChatroom)] == \
+        ["chatroom1", "chatroom4", "chatroom5"]
+    # The oldest summary is forgotten.
+    released_chatrooms.add(chatrooms[6])
+    assert "chatroom0" not in released_chatrooms and len(released_chatrooms) == 6
+
+    released_chatrooms = ReleasedChatrooms(max_count=None, max_age=0)
+    released_chatrooms.add(chatrooms[0])
+    released_chatrooms.add(chatrooms[1])
+    summary, other_summary = released_chatrooms["chatroom0"], released_chatrooms["chatroom1"]
+    assert isinstance(summary, ChatroomSummary) and isinstance(other_summary, ChatroomSummary)
+    # The summaries do not share their users and poll requests.
+    assert summary.users is not other_summary.users and summary.poll_requests is not other_summary.poll_requests
+
+
+def test_evicted_dialogs_are_read_from_the_archive(make_api):
+    api = make_api(archive_format="jsonl", released_chatrooms_max_count=1)
+    chatroom_ids = []
+    for c in range(2):
+        chatroom_id = api.join(f'aaaa{c}_1')['chatroom'].id
+        api.join(f'bbbb{c}_1')
+        api.post_message(f'aaaa{c}_1', chatroom_id, f'Hello {c}')
+        api.leave_chatroom(f'aaaa{c}_1', chatroom_id)
+        api.leave_chatroom(f'bbbb{c}_1', chatroom_id)
+        chatroom_ids.append(chatroom_id)
+    api.archiver.drain()
+
+    summary = api.released_chatrooms[chatroom_ids[0]]
+    assert isinstance(summary, ChatroomSummary)
+    assert summary.last_seq() == 1 and summary.leaved_users['U1']['user_id'] == 'aaaa0_1'
+    assert api.get_released_dialog(chatroom_ids[0])['events'][0]['body'] == 'Hello 0'
+    assert api.get_released_dialog(chatroom_ids[1])['events'][0]['body'] == 'Hello 1'
+    assert api.get_released_dialog('unknown') is None
+
+
+def test_chatroom_pages(api):
+    chatroom_ids = []
+    for c in range(5):
+        chatroom_ids.append(api.join(f'aaaa{c}_1')['chatroom'].id)
+        api.join(f'bbbb{c}_1')
+    api.post_message('aaaa1_1', chatroom_ids[1], "Hello")
+
+    page = api.get_chatroom_page('active', order='created', limit=2)
+    assert [chatroom.id for chatroom in page['chatrooms']] == chatroom_ids[:2:-1]
+    assert page['total'] == 5 and page['more']
+    page = api.get_chatroom_page('active', order='created', offset=4, limit=2)
+    assert [chatroom.id for chatroom in page['chatrooms']] == chatroom_ids[:1] and not page['more']
+
+    # The most recently modified chatroom comes first.
+    assert api.get_chatroom_page('active', limit=1)['chatrooms'][0].id == chatroom_ids[1]
+    assert [chatroom.id for chatroom in api.get_chatroom_page('active', user='bbbb3')['chatrooms']] == [chatroom_ids[3]]
+
+    api.leave_chatroom('aaaa1_1', chatroom_ids[1])
+    api.leave_chatroom('bbbb1_1', chatroom_ids[1])
+    assert chatroom_ids[1] not in [chatroom.id for chatroom in api.get_chatroom_page('active')['chatrooms']]
+    page = api.get_chatroom_page('released', user='aaaa1')
+    assert [chatroom.id for chatroom in page['chatrooms']] == [chatroom_ids[1]] and page['total'] == 1
+
+
+def test_admin_pages(api, client):
+    chatroom_ids = []
+    for c in range(3):
+        chatroom_ids.append(api.join(f'aaaa{c}_1')['chatroom'].id)
+        api.join(f'bbbb{c}_1')
+
+    response = client.get("/ChatCollectionServer/admin/chatrooms?order=created&limit=2")
+    data = json.loads(response.data)
+    assert [chatroom['id'] for chatroom in data['chatrooms']] == chatroom_ids[:0:-1]
+    assert data['total'] == 3 and data['more']
+    assert data['chatrooms'][0]['polls']['aaaa2_1']['count'] == 1
+    assert client.get("/ChatCollectionServer/admin/chatrooms?limit=0").status_code == 400
+    assert client.get("/ChatCollectionServer/admin/chatrooms?status=unknown").status_code == 400
+
+    response = client.get("/ChatCollectionServer/admin?order=created&limit=2")
+    assert response.is_streamed
+    html = response.get_data(as_text=True)
+    assert "チャットルーム(Active) (3)" in html
+    active_table = html[:html.index("チャットルーム(Disactive)")]
+    assert chatroom_ids[2] in active_table and chatroom_ids[0] not in active_table
+    assert 'href="admin?order=created&amp;limit=2&amp;offset=2"' in html
+
+
+def test_admin_rows_are_built_under_the_chatroom_lock(api, client):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    chatroom = api.chatrooms[chatroom_id]
+
+    # The row of the chatroom waits while a user is leaving it.
+    pages = []
+    reader = threading.Thread(target=lambda: pages.append(client.get("/ChatCollectionServer/admin").get_data(as_text=True)))
+    with chatroom.lock:
+        reader.start()
+        time.sleep(0.2)
+        assert reader.is_alive()
+        api.leave_chatroom('bbbb_1', chatroom_id)
+    reader.join()
+    assert "チャットルーム(Active) (1)" in pages[0] and 'bbbb_1' not in pages[0]
+
+
+def test_metrics(api, client):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    timestamp = api.chatrooms[chatroom_id].modified
+    poller = threading.Thread(target=api.get_chatroom, args=(chatroom_id, 'bbbb_1', timestamp))
+    poller.start()
+    time.sleep(0.2)
+    api.post_message('aaaa_1', chatroom_id, 'Hello')
+    poller.join()
+
+    response = client.get("/ChatCollectionServer/metrics")
+    assert response.mimetype == 'text/plain'
+    lines = response.get_data(as_text=True).splitlines()
+    assert "# TYPE chat_join_seconds histogram" in lines
+    assert "chat_join_seconds_count 2" in lines
+    assert "chat_pairing_wait_seconds_count 1" in lines
+    assert 'chat_polls_total{result="changed"} 1' in lines
+    assert "chat_poll_wakeup_seconds_count 1" in lines
+    assert 'chat_poll_park_seconds_bucket{le="0.1"} 0' in lines
+    assert 'chat_poll_park_seconds_bucket{le="+Inf"} 1' in lines
+    assert "chat_post_seconds_count 1" in lines
+    assert "chat_active_chatrooms 1" in lines
+    assert "chat_archive_queue_depth 0" in lines
+
+
+def test_request_logging_is_sampled_and_queued(make_api):
+    records = []
+
+    class ListHandler(logging.Handler):
+
+        def emit(self, record):
+            records.append((threading.current_thread().name, record.getMessage()))
+
+    logger = logging.getLogger('test.request_logging')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    api = make_api(logger=logger, debug_log_sampling=2, log_queue="True")
+    assert logger.handlers != [handler]
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    assert not api.request_logger.sample()
+
+    logger.setLevel(logging.DEBUG)
+    for p in range(4):
+        api.get_chatroom(chatroom_id, 'aaaa_1', None)
+    # The queued records are handled before the listener stops.
+    api.shutdown()
+    logger.removeHandler(handler)
+
+    # One poll out of two has been traced by the listener thread.
+    polls = [message for thread_name, message in records if message.startswith("get_chatroom ")]
+    assert polls == [f"get_chatroom chatroom={chatroom_id} user=aaaa_1 client_timestamp=None"] * 2
+    assert all(thread_name != threading.current_thread().name for thread_name, message in records)
+    assert not any(message.startswith("join ") for thread_name, message in records)
+
+
+def test_dialogs_are_archived_in_the_background(api):
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    api.post_message('aaaa_1', chatroom_id, 'Hello')
+    api.post_message('bbbb_1', chatroom_id, 'Hi')
+    created = api.chatrooms[chatroom_id].created
+    api.leave_chatroom('aaaa_1', chatroom_id)
+    api.leave_chatroom('bbbb_1', chatroom_id)
+
+    api.archiver.drain()
+    year, month, day = created[:10].split('-')
+    with open(f"{api.cfg['archives']}/{year}/{month}/{day}/{chatroom_id}.txt") as dialog_file:
+        lines = dialog_file.read().splitlines()
+    assert lines[0] == "Experiment: 123"
+    assert lines[1].endswith("|U1: Hello")
+    assert lines[2].endswith("|U2: Hi")
+
+    stats = api.get_archive_stats()
+    assert stats['written'] == 1
+    assert stats['queue_depth'] == 0
+
+
+def test_jsonl_archive_backend(make_api, tmp_path):
+    api = make_api(archive_format="jsonl", archive_segment_size=1)
+    chatroom_ids = []
+    for c in range(3):
+        chatroom_id = api.join(f'aaaa{c}_1')['chatroom'].id
+        api.join(f'bbbb{c}_1')
+        api.post_message(f'aaaa{c}_1', chatroom_id, f'Hello {c}')
+        api.post_message(f'bbbb{c}_1', chatroom_id, f'Hi {c}')
+        api.leave_chatroom(f'aaaa{c}_1', chatroom_id)
+        api.leave_chatroom(f'bbbb{c}_1', chatroom_id)
+        api.archiver.drain()
+        chatroom_ids.append(chatroom_id)
+
+    # Each segment exceeds the segment size so a new segment is started for each batch.
+    assert len(list((tmp_path / "dialogs" / "segments").glob('dialogs-*.jsonl'))) == 3
+
+    record = api.archive_backend.read(chatroom_ids[1])
+    assert record['id'] == chatroom_ids[1]
+    assert [(evt['sender'], evt['from'], evt['body']) for evt in record['events']] == \
+        [('U1', 'aaaa1_1', 'Hello 1'), ('U2', 'bbbb1_1', 'Hi 1')]
+
+    # The index is reloaded from the disk.
+    assert JsonlArchiveBackend(api.cfg, api.logger).read(chatroom_ids[2])['events'][0]['body'] == 'Hello 2'
+
+    columns = records_to_columns(read_segments(tmp_path / "dialogs" / "segments"))
+    assert columns['chatroom_id'] == [chatroom_id for chatroom_id in chatroom_ids for m in range(2)]
+    assert columns['sender'] == ['U1', 'U2'] * 3
+
+
+def test_chatrooms_are_recovered_from_the_journal(make_api, tmp_path):
+    cfg = {"archive_format": "jsonl", "journal": str(tmp_path / "journal")}
+    api = make_api(**cfg)
+    chatroom_ids = []
+    for c in range(3):
+        chatroom_id = api.join(f'aaaa{c}_1')['chatroom'].id
+        api.join(f'bbbb{c}_1')
+        api.post_message(f'aaaa{c}_1', chatroom_id, f'Hello {c}')
+        chatroom_ids.append(chatroom_id)
+        if c == 1:
+            # The records preceding the snapshot are not replayed.
+            api.journal.snapshot()
+    api.post_events('bbbb0_1', chatroom_ids[0], [{'type': 'msg', 'body': 'Hi'}, {'type': 'action', 'body': 'smile'}])
+    waiting_chatroom_id = api.join('cccc_1', {'lang': 'ja'})['chatroom'].id
+    # The dialog of this chatroom is released but not archived when the server crashes.
+    api.archiver.submit = lambda chatroom: None
+    api.leave_chatroom('aaaa2_1', chatroom_ids[2])
+    api.leave_chatroom('bbbb2_1', chatroom_ids[2])
+
+    # Simulate a crash: the journal is not snapshotted and its last record is torn.
+    crash(api)
+    segment_path = sorted((tmp_path / "journal").glob('journal-*.log'))[-1]
+    with open(segment_path, mode='ab') as segment_file:
+        segment_file.write(b'\x20\x00\x00\x00torn')
+
+    api = make_api(**cfg)
+    assert set(api.chatrooms.values()) == {api.chatrooms[chatroom_id] for chatroom_id in chatroom_ids[:2] + [waiting_chatroom_id]}
+    chatroom = api.chatrooms[chatroom_ids[0]]
+    assert chatroom.users == ['aaaa0_1', 'bbbb0_1'] and chatroom.closed
+    assert [(evt['seq'], evt['from'], evt['body']) for evt in chatroom.events] == \
+        [(1, 'aaaa0_1', 'Hello 0'), (2, 'bbbb0_1', 'Hi'), (3, 'bbbb0_1', 'smile')]
+    assert [evt['body'] for evt in api.chatrooms[chatroom_ids[1]].events] == ['Hello 1']
+    assert 'aaaa1' in api.session_index
+
+    # The users can go on.
+    assert api.post_message('aaaa0_1', chatroom_ids[0], 'Bye')['chatroom'].last_seq() == 4
+    assert api.users['cccc_1'].attribs == {'lang': 'ja'}
+    assert api.join('dddd_1')['chatroom'].id == waiting_chatroom_id
+
+    # The unarchived dialog is archived.
+    api.archiver.drain()
+    assert api.get_released_dialog(chatroom_ids[2])['events'][0]['body'] == 'Hello 2'
+    api.shutdown()
+
+    # After a clean shutdown, only the snapshot is loaded.
+    assert len(list((tmp_path / "journal").glob('snapshot-*.pickle'))) == 1
+    api = make_api(**cfg)
+    assert [evt['body'] for evt in api.chatrooms[chatroom_ids[0]].events][-1] == 'Bye'
+    assert api.chatrooms[waiting_chatroom_id].users == ['cccc_1', 'dddd_1']
+    assert chatroom_ids[2] not in api.released_chatrooms
+
+
+def test_chatroom_released_during_a_snapshot_is_not_recovered(make_api, tmp_path):
+    cfg = {"archive_format": "jsonl", "journal": str(tmp_path / "journal")}
+    api = make_api(**cfg)
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    api.join('bbbb_1')
+    api.post_message('aaaa_1', chatroom_id, 'Hello')
+    api.archiver.submit = lambda chatroom: None
+
+    # The snapshot lists the chatroom as active and waits for its lock while it is released.
+    chatroom = api.chatrooms[chatroom_id]
+    with chatroom.lock:
+        snapshot = threading.Thread(target=api.journal.snapshot)
+        snapshot.start()
+        time.sleep(0.2)
+        api.leave_chatroom('aaaa_1', chatroom_id)
+        api.leave_chatroom('bbbb_1', chatroom_id)
+    snapshot.join()
+    crash(api)
+
+    api = make_api(**cfg)
+    assert chatroom_id not in api.chatrooms
+    api.archiver.drain()
+    assert api.get_released_dialog(chatroom_id)['events'][0]['body'] == 'Hello'
+
+
+def test_chatroom_created_during_a_snapshot_is_recovered(make_api, tmp_path):
+    api = make_api(journal=str(tmp_path / "journal"))
+
+    # A snapshot starts right after the creation of the chatroom is journaled.
+    append = api.journal.append
+    snapshots = []
+
+    def append_and_snapshot(record):
+        lsn = append(record)
+        if record[0] == 'create':
+            snapshot = threading.Thread(target=api.journal.snapshot)
+            snapshot.start()
+            snapshot.join(timeout=0.5)
+            snapshots.append(snapshot)
+        return lsn
+
+    api.journal.append = append_and_snapshot
+    chatroom_id = api.join('aaaa_1')['chatroom'].id
+    snapshots[0].join()
+    crash(api)
+
+    api = make_api(journal=str(tmp_path / "journal"))
+    assert api.chatrooms[chatroom_id].users == ['aaaa_1']
+    assert api.join('bbbb_1')['chatroom'].id == chatroom_id
+
+
+def test_journal_records_follow_the_chatrooms_of_the_snapshot(tmp_path):
+    # The snapshot saved the chatroom after its last 3 records, which were lost in a crash.
+    journal = EventJournal(tmp_path / "journal", logging.getLogger('test'))
+    journal.recover()
+    journal.start()
+    segment_number, lsn = journal.rotate()
+    chatroom = BaseChatroom(id_="chatroom0")
+    chatroom.add_events([{'type': 'msg', 'body': "Hello"}])
+    journal.write_snapshot(segment_number, lsn, [(3, pickle.dumps(chatroom), {})], [])
+    journal.close()
+
+    # The records written after the restart are replayed by the next one.
+    journal = EventJournal(tmp_path / "journal", logging.getLogger('test'))
+    assert [evt['body'] for evt in journal.recover().chatrooms["chatroom0"].events] == ["Hello"]
+    journal.start()
+    assert journal.append(('add_events', "chatroom0", [{'type': 'msg', 'body': "World"}], time.time())) == 4
+    journal.commit()
+    journal.close()
+
+    journal = EventJournal(tmp_path / "journal", logging.getLogger('test'))
+    assert [evt['body'] for evt in journal.recover().chatrooms["chatroom0"].events] == ["Hello", "World"]
@@ -87,6 +87,14 @@ def get_chatroom_id(script_base):
     return None
 
 
+def parse_chatroom(resp):
+    # The chatroom is sent as a JSON object or as a JSON string when the chatroom.json template is used.
+    chatroom = json.loads(resp)
+    if isinstance(chatroom, str):
+        chatroom = json.loads(chatroom)
+    return chatroom
+
+
 def run_command(command):
     stream = os.popen(command)
     output = stream.read()
@@ -326,7 +334,7 @@ def test_several_users_chatting_together():
             session_id = f'1234abcd-aaaa-bbbb-cccc-0000000000{u:02}'
             command = f'curl -X POST http://127.0.0.1:{PORT}/{WEBAPP_CONTEXT}/post -d "clientTabId=11111" -d "chatroom={user_chatrooms[u]}" -d "message={msg}" --cookie "CGISESSID={session_id}"'
             resp_greeting_msg = run_command(command)
-            resp_json = json.loads(resp_greeting_msg.strip().encode('utf-8').decode('unicode_escape')[1:-1])
+            resp_json = parse_chatroom(resp_greeting_msg)
             assert resp_json['id'] == user_chatrooms[u]
 
             if user_chatrooms[u] not in msg_count_per_chatroom:
@@ -340,7 +348,7 @@ def test_several_users_chatting_together():
             session_id = f'1234abcd-aaaa-bbbb-cccc-0000000000{user:02}'
             command = f'curl -X POST http://127.0.0.1:{PORT}/{WEBAPP_CONTEXT}/post -d "clientTabId=11111" -d "chatroom={user_chatrooms[user]}" -d "message={msg}" --cookie "CGISESSID={session_id}"'
             resp_msg = run_command(command)
-            resp_json = json.loads(resp_msg.strip().encode('utf-8').decode('unicode_escape')[1:-1])
+            resp_json = parse_chatroom(resp_msg)
             assert resp_json['id'] == user_chatrooms[user]
 
             if user_chatrooms[user] not in msg_count_per_chatroom:
@@ -353,7 +361,7 @@ def test_several_users_chatting_together():
             session_id = f'1234abcd-aaaa-bbbb-cccc-0000000000{u:02}'
             command = f'curl -X POST http://127.0.0.1:{PORT}/{WEBAPP_CONTEXT}/post -d "clientTabId=11111" -d "chatroom={user_chatrooms[u]}" -d "message={msg}" --cookie "CGISESSID={session_id}"'
             resp_farewell_msg = run_command(command)
-            resp_json = json.loads(resp_farewell_msg.strip().encode('utf-8').decode('unicode_escape')[1:-1])
+            resp_json = parse_chatroom(resp_farewell_msg)
             assert resp_json['id'] == user_chatrooms[u]
 
             if user_chatrooms[u] not in msg_count_per_chatroom:
@@ -385,7 +393,7 @@ def test_several_users_chatting_together():
             session_id = f'1234abcd-aaaa-bbbb-cccc-0000000000{u:02}'
             command = f'curl --cookie "CGISESSID={session_id}" -G http://127.0.0.1:{PORT}/{WEBAPP_CONTEXT}/leave -d clientTabId=11111 -d chatroom={user_chatrooms[u]}'
             resp_leave = run_command(command)
-            resp_json = json.loads(resp_leave.strip().encode('utf-8').decode('unicode_escape')[1:-1])
+            resp_json = parse_chatroom(resp_leave)
             user_id = f'{session_id}_11111'
             assert 'id' not in resp_json or resp_json['id'] == user_chatrooms[u] and 'users' not in resp_json or user_id not in resp_json['users']
 
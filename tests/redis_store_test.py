@@ -0,0 +1,119 @@
+import logging
+import pytest
+import threading
+import time
+
+from server.base import BaseApi
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from server.redis_store import RedisStateStore
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two Api instances sharing the same Redis server behave like two worker processes.
+    server = fakeredis.FakeServer()
+
+    class Api(BaseApi):
+
+        def _create_state_store(self):
+            return RedisStateStore(self.cfg, self.logger, client=fakeredis.FakeRedis(server=server))
+
+    apis = []
+    for w in range(2):
+        cfg = {
+            "archives": str(tmp_path / f"dialogs{w}"),
+            "poll_interval": 5,
+            "delay_for_partner": 60,
+            "chatroom_cleaning_interval": 3600,
+            "msg_count_low": 5,
+            "msg_count_high": 15,
+            "experiment_id": 123,
+            "prevent_multiple_tabs": "True",
+            "state_store": "redis"
+        }
+        apis.append(Api(cfg, logging.getLogger(f"worker{w}")))
+    yield apis
+    for api in apis:
+        api.shutdown()
+
+
+def test_users_joining_different_workers_are_paired(workers):
+    chatroom_id = workers[0].join('aaaa_1')['chatroom'].id
+    data = workers[1].join('bbbb_1')
+    assert data['chatroom'].id == chatroom_id
+    assert data['chatroom'].users == ['aaaa_1', 'bbbb_1']
+    assert data['chatroom'].closed
+    assert len(workers[0].waiting_rooms) == 0
+
+    workers[0].post_message('aaaa_1', chatroom_id, "Hello")
+    chatroom = workers[1].get_chatroom(chatroom_id, 'bbbb_1', None)['chatroom']
+    assert [evt['body'] for evt in chatroom.events] == ["Hello"]
+
+
+def test_parked_poll_is_woken_up_by_another_worker(workers):
+    chatroom_id = workers[0].join('aaaa_1')['chatroom'].id
+    workers[1].join('bbbb_1')
+    timestamp = workers[0].get_chatroom(chatroom_id, 'aaaa_1', None)['chatroom'].modified
+
+    result = {}
+
+    def poll():
+        start = time.monotonic()
+        result['data'] = workers[0].get_chatroom(chatroom_id, 'aaaa_1', timestamp)
+        result['elapsed'] = time.monotonic() - start
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    time.sleep(0.2)
+    workers[1].post_message('bbbb_1', chatroom_id, "Hello")
+    poller.join()
+
+    assert result['elapsed'] < 2
+    assert [evt['body'] for evt in result['data']['chatroom'].events] == ["Hello"]
+
+
+def test_chatroom_released_by_another_worker(workers):
+    chatroom_id = workers[0].join('aaaa_1')['chatroom'].id
+    workers[1].join('bbbb_1')
+    workers[0].get_chatroom(chatroom_id, 'aaaa_1', None)
+
+    workers[1].leave_chatroom('bbbb_1', chatroom_id)
+    workers[1].leave_chatroom('aaaa_1', chatroom_id)
+    # Wait for the notification.
+    time.sleep(0.2)
+
+    assert chatroom_id not in workers[0].chatrooms
+    assert workers[0].get_chatroom(chatroom_id, 'aaaa_1', None) is None
+    assert [chatroom.id for chatroom in workers[0].released_chatrooms.values()] == [chatroom_id]
+    assert [chatroom.id for chatroom in workers[0].get_chatroom_page('released')['chatrooms']] == [chatroom_id]
+    assert len(workers[0].session_index.to_dict()) == 0
+
+
+def test_multiple_tabs_are_detected_across_workers(workers):
+    workers[0].join('aaaa_1')
+    assert workers[1].join('aaaa_2').startswith("Error: MultipleTabAccessForbidden")
+    assert workers[1].session_index.tabs('aaaa') == {'aaaa_1': [workers[0].chatrooms.values()[0].id]}
+
+
+def test_concurrent_joins_across_workers(workers):
+    assignments = {}
+
+    def join(w):
+        for u in range(20):
+            user_id = f"user{w}x{u}_1"
+            assignments[user_id] = workers[w % 2].join(user_id)['chatroom'].id
+
+    threads = [threading.Thread(target=join, args=(w,)) for w in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    users_per_chatroom = {}
+    for chatroom_id in assignments.values():
+        users_per_chatroom[chatroom_id] = users_per_chatroom.get(chatroom_id, 0) + 1
+    assert sorted(set(users_per_chatroom.values())) == [2]
+    assert len(workers[0].chatrooms) == 60
+    assert len(workers[1].waiting_rooms) == 0